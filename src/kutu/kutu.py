@@ -4,26 +4,51 @@ import errno
 import shutil
 import re
 import tempfile
-import json
-from time import strftime, localtime
+import sqlite3
 import shlex
 import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from .utils.kwargs import clean_kwargs, invalid_kwargs
 from .utils.user import get_uid
 from .utils.path import which
 from .utils.platform import get_arch
-from .utils.getfile import file_get
-from .utils.tar import tar_extract
-from .utils.checksum import checksum_url, parse_checksum, verify_all
+from .utils.getfile import file_get_cached, file_stream, file_get_segmented, probe_url
+from .utils.tar import tar_extract_stream
+from .utils.checksum import checksum_url, parse_checksum, perform_checksum, HashReader
 from .utils.cmd import run_cmd
+from .utils.cache import DownloadCache, MetadataCache, parse_size, CACHE_MAX_SIZE
+from .utils.yamlfile import yaml_load
 from .lib.funcutils import alias_function
-from .utils.jsonfile import JsonFile
+from .lib.layers import LayerStore, copy_upperdir
+from .lib.dedup import ContentFarm, FARM_ROOT
+from .lib.manifest import Manifest
+from .lib.state import StateStore
+from .lib.registry import Registry
+from .lib.trash import move_to_trash, reap, spawn_reaper, TRASH_NAME
+from .lib.gc import Collector, tree_size
+from .lib.debian import (DebianBootstrap, debian_arch, DEBIAN_MIRROR, UBUNTU_MIRROR,
+                         UBUNTU_PORTS_MIRROR, DEBIAN_KEYRING, UBUNTU_KEYRING)
+from .lib.zygote import available as zygote_available, POOL_MAX_MEMORY
 from .services.container import ContainerStart, ContainerStop
+from .services.zygote import Zygote
 
 
 logger = logging.getLogger(__name__)
 
+# sqlite connections can not be shared between threads, each
+# thread opens its own state store and registry
+_state_stores = threading.local()
+_reaper_spawned = False
+
+# concurrent batch bootstraps fetching one url or building one layer
+_named_locks = {}
+_named_locks_guard = threading.Lock()
+
+# batch bootstraps run this many downloads at once
+BOOTSTRAP_DOWNLOADS = 8
+
 
 def _ensure_cont_exists(wrapped):
     """
@@ -81,6 +106,91 @@ def _cont_root(name="", all_roots=False):
         return os.path.join("/var/lib/kutu/containers", name)
 
 
+def _kutu_root():
+    """
+    Return the directory holding all kutu data
+    """
+    return "/var/lib/kutu"
+
+
+def _download_root():
+    """
+    Return the directory keeping downloads across bootstrap attempts
+    """
+    return "/var/lib/kutu/downloads"
+
+
+def _download_cache():
+    """
+    Return the download cache, its budget can be set with KUTU_CACHE_SIZE
+    """
+    max_size = os.getenv("KUTU_CACHE_SIZE")
+    if max_size:
+        return DownloadCache(max_size=parse_size(max_size))
+    return DownloadCache(max_size=CACHE_MAX_SIZE)
+
+
+def _metadata_max_age():
+    """
+    Return how many seconds cached release indexes are trusted without
+    revalidation, set with KUTU_METADATA_MAX_AGE (default: always revalidate)
+    """
+    max_age = os.getenv("KUTU_METADATA_MAX_AGE")
+    if max_age:
+        try:
+            return int(max_age)
+        except ValueError:
+            raise Exception("Invalid KUTU_METADATA_MAX_AGE '{}'".format(max_age))
+    return None
+
+
+def _pool_max_memory():
+    """
+    Return the memory warm PID1s of the zygote may use,
+    set with KUTU_POOL_MEMORY
+    """
+    max_memory = os.getenv("KUTU_POOL_MEMORY")
+    if max_memory:
+        return parse_size(max_memory)
+    return POOL_MAX_MEMORY
+
+
+def _dist_setting(dist, key, default=None):
+    """
+    Return a per distribution setting, overridden with KUTU_<DIST>_<KEY>,
+    e.g. KUTU_DEBIAN_MIRROR
+    """
+    return os.getenv("KUTU_{}_{}".format(dist.upper(), key.upper()), default)
+
+
+def _state():
+    """
+    Return the state store, importing images.json on first use
+    """
+    global _reaper_spawned
+    store = getattr(_state_stores, "store", None)
+    if store is None:
+        store = StateStore(legacy_images=os.path.join(_img_root(), "images.json"),
+                           legacy_containers=_cont_root())
+        _state_stores.store = store
+        if not _reaper_spawned:
+            _reaper_spawned = True
+            # finish deletions an earlier run left behind
+            spawn_reaper([_img_root(TRASH_NAME), _cont_root(TRASH_NAME), LayerStore().trash])
+    return store
+
+
+def _registry():
+    """
+    Return the registry answering name lookups without directory scans
+    """
+    registry = getattr(_state_stores, "registry", None)
+    if registry is None or registry.state is not _state():
+        registry = Registry(_state(), _pid())
+        _state_stores.registry = registry
+    return registry
+
+
 def _make_images_root(name):
     """
     Make the image root directory
@@ -144,29 +254,147 @@ def _build_failed(dest, name):
     raise Exception("Container {} failed to build".format(name))
 
 
-def _add_img_json(name, imgbase, version):
+def _add_image(name, imgbase, version, layers):
     """
-    adds new image to json file
+    adds new image to the state store, layers are listed base first
     """
-    new_img = {
-        "ImageName": name,
-        "ImageBase": imgbase,
-        "Version": version,
-        "CreatedTime": strftime("%Y-%m-%d %H:%M:%S", localtime()),
-        "Containers": []
-    }
     try:
-        with JsonFile(os.path.join(_img_root(), "images.json"), "r+") as f:
-            json_data = f.read()
-            json_data["images"].append(new_img)
-            f.save()
-    except IOError as exc:
-        raise Exception("Image {} failed to add to json file: {}".format(name, exc))
+        _state().add_image(name, imgbase, version, layers)
+    except sqlite3.Error as exc:
+        raise Exception("Image {} failed to add to state store: {}".format(name, exc))
 
 
-def _bootstrap_alpine(name, **kwargs):
+def _selected_images(name=None):
     """
-    Boostrap an Alpine Linux container
+    Return the named images, or all of them
+    """
+    try:
+        images = _state().list_images()
+    except sqlite3.Error as exc:
+        raise Exception("Unable to read images: {}".format(exc))
+    return [i for i in images if not name or i["name"] in name]
+
+
+def _named_lock(name):
+    """
+    Return the lock serializing threads working on |name|
+    """
+    with _named_locks_guard:
+        return _named_locks.setdefault(name, threading.Lock())
+
+
+def _dedup_layer(path):
+    """
+    Replace files of a new layer that already exist in other layers.
+    Only the staging directory, which no overlay mounts yet, is changed.
+    """
+    with ContentFarm() as farm:
+        farm.dedup_tree(path)
+    logger.info("Deduplicated %d files, %d bytes", farm.files, farm.saved)
+
+
+def _download_rootfs(url, hashname, checksum):
+    """
+    Bring a rootfs tarball into the download cache, fetching it in
+    parallel and resumably when the server accepts ranges, and return
+    its cached path and whether it was just verified. The path is None
+    when the tarball has to be streamed while it is extracted, see
+    _extract_rootfs().
+    """
+    with _named_lock(url):
+        cache = _download_cache()
+        cached = cache.lookup(url, checksum)
+        if cached is not None:
+            logger.info("Using cached '%s'", os.path.basename(url))
+            return cached, False
+
+        size, ranges, _, _ = probe_url(url)
+        if not ranges or size is None:
+            return None, False
+        os.makedirs(_download_root(), exist_ok=True)
+        file_path = os.path.join(_download_root(), os.path.basename(url))
+        if file_get_segmented(url, file_path) != 0:
+            raise Exception("'{}': Rootfs download failed, bootstrap again to resume it".format(url))
+        # cached blobs are trusted by digest, only a verified one goes in
+        if perform_checksum(file_path, hashname, use_cache=False)[0] != checksum:
+            os.remove(file_path)
+            raise Exception("'{}': Failed on {} verification, download discarded".format(url, hashname))
+        return cache.insert(file_path, url, checksum), True
+
+
+def _extract_rootfs(url, cached, dest, hashname, checksum, digests=None, verified=False):
+    """
+    Extract a rootfs tarball into dest, hashing it on the fly.
+    |cached| is the path _download_rootfs() returned; when it is None the
+    tarball is streamed from url and added to the download cache.
+    A |verified| cached file, hashed right after its download, is
+    extracted without hashing it again.
+    The caller must discard dest if this raises.
+    |digests| is filled with the sha256 of every extracted file.
+    """
+    mismatch = []
+
+    def _extract(fileobj, copy_to=None):
+        if verified and copy_to is None:
+            if not tar_extract_stream(fileobj, dest, digests):
+                raise Exception("'{}': Extraction failed".format(url))
+            return
+        reader = HashReader(fileobj, hashname, copy_to=copy_to)
+        if not tar_extract_stream(reader, dest, digests):
+            raise Exception("'{}': Extraction failed".format(url))
+        # the archive may end before the file does, hash the trailing padding too
+        reader.drain()
+        if reader.hexdigest() != checksum:
+            mismatch.append(reader.hexdigest())
+            raise Exception(
+                "'{}': Failed on {} verification, extracted files discarded".format(url, hashname)
+            )
+
+    fileobj = None
+    if cached is not None:
+        try:
+            fileobj = open(cached, "rb")
+        except FileNotFoundError:
+            # evicted by a download of a concurrent bootstrap
+            logger.debug("'%s' left the download cache, streaming it", url)
+    if fileobj is None:
+        verified = False
+        with _named_lock(url):
+            cache = _download_cache()
+            # another bootstrap may have streamed it meanwhile
+            cached = cache.lookup(url, checksum)
+            if cached is not None:
+                fileobj = open(cached, "rb")
+            else:
+                os.makedirs(_download_root(), exist_ok=True)
+                file_path = os.path.join(_download_root(), os.path.basename(url))
+                try:
+                    with open(file_path, "wb") as f:
+                        if file_stream(url, lambda response: _extract(response, copy_to=f)) != 0:
+                            raise Exception("'{}': Rootfs is not available".format(url))
+                except Exception:
+                    os.remove(file_path)
+                    raise
+                cache.insert(file_path, url, checksum)
+                return
+
+    try:
+        with fileobj:
+            _extract(fileobj)
+    except Exception:
+        # a failed write or a cancelled batch leaves the blob intact
+        if mismatch:
+            try:
+                os.remove(cached)
+            except FileNotFoundError:
+                pass
+        raise
+
+
+def _stage_alpine(name, **kwargs):
+    """
+    Download an Alpine Linux rootfs and return the function that
+    builds the image from it, see _bootstrap_alpine()
     """
     imgbase = "Alpine Linux"
     releases = [
@@ -190,13 +418,16 @@ def _bootstrap_alpine(name, **kwargs):
     mirror = "https://dl-cdn.alpinelinux.org/alpine/"
     arch = get_arch()
     base_url = mirror + version + "/releases/" + arch + "/"
-    temp_dir = tempfile.mkdtemp()
+    # the prefix lets gc find directories of interrupted bootstraps
+    temp_dir = tempfile.mkdtemp(prefix="kutu-")
+    metadata = MetadataCache()
+    max_age = _metadata_max_age()
 
     def _getlastversion():
         reason = "unknown"
         yaml = "latest-releases.yaml"
         yaml_url = base_url + yaml
-        fetch_yaml = file_get(yaml_url, temp_dir)
+        fetch_yaml = file_get_cached(yaml_url, temp_dir, metadata, max_age)
         if fetch_yaml == 0:
             with open(os.path.join(temp_dir, yaml), "r") as f:
                 data = f.read()
@@ -209,6 +440,26 @@ def _bootstrap_alpine(name, **kwargs):
         else:
             return False, reason
 
+    def _build():
+        # the layer is keyed by the tarball digest, a stored one is reused as is
+        digest = "sha256:" + chksum
+        store = LayerStore()
+        try:
+            with _named_lock(digest):
+                if not store.exists(digest):
+                    with store.writer() as layer:
+                        # verify and extract the rootfs in a single pass
+                        digests = {}
+                        _extract_rootfs(rootfs_url, cached, layer.path, "SHA256", chksum, digests, verified)
+                        if kwargs.get("dedup"):
+                            _dedup_layer(layer.path)
+                        layer.commit(digest, digests)
+            _add_image(name, imgbase, version, [digest])
+        except Exception as exc:
+            _build_failed(dest, name)
+            raise Exception(str(exc)) from None
+        return True
+
     try:
         # get last alpine release version
         result = _getlastversion()
@@ -220,34 +471,37 @@ def _bootstrap_alpine(name, **kwargs):
         rootfs_url = base_url + rootfs_version
         # get checksum url for data integrity
         sums_url = checksum_url(rootfs_version, "SHA256")
-        fetch_rootfs = file_get(rootfs_url, temp_dir)
-        if fetch_rootfs == 0:
-            for file in sums_url:
-                new_url = base_url + file
-                conn = file_get(new_url, temp_dir)
-                if conn == 0:
-                    sum_file = file
-            my_dict = {}
-            chksum = parse_checksum(rootfs_version, os.path.join(temp_dir, sum_file))
-            my_dict.update({"SHA256": chksum})
-            temp_path = os.path.join(temp_dir, rootfs_version)
-            # verify file checksum
-            verify = verify_all(temp_path, my_dict)
-            if verify[0] is True:
-                tar_extract(temp_path, dest)
-            else:
-                raise Exception("'{}': The checksum format is invalid".format(rootfs_version))
-            _add_img_json(name, imgbase, version)
+        sum_file = None
+        for file in sums_url:
+            new_url = base_url + file
+            conn = file_get_cached(new_url, temp_dir, metadata, max_age)
+            if conn == 0:
+                sum_file = file
+                break
+        if sum_file is None:
+            raise Exception("'{}': Checksum file is not available".format(rootfs_version))
+        chksum = parse_checksum(rootfs_version, os.path.join(temp_dir, sum_file))
+        if LayerStore().exists("sha256:" + chksum):
+            cached, verified = None, False
+        else:
+            cached, verified = _download_rootfs(rootfs_url, "SHA256", chksum)
     except Exception as exc:
         _build_failed(dest, name)
         raise Exception(str(exc)) from None
     finally:
         shutil.rmtree(temp_dir)
 
-    return True
+    return _build
 
 
-def _debootstrap(name, version, imgbase):
+def _bootstrap_alpine(name, **kwargs):
+    """
+    Boostrap an Alpine Linux container
+    """
+    return _stage_alpine(name, **kwargs)()
+
+
+def _debootstrap(name, version, imgbase, dedup=False):
     """
     Common deboostrap function
     """
@@ -257,22 +511,67 @@ def _debootstrap(name, version, imgbase):
         )
     try:
         dest = _make_images_root(name)
-        cmd = "debootstrap --include=systemd-container {} {}".format(version, dest)
-        ret = run_cmd(cmd, is_shell=True)
+        with LayerStore().writer() as layer:
+            cmd = "debootstrap --include=systemd-container {} {}".format(version, layer.path)
+            ret = run_cmd(cmd, is_shell=True)
 
-        if ret["returncode"] != 0:
-            raise Exception("Deboostrap failed while installing {} image".format(name))
+            if ret["returncode"] != 0:
+                raise Exception("Deboostrap failed while installing {} image".format(name))
+            if dedup:
+                _dedup_layer(layer.path)
+            digest = layer.commit()
 
-        _add_img_json(name, imgbase, version)
+        _add_image(name, imgbase, version, [digest])
         return ret["stdout"]
     except Exception as exc:
         _build_failed(dest, name)
         raise Exception(str(exc)) from None
 
 
-def _bootstrap_debian(name, **kwargs):
+def _stage_native(name, version, imgbase, dist, mirror, keyring, dedup=False):
     """
-    Bootstrap a Debian Linux container
+    Resolve and download the base packages of a Debian or Ubuntu release
+    and return the function that unpacks and configures them into an
+    image. KUTU_DEBOOTSTRAP=1 uses debootstrap instead. Releases whose
+    signature can not be checked are refused unless KUTU_<DIST>_INSECURE=1.
+    """
+    if os.getenv("KUTU_DEBOOTSTRAP"):
+        result = _debootstrap(name, version, imgbase, dedup)
+        return lambda: result
+
+    dest = _make_images_root(name)
+    try:
+        bootstrap = DebianBootstrap(
+            version, debian_arch(get_arch()), _dist_setting(dist, "mirror", mirror), _download_cache(),
+            metadata=MetadataCache(), max_age=_metadata_max_age(), include=["systemd-container"],
+            keyring=_dist_setting(dist, "keyring", keyring),
+            insecure=_dist_setting(dist, "insecure", "") not in ("", "0"),
+        )
+        packages = bootstrap.resolve()
+        paths = bootstrap.fetch(packages)
+    except Exception as exc:
+        _build_failed(dest, name)
+        raise Exception(str(exc)) from None
+
+    def _build():
+        try:
+            with LayerStore().writer() as layer:
+                bootstrap.install(layer.path, packages, paths)
+                if dedup:
+                    _dedup_layer(layer.path)
+                digest = layer.commit()
+            _add_image(name, imgbase, version, [digest])
+        except Exception as exc:
+            _build_failed(dest, name)
+            raise Exception(str(exc)) from None
+        return True
+
+    return _build
+
+
+def _stage_debian(name, **kwargs):
+    """
+    Stage a Debian Linux bootstrap, see _stage_native()
     """
     imgbase = "Debian Linux"
     version = kwargs.get("version", False)
@@ -290,12 +589,20 @@ def _bootstrap_debian(name, **kwargs):
             'Unsupported Debian version "{}". '
             'Only "stable" or "stretch" and newer are supported'.format(version)
         )
-    return _debootstrap(name, version, imgbase)
+    return _stage_native(name, version, imgbase, "debian", DEBIAN_MIRROR, DEBIAN_KEYRING,
+                         kwargs.get("dedup", False))
 
 
-def _bootstrap_ubuntu(name, **kwargs):
+def _bootstrap_debian(name, **kwargs):
     """
-    Bootstrap a Ubuntu Linux container
+    Bootstrap a Debian Linux container
+    """
+    return _stage_debian(name, **kwargs)()
+
+
+def _stage_ubuntu(name, **kwargs):
+    """
+    Stage a Ubuntu Linux bootstrap, see _stage_native()
     """
     imgbase = "Ubuntu Linux"
     version = kwargs.get("version", False)
@@ -312,13 +619,123 @@ def _bootstrap_ubuntu(name, **kwargs):
             'Unsupported Ubuntu version "{}". '
             '"bionic" and newer are supported'.format(version)
         )
-    return _debootstrap(name, version, imgbase)
+    if get_arch() in ("x86_64", "i386", "i686"):
+        mirror = UBUNTU_MIRROR
+    else:
+        mirror = UBUNTU_PORTS_MIRROR
+    return _stage_native(name, version, imgbase, "ubuntu", mirror, UBUNTU_KEYRING,
+                         kwargs.get("dedup", False))
+
+
+def _bootstrap_ubuntu(name, **kwargs):
+    """
+    Bootstrap a Ubuntu Linux container
+    """
+    return _stage_ubuntu(name, **kwargs)()
+
+
+def _stage_image(name, dist, version=None, dedup=False):
+    """
+    Do the download bound part of a bootstrap and return the function
+    doing the rest. Distributions without a _stage_<dist> function are
+    bootstrapped entirely here.
+    """
+    stage = globals().get("_stage_{}".format(dist))
+    if stage is not None:
+        return stage(name, version=version, dedup=dedup)
+    bootstrap = globals().get("_bootstrap_{}".format(dist))
+    if bootstrap is None:
+        raise Exception('Unsupported distribution "{}"'.format(dist))
+    result = bootstrap(name, version=version, dedup=dedup)
+    return lambda: result
+
+
+def _batch_entries(from_file, dedup=False):
+    """
+    Read the images to bootstrap from a manifest listing them,
+    at the top or under "images:", as name, dist, version and dedup
+    """
+    try:
+        data = yaml_load(from_file)
+    except OSError as exc:
+        raise Exception("Unable to read '{}': {}".format(from_file, exc))
+    if isinstance(data, dict):
+        data = data.get("images")
+    if not isinstance(data, list) or not data:
+        raise Exception("'{}': No images listed".format(from_file))
+
+    entries = []
+    names = set()
+    for entry in data:
+        if not isinstance(entry, dict) or not entry.get("name") or not entry.get("dist"):
+            raise Exception("'{}': Every image needs a name and a dist".format(from_file))
+        unknown = set(entry) - {"name", "dist", "version", "dedup"}
+        if unknown:
+            raise Exception("'{}': Unknown keys {}".format(from_file, ", ".join(sorted(unknown))))
+        name = str(entry["name"])
+        if name in names:
+            raise Exception("'{}': Image {} is listed twice".format(from_file, name))
+        names.add(name)
+        entries.append({
+            "name": name,
+            "dist": str(entry["dist"]),
+            "version": str(entry["version"]) if entry.get("version") is not None else None,
+            "dedup": bool(entry.get("dedup", dedup)),
+        })
+    return entries
+
+
+def _bootstrap_batch(from_file, dedup=False):
+    """
+    Bootstrap the images listed in a manifest concurrently.
+    Downloads run on one pool and, as each finishes, extraction on
+    another, so the batch takes about as long as its slowest image.
+    """
+    entries = _batch_entries(from_file, dedup)
+    errors = {}
+    downloads = ThreadPoolExecutor(max_workers=BOOTSTRAP_DOWNLOADS)
+    builds = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    try:
+        staged = {
+            downloads.submit(_stage_image, **entry): entry["name"] for entry in entries
+        }
+        building = {}
+        for future in as_completed(staged):
+            name = staged[future]
+            try:
+                building[builds.submit(future.result())] = name
+            except Exception as exc:
+                errors[name] = exc
+        for future in as_completed(building):
+            try:
+                future.result()
+            except Exception as exc:
+                errors[building[future]] = exc
+    finally:
+        downloads.shutdown()
+        builds.shutdown()
+
+    report = []
+    for entry in entries:
+        if entry["name"] in errors:
+            exc = errors[entry["name"]]
+            # _build_failed() hides the cause behind a generic message
+            cause = exc.__context__ if exc.__context__ is not None else exc
+            logger.error("Image %s failed: %s", entry["name"], cause)
+            report.append("{}: failed: {}".format(entry["name"], cause))
+        else:
+            report.append("{}: ok".format(entry["name"]))
+    if errors:
+        raise Exception("{} of {} images failed to build\n{}".format(
+            len(errors), len(entries), "\n".join(report)))
+    return report
 
 
 @_check_useruid
-def bootstrap_container(name, dist=None, version=None):
+def bootstrap_container(name=None, dist=None, version=None, dedup=False, from_file=None):
     """
-    Bootstrap a container from package servers
+    Bootstrap a container from package servers,
+    or every image listed in |from_file|
     """
     distro = [
         "debian",
@@ -326,12 +743,18 @@ def bootstrap_container(name, dist=None, version=None):
         "alpine",
     ]
 
-    if dist not in distro and dist is None:
+    if from_file:
+        if name or dist:
+            raise Exception("Give either a name and a distribution or a manifest file")
+        return _bootstrap_batch(from_file, dedup)
+    if not name or not dist:
+        raise Exception("A name and a distribution are required")
+    if dist not in distro:
         raise Exception(
             'Unsupported distribution "{}"'.format(dist)
         )
     try:
-        return globals()["_bootstrap_{}".format(dist)](name, version=version)
+        return globals()["_bootstrap_{}".format(dist)](name, version=version, dedup=dedup)
     except KeyError:
         raise Exception('Unsupported distribution "{}"'.format(dist))
 
@@ -343,30 +766,14 @@ def img_list():
     """
     Lists all kutu images
     """
-    ret = []
-    img_dir = _img_root()
-    try:
-        for dirname in os.listdir(img_dir):
-            if os.path.isdir(os.path.join(img_dir, dirname)):
-                ret.append(dirname)
-    except OSError:
-        pass
-    return ret
+    return sorted(_registry().images())
 
 
 def cont_listall():
     """
     Lists all kutu containers
     """
-    ret = []
-    img_dir = _cont_root()
-    try:
-        for dirname in os.listdir(img_dir):
-            if os.path.isdir(os.path.join(img_dir, dirname)):
-                ret.append(dirname)
-    except OSError:
-        pass
-    return ret
+    return sorted(_registry().containers())
 
 
 @_check_useruid
@@ -374,58 +781,149 @@ def img_remove(name):
     """
     Remove the named image(s)
     """
+    store = LayerStore()
+    state_store = _state()
     try:
-        with JsonFile(os.path.join(_img_root(), "images.json"), "r+") as f:
-            json_data = f.read()
-            for img in name:
-                if img in img_list():
-                    for i in json_data["images"]:
-                        if i["ImageName"] == img and not i["Containers"]:
-                            json_data["images"].remove(i)
-                            shutil.rmtree(os.path.join(_img_root(), img))
-                else:
-                    logger.warning("Image '{}' not found".format(img))
-            f.save()
-    except (IOError, json.decoder.JSONDecodeError) as exc:
+        removed = []
+        for img in name:
+            if img_exists(img):
+                layers = state_store.remove_image(img)
+                if layers is not None:
+                    removed.extend(layers)
+                    move_to_trash(_img_root(img), reap=False)
+            else:
+                logger.warning("Image '{}' not found".format(img))
+        # layers are shared between images, drop only the unreferenced ones
+        for digest in set(removed) - state_store.layers_in_use():
+            store.remove(digest, reap=False)
+        spawn_reaper([_img_root(TRASH_NAME), store.trash])
+        if removed and os.path.isdir(FARM_ROOT):
+            with ContentFarm() as farm:
+                farm.prune()
+    except (IOError, sqlite3.Error) as exc:
         raise Exception("Unable to remove image(s): {}".format(exc))
 
     return True
 
 
-def cont_listrun():
+def _img_lowerdirs(name):
     """
-    Lists running kutu containers
+    Return the read-only directories of the named image, top layer first
+    """
+    image = _state().get_image(name)
+    if image is not None and image["layers"]:
+        return LayerStore().lowerdirs(image["layers"])
+    # images created before the layer store hold their files directly
+    return [_img_root(name)]
+
+
+def _busy_layer_paths():
+    """
+    Return the layer directories of images having a running container
+    """
+    running = _registry().running()
+    paths = set()
+    for i in _selected_images():
+        if any(c in running for c in _state().image_containers(i["name"])):
+            paths.update(_img_lowerdirs(i["name"]))
+    return paths
+
+
+@_check_useruid
+def img_dedup(name=None):
+    """
+    Share identical files between the named images (default: all)
     """
-    ret = []
-    piddir = _pid()
+    store = LayerStore()
+    paths = []
+    for i in _selected_images(name):
+        if i["layers"]:
+            layer_paths = [store.path(digest) for digest in i["layers"]]
+        else:
+            layer_paths = [_img_root(i["name"])]
+        paths.extend(path for path in layer_paths if path not in paths)
+
+    # renaming files under the lowerdirs of a mounted overlay is undefined
+    busy = _busy_layer_paths()
+    for path in [path for path in paths if path in busy]:
+        logger.warning("Skipping '%s', a running container uses it", path)
+        paths.remove(path)
+
+    with ContentFarm() as farm:
+        for path in paths:
+            logger.debug("Deduplicating '%s'", path)
+            farm.dedup_tree(path)
+        farm.prune()
+
+    return "Deduplicated {} files, {:.1f} MiB saved".format(farm.files, farm.saved / 1024 ** 2)
+
+
+@_check_useruid
+def img_pool(name, size):
+    """
+    Set how many warm PID1s a running zygote keeps for the image
+    """
+    if size < 0:
+        raise Exception("Invalid pool size: {}".format(size))
     try:
-        for pidname in os.listdir(piddir):
-            if os.path.isfile(os.path.join(piddir, pidname)):
-                ret.append(pidname.split('.')[0])
-    except OSError:
-        pass
+        if not _state().set_pool(name, size):
+            raise Exception("Image does not exist: {}".format(name))
+    except sqlite3.Error as exc:
+        raise Exception("Unable to set pool size of {}: {}".format(name, exc))
+    if size and not zygote_available():
+        logger.warning("Zygote is not running, start it with 'ktctl zygote start' to fill the pool")
+
+    return True
 
-    return ret
+
+@_check_useruid
+def img_verify(name=None):
+    """
+    Check the files of the named images (default: all) against their layer
+    manifests, only files whose stat changed are hashed again
+    """
+    store = LayerStore()
+    layers = []
+    for i in _selected_images(name):
+        if not i["layers"]:
+            logger.warning("Image '%s' has no layers, skipping it", i["name"])
+        layers.extend(digest for digest in i["layers"] if digest not in layers)
+
+    problems = []
+    with ProcessPoolExecutor() as executor:
+        for digest in layers:
+            manifest_path = store.manifest_path(digest)
+            if not os.path.exists(manifest_path):
+                logger.warning("Layer '%s' has no manifest, recording its current state", digest)
+                Manifest.from_tree(store.path(digest)).save(manifest_path)
+                continue
+            manifest = Manifest.load(manifest_path)
+            problems.extend(manifest.verify(store.path(digest), executor))
+            if manifest.changed:
+                manifest.save(manifest_path)
+
+    return problems or "Verified {} layers".format(len(layers))
+
+
+def cont_listrun():
+    """
+    Lists running kutu containers
+    """
+    return sorted(_registry().running())
 
 
 def img_exists(name):
     """
     Return true if the named container image exists
     """
-    if name in img_list():
-        return True
-    else:
-        return False
+    return _registry().image_exists(name)
 
 
 def cont_exists(name):
     """
     Return true if the named container exists
     """
-    if name in cont_listall():
-        return True
-    else:
-        return False
+    return _registry().container_exists(name)
 
 
 @_check_useruid
@@ -445,7 +943,7 @@ def kill(name):
     Kill the named kutu container(s)
     """
     for i in name:
-        if i in cont_listrun():
+        if _registry().is_running(i):
             pidfile = _pid(i)
             constop = ContainerStop(pidfile)
             constop.stop()
@@ -460,12 +958,67 @@ def state(name):
     """
     Return the state of container (running or stopped)
     """
-    if name in cont_listrun():
+    if _registry().is_running(name):
         return "Running"
     else:
         return "Stopped"
 
 
+def _duration_str(ns):
+    return "{:.3f} ms".format(ns / 1000 ** 2)
+
+
+def _histogram(buckets):
+    """
+    Summarize the buckets of a phase: starts, percentiles and the
+    buckets themselves, each bound to the upper end of its bucket
+    """
+    count = sum(buckets.values())
+    summary = {"starts": count}
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        seen = 0
+        for bucket in sorted(buckets):
+            seen = seen + buckets[bucket]
+            if seen >= count * fraction:
+                summary[name] = "< " + _duration_str(2 ** bucket * 1000)
+                break
+    summary["buckets"] = {
+        "< " + _duration_str(2 ** bucket * 1000): buckets[bucket] for bucket in sorted(buckets)
+    }
+    return summary
+
+
+@_ensure_cont_exists
+def inspect(name, timings=False):
+    """
+    Return the details of the named container; with timings how long
+    each phase of its last start took and histograms over all starts,
+    one set per start path: exec, zygote or warm
+    """
+    try:
+        state_store = _state()
+        if not timings:
+            cont_data = state_store.get_container(name)
+            cont_data.pop("timings", None)
+            cont_data["state"] = state(name)
+            return cont_data
+        path, last = state_store.last_timings(name)
+        histograms = state_store.timing_histograms()
+    except sqlite3.Error as exc:
+        raise Exception("Unable to inspect container {}: {}".format(name, exc))
+
+    return {
+        "last_start": {
+            "path": path,
+            "phases": {phase: _duration_str(ns) for phase, ns in last.items()},
+        },
+        "histograms": {
+            start_path: {phase: _histogram(buckets) for phase, buckets in phases.items()}
+            for start_path, phases in histograms.items()
+        },
+    }
+
+
 @_check_useruid
 def create(name, image, cmd):
     """
@@ -476,27 +1029,14 @@ def create(name, image, cmd):
     else:
         dest = _make_container_root(name)
 
-    new_cont = {
-        "ContainerName": name,
-        "ImageName": image,
-        "Entrypoint": cmd,
-        "CreatedTime": strftime("%Y-%m-%d %H:%M:%S", localtime())
-    }
     try:
-        # first, create container json file
-        with JsonFile(os.path.join(dest, name + ".json"), "w") as f:
-            f.write(new_cont)
-
-        # second, update 'Containers' property in image file
-        with JsonFile(os.path.join(_img_root(), "images.json"), "r+") as jfile:
-            json_data = jfile.read()
-            for i in json_data["images"]:
-                if i["ImageName"] == image:
-                    i["Containers"].append(name)
-            jfile.save()
-    except (IOError, json.decoder.JSONDecodeError) as exc:
+        _state().add_container(name, image, cmd)
+    except sqlite3.Error as exc:
         _build_failed(dest, name)
         raise Exception("Building container failed: {}".format(exc))
+    except Exception:
+        _build_failed(dest, name)
+        raise
 
     return True
 
@@ -514,19 +1054,40 @@ def start(name):
     pidfile = _pid(name)
 
     try:
-        with open(os.path.join(rootdir, name + ".json"), "r") as f:
-            cont_data = json.load(f)
-
-        epoint = shlex.split(cont_data["Entrypoint"])
-        imgdir = _img_root(cont_data["ImageName"])
-        constart = ContainerStart(rootdir, imgdir, pidfile, epoint)
+        cont_data = _state().get_container(name)
+        if cont_data is None:
+            raise Exception("Container '{}' is not registered".format(name))
+
+        epoint = shlex.split(cont_data["entrypoint"])
+        imgdirs = _img_lowerdirs(cont_data["image"])
+        _state().touch_image(cont_data["image"])
+        constart = ContainerStart(rootdir, imgdirs, pidfile, epoint, cont_data["image"], name)
+        # sqlite connections must not cross the daemon's forks, it opens its own
+        _state().close()
         constart.start()
-    except OSError as exc:
+    except (OSError, sqlite3.Error) as exc:
         raise Exception("Unable to start container: {}".format(exc))
 
     return True
 
 
+@_check_useruid
+def zygote(action):
+    """
+    Start, stop or query the server forking container PID1s
+    """
+    if action == "status":
+        return "Running" if zygote_available() else "Stopped"
+    if action == "start":
+        if zygote_available():
+            raise Exception("Zygote already running")
+        Zygote(max_memory=_pool_max_memory()).start()
+    else:
+        Zygote().stop()
+
+    return True
+
+
 @_ensure_cont_exists
 @_check_useruid
 def cont_remove(name, stop=False):
@@ -539,19 +1100,94 @@ def cont_remove(name, stop=False):
     rootdir = _cont_root(name)
 
     try:
-        # first, read the image name from container json
-        with JsonFile(os.path.join(rootdir, name + ".json"), "r") as f:
-            cont_data = f.read()
-            img = cont_data["ImageName"]
-        # second, delete container name from image Containers property
-        with JsonFile(os.path.join(_img_root(), "images.json"), "r+") as jfile:
-            json_data = jfile.read()
-            for i in json_data["images"]:
-                if i["ImageName"] == img:
-                    i["Containers"].remove(name)
-            jfile.save()
-        shutil.rmtree(rootdir)
-    except (IOError, json.decoder.JSONDecodeError) as exc:
+        _state().remove_container(name)
+        move_to_trash(rootdir)
+    except (IOError, sqlite3.Error) as exc:
         raise Exception("Unable to remove container {}: {}".format(name, exc))
 
     return True
+
+
+@_ensure_cont_exists
+@_check_useruid
+def commit(name, image):
+    """
+    Create an image from the base layers of the named container plus
+    a new layer holding its changes
+    """
+    if state(name) != "Stopped":
+        raise Exception("Container is not stopped: {}".format(name))
+
+    rootdir = _cont_root(name)
+    try:
+        state_store = _state()
+        base = state_store.get_container(name)["image"]
+        base_img = state_store.get_image(base)
+    except (TypeError, sqlite3.Error) as exc:
+        raise Exception("Unable to commit container {}: {}".format(name, exc))
+
+    if base_img is None or not base_img["layers"]:
+        raise Exception("Image {} has no layers, bootstrap it again to commit on top of it".format(base))
+
+    dest = _make_images_root(image)
+    try:
+        with LayerStore().writer() as layer:
+            copy_upperdir(os.path.join(rootdir, "upperdir"), layer.path)
+            digest = layer.commit()
+        _add_image(image, base_img["base"], base_img["version"], base_img["layers"] + [digest])
+    except Exception as exc:
+        _build_failed(dest, image)
+        raise Exception(str(exc)) from None
+
+    return digest
+
+
+def _gc_excess(target):
+    """
+    Return how many bytes are used beyond target, either a size for
+    the kutu data directory (e.g. 20G) or a percentage of its disk
+    """
+    target = str(target).strip()
+    if target.endswith("%"):
+        try:
+            percent = float(target[:-1])
+        except ValueError:
+            raise Exception("Invalid target '{}'".format(target))
+        st = os.statvfs(_kutu_root())
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        return used - int(st.f_blocks * st.f_frsize * percent / 100)
+    return tree_size(_kutu_root()) - parse_size(target)
+
+
+@_check_useruid
+def gc(target=None, dry_run=False):
+    """
+    Remove layers, directories and downloads nothing references; with a
+    target also evict cached downloads and unused images, least
+    recently used first, until disk usage fits it
+    """
+    collector = Collector(_state(), LayerStore(), _download_cache(), _img_root(),
+                          _cont_root(), _download_root(), dry_run)
+    try:
+        collector.sweep()
+        if target:
+            excess = _gc_excess(target) - collector.freed
+            if excess > 0:
+                collector.evict(excess)
+        if not dry_run and os.path.isdir(FARM_ROOT):
+            # farm entries of the swept layers only go once those are
+            # reaped, the freed total counts them already
+            for trash in collector.trashes:
+                reap(trash)
+            with ContentFarm() as farm:
+                farm.prune()
+    except sqlite3.Error as exc:
+        raise Exception("Garbage collection failed: {}".format(exc))
+    finally:
+        spawn_reaper(collector.trashes)
+
+    if dry_run:
+        summary = "Would free {:.1f} MiB".format(collector.freed / 1024 ** 2)
+    else:
+        summary = "Freed {:.1f} MiB".format(collector.freed / 1024 ** 2)
+    return collector.report + [summary]
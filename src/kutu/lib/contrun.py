@@ -2,12 +2,14 @@ import json
 import logging
 import os
 import signal
+import struct
 import subprocess
 import sys
+import time
 from pathlib import Path
 from typing import Union, List
 
-from . import create
+from . import create, zygote
 from .variables import NAMESPACES, HOST_NETWORK_BIND_MOUNTS, BindMount, CLONE_NEWPID
 from .libc import unshare, setns
 from .mount import PathEncoder
@@ -16,36 +18,86 @@ logger = logging.getLogger(__name__)
 
 
 class ContainerPID1Manager:
-    def __init__(self, root_dir: Path, *, isolate_networking=False, bind_mounts=None):
+    def __init__(self, root_dir: Path, *, isolate_networking=False, bind_mounts=None, image=None, overlay=None):
         self.root_dir = root_dir.resolve()
         self.isolate_networking = isolate_networking
         self.bind_mounts = bind_mounts
         if self.bind_mounts is None:
             self.bind_mounts = []
-
-    def do_exec(self, control_read, control_write):
-        logger.debug("Executing {} {}".format(sys.executable, create.__file__))
-        params = json.dumps({
+        # picks the zygote pool of warm PID1s to claim from
+        self.image = image
+        self.overlay = overlay
+        # nanoseconds spent in each phase of start(), PID1's included;
+        # phases differ by how PID1 was started: exec, zygote or warm
+        self.timings = {}
+        self.start_path = None
+        # connection to the zygote that forked PID1, if one did
+        self.zygote_conn = None
+
+    def params(self):
+        return {
             "loglevel": logging.getLevelName(logger.getEffectiveLevel()),
             "root_dir": self.root_dir,
-            "control_read": control_read,
-            "control_write": control_write,
             "isolate_networking": self.isolate_networking,
             "bind_mounts": self.bind_mounts,
-        }, cls=PathEncoder)
+            "overlay": self.overlay,
+        }
+
+    def do_exec(self, control_read, control_write):
+        logger.debug("Executing {} {}".format(sys.executable, create.__file__))
+        params = dict(self.params(), control_read=control_read, control_write=control_write)
+
+        os.execl(sys.executable, sys.executable, create.__file__, json.dumps(params, cls=PathEncoder))
 
-        os.execl(sys.executable, sys.executable, create.__file__, params)
+    def start_from_zygote(self, pipe_child_read, pipe_child_write):
+        """
+        Have a running zygote fork PID1, False when there is none
+        """
+        if not zygote.available():
+            return False
+        try:
+            self.pid, warm, self.zygote_conn = zygote.spawn(dict(self.params(), image=self.image),
+                                                            pipe_child_read, pipe_child_write)
+        except OSError as exc:
+            logger.debug("Zygote not running, executing PID1: {}".format(exc))
+            return False
+        self.start_path = "warm" if warm else "zygote"
+        logger.debug("Container PID1 forked by the zygote: {}".format(self.pid))
+        return True
+
+    def read_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = os.read(self.control_read, size - len(data))
+            if not chunk:
+                raise RuntimeError("Container PID 1 closed the control pipe")
+            data = data + chunk
+        return data
 
     def wait_for_ready_signal(self):
         if os.read(self.control_read, 3) != b"RDY":
             raise RuntimeError("Container PID 1 did not send Ready signal")
+        # followed by how long its setup phases took
+        size, = struct.unpack("=I", self.read_exact(4))
+        self.timings.update(json.loads(self.read_exact(size).decode("utf-8")))
 
     def start(self):
+        started = time.monotonic_ns()
         pipe_parent_read, pipe_child_write = os.pipe()
         pipe_child_read, pipe_parent_write = os.pipe()
         os.set_inheritable(pipe_child_read, True)
         os.set_inheritable(pipe_child_write, True)
 
+        if self.start_from_zygote(pipe_child_read, pipe_child_write):
+            self.timings["fork"] = time.monotonic_ns() - started
+            os.close(pipe_child_read)
+            os.close(pipe_child_write)
+            self.control_read = pipe_parent_read
+            self.control_write = pipe_parent_write
+            self.wait_for_ready_signal()
+            self.timings["ready"] = time.monotonic_ns() - started
+            return
+
         # We unshare (change) the pid namespace here, and other namespaces after
         # the exec, because if we exec'd in the new mount namespace, it would open
         # files in the new namespace's root, and prevent us from umounting the old
@@ -54,6 +106,7 @@ class ContainerPID1Manager:
         # safe because unshare() affects the calling thread only.
         unshare(CLONE_NEWPID)
 
+        self.start_path = "exec"
         self.pid = os.fork()
         if not self.pid:
             # this is the child process, will turn into PID1 in the container
@@ -65,6 +118,7 @@ class ContainerPID1Manager:
                 print(e, file=sys.stderr)
                 os._exit(1)
 
+        self.timings["fork"] = time.monotonic_ns() - started
         logger.debug("Container PID1 actual PID: {}".format(self.pid))
 
         # Reset the pid namespace of the parent process. /proc/self/ns/pid contains
@@ -80,13 +134,26 @@ class ContainerPID1Manager:
         self.control_read = pipe_parent_read
         self.control_write = pipe_parent_write
         self.wait_for_ready_signal()
+        self.timings["ready"] = time.monotonic_ns() - started
 
     def kill(self):
         # Killing pid1 will kill every other process in the context
         # The context itself will implode without any references,
         # basically cleaning up everything
-        os.kill(self.pid, signal.SIGKILL)
-        os.waitpid(self.pid, 0)
+        if self.zygote_conn is not None:
+            # PID1 is a child of the zygote, which may have reaped it already;
+            # only the zygote can tell and it reports the exit
+            try:
+                zygote.kill(self.zygote_conn)
+            except OSError as exc:
+                # the zygote closes the connection once it reported the exit
+                logger.debug("Unable to have the zygote kill PID1 {}: {}".format(self.pid, exc))
+            if zygote.wait(self.zygote_conn) is None:
+                logger.warning("Zygote went away, PID1 {} may still be running".format(self.pid))
+            self.zygote_conn = None
+        else:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
 
 
 class SetnsContext:
@@ -137,7 +204,8 @@ class SetnsContext:
 
 
 class ContainerContext:
-    def __init__(self, root_dir: Union[str, Path], *, isolate_networking: bool = False, bind_mounts: List[BindMount] = None):
+    def __init__(self, root_dir: Union[str, Path], *, isolate_networking: bool = False, bind_mounts: List[BindMount] = None,
+                 image: str = None, overlay=None):
         if not isinstance(root_dir, Path):
             root_dir = Path(root_dir)
         self.root_dir = root_dir.resolve()
@@ -145,7 +213,9 @@ class ContainerContext:
             bind_mounts = []
         if not isolate_networking:
             bind_mounts.extend(HOST_NETWORK_BIND_MOUNTS)
-        self.pid1 = ContainerPID1Manager(root_dir, isolate_networking=isolate_networking, bind_mounts=bind_mounts)
+        # overlay: lowerdirs, upperdir and workdir, mounted by PID1 in its own mount namespace
+        self.pid1 = ContainerPID1Manager(root_dir, isolate_networking=isolate_networking, bind_mounts=bind_mounts,
+                                         image=image, overlay=overlay)
         self.setns_context = None
 
     def __enter__(self):
@@ -3,12 +3,16 @@ import logging
 import os
 import signal
 import stat
+import struct
 import subprocess
 import sys
+import time
 from socket import sethostname
 from pathlib import Path
 
-from kutu.lib.libc import unshare, mount, umount2, non_caching_getpid, pivot_root, is_mount_point
+from kutu.lib.libc import unshare, mount, umount2, non_caching_getpid, pivot_root, open_tree, move_mount
+from kutu.lib.mountinfo import is_mount_point
+from kutu.lib.mount import OverlayfsMountContext
 from kutu.lib.variables import *
 from kutu.utils.genhostname import gen_hostname
 
@@ -16,15 +20,39 @@ logger = logging.getLogger(__name__)
 
 HOSTNAME = gen_hostname(8)
 
+# default mounts the same for every container, see build_template()
+TEMPLATE_MOUNTS = [Path("/sys")]
+
 
 class PID1:
-    def __init__(self, root_dir, control_read, control_write, isolate_networking, bind_mounts):
+    def __init__(self, root_dir, control_read, control_write, isolate_networking, bind_mounts, overlay=None,
+                 template=None):
         self.control_read = control_read
         self.control_write = control_write
-        self.root_dir = Path(root_dir).resolve()
+        self.root_dir = None
+        if root_dir is not None:
+            self.root_dir = Path(root_dir).resolve()
         self.isolate_networking = isolate_networking
         self.bind_mounts = self.convert_bind_mounts_parameter(bind_mounts)
+        # lowerdirs, upperdir and workdir of an overlayfs mounted at root_dir
+        self.overlay = overlay
         self.loop_devices = list(self.get_loop_devices())
+        # where the default mounts are made, see prepare()
+        self.sandbox = Path("/")
+        # nanoseconds each setup phase took, sent along with RDY
+        self.timings = {}
+        # directory of a build_template() tree, cloned instead of mounting /sys
+        self.template = template
+        self.template_fds = {}
+
+    def timed(self, phase, func):
+        start = time.monotonic_ns()
+        result = func()
+        self.timings[phase] = time.monotonic_ns() - start
+        return result
+
+    def sandbox_path(self, path):
+        return self.sandbox.joinpath(Path(path).relative_to("/"))
 
     @classmethod
     def convert_bind_mounts_parameter(cls, bind_mounts):
@@ -66,36 +94,97 @@ class PID1:
                 flags = MS_REMOUNT | MS_BIND | MS_RDONLY
                 mount(Path(), destination, None, flags, None)
 
-    def setup_root_mount(self):
+    def mount_overlay(self):
+        if self.overlay is not None:
+            lowerdirs, upperdir, workdir = self.overlay
+            OverlayfsMountContext(lowerdirs, upperdir, workdir, self.root_dir).mount()
+
+    def make_root_slave(self):
         # SLAVE means that mount events will get inside the container, but
         # mounting something inside will not leak out.
         # Use PRIVATE to not let outside events propagate in
         mount(Path("none"), Path("/"), None, MS_REC | MS_SLAVE, None)
+
+    def setup_root_mount(self):
+        self.make_root_slave()
+        self.timed("mount_overlay", self.mount_overlay)
+        self.bind_root()
+        self.pivot_root()
+
+    def bind_root(self):
         self.create_bind_mounts()
         if not is_mount_point(self.root_dir):
             mount(self.root_dir, self.root_dir, None, MS_BIND, None)
+
+    def pivot_root(self):
         old_root_dir = self.root_dir.joinpath('old_root')
         old_root_dir.mkdir(parents=True, exist_ok=True)
         os.chdir(str(self.root_dir))
         pivot_root(Path('.'), Path('old_root'))
         os.chroot('.')
 
+    def open_template(self):
+        """
+        Clone the template mounts, while the host tree is still reachable
+        """
+        if self.template is None:
+            return
+        for destination in TEMPLATE_MOUNTS:
+            # sysfs shows the network namespace of whoever mounted it
+            if destination == Path("/sys") and self.isolate_networking:
+                continue
+            source = Path(self.template).joinpath(destination.relative_to("/"))
+            self.template_fds[destination] = open_tree(source, OPEN_TREE_CLONE | OPEN_TREE_CLOEXEC | AT_RECURSIVE)
+
+    def clone_template(self, destination):
+        fd = self.template_fds.pop(destination, None)
+        if fd is None:
+            return False
+        try:
+            destination = self.sandbox_path(destination)
+            destination.mkdir(parents=True, exist_ok=True)
+            move_mount(fd, destination)
+        finally:
+            os.close(fd)
+        return True
+
     def mount_defaults(self):
         for m in CONTAINER_MOUNTS:
+            if m.destination in self.template_fds:
+                self.clone_template(m.destination)
+                continue
             options = None
             if m.options:
                 options = ",".join(m.options)
-            m.destination.mkdir(parents=True, exist_ok=True)
-            mount(m.source, m.destination, m.type, m.flags, options)
+            source = m.source
+            if isinstance(source, Path):
+                source = self.sandbox_path(source)
+            destination = self.sandbox_path(m.destination)
+            destination.mkdir(parents=True, exist_ok=True)
+            mount(source, destination, m.type, m.flags, options)
+
+    def move_defaults(self):
+        """
+        Move the default mounts made in the sandbox into the root
+        """
+        for m in CONTAINER_MOUNTS:
+            # submounts move along with their parent
+            if m.destination.parent != Path("/") or m.type is None:
+                continue
+            destination = self.root_dir.joinpath(m.destination.relative_to("/"))
+            destination.mkdir(parents=True, exist_ok=True)
+            mount(self.sandbox_path(m.destination), destination, None, MS_MOVE, None)
 
     def inaccessible_mounts(self):
         for m in INACCESSIBLE_MOUNTS:
-            mount(Path("/dev/null"), m, None, MS_BIND, None)
+            m = self.sandbox_path(m)
+            mount(self.sandbox_path("/dev/null"), m, None, MS_BIND, None)
             mount(None, m, None, MS_BIND | MS_RDONLY | MS_NOSUID | MS_NOEXEC | MS_NODEV | MS_REMOUNT, None)
 
     def readonly_mounts(self):
         for m in READONLY_MOUNTS:
-            if Path(m).exists():
+            m = self.sandbox_path(m)
+            if m.exists():
                 mount(m, m, None, MS_BIND, None)
                 mount(None, m, None, MS_BIND | MS_RDONLY | MS_NOSUID | MS_NOEXEC | MS_NODEV | MS_REMOUNT, None)
 
@@ -104,7 +193,7 @@ class PID1:
             device_type = stat.S_IFBLK
         else:
             device_type = stat.S_IFCHR
-        nodepath = Path("/dev", name)
+        nodepath = self.sandbox_path(Path("/dev", name))
         os.mknod(str(nodepath), mode=device_type, device=os.makedev(major, minor))
         # A separate chmod is necessary, because mknod (undocumentedly) takes umask into account when creating
         nodepath.chmod(mode=mode)
@@ -119,13 +208,13 @@ class PID1:
     def create_symlink_devices(self):
         try:
             # create ptmx symlink
-            os.symlink("pts/ptmx", "/dev/ptmx")
-            os.symlink("pts/0", "/dev/console")
-            os.symlink("/proc/self/fd", "/dev/fd")
-            os.symlink("/proc/self/fd/0", "/dev/stdin")
-            os.symlink("/proc/self/fd/1", "/dev/stdout")
-            os.symlink("/proc/self/fd/2", "/dev/stderr")
-            os.symlink("/proc/kcore", "/dev/core")
+            os.symlink("pts/ptmx", self.sandbox_path("/dev/ptmx"))
+            os.symlink("pts/0", self.sandbox_path("/dev/console"))
+            os.symlink("/proc/self/fd", self.sandbox_path("/dev/fd"))
+            os.symlink("/proc/self/fd/0", self.sandbox_path("/dev/stdin"))
+            os.symlink("/proc/self/fd/1", self.sandbox_path("/dev/stdout"))
+            os.symlink("/proc/self/fd/2", self.sandbox_path("/dev/stderr"))
+            os.symlink("/proc/kcore", self.sandbox_path("/dev/core"))
         except OSError as exc:
             raise Exception("Failed to create symlink to devices: {}".format(exc))
 
@@ -146,7 +235,7 @@ class PID1:
                 logger.warning("Namespace type {} not supported on this system".format(name))
         unshare(unshare_flags)
 
-    def run(self):
+    def enter_namespaces(self):
         if non_caching_getpid() != 1:
             raise ValueError("We are not actually PID1, exiting for safety reasons")
 
@@ -154,17 +243,63 @@ class PID1:
         make_sure_codecs_are_loaded = b'a'.decode('unicode_escape')  # NOQA: F841 local variable 'make_sure_codecs_are_loaded' is assigned to but never used
         os.setsid()
         self.enable_zombie_reaping()
-        self.create_namespaces()
-        self.setup_root_mount()
+        self.timed("unshare", self.create_namespaces)
+        self.open_template()
+
+    def run(self):
+        self.enter_namespaces()
+        self.timed("setup_root_mount", self.setup_root_mount)
+        self.timed("mount_defaults", self.mount_defaults)
+        self.timed("create_default_dev_nodes", self.create_default_dev_nodes)
+        self.timed("create_symlink_devices", self.create_symlink_devices)
+        self.timed("inaccessible_mounts", self.inaccessible_mounts)
+        self.timed("readonly_mounts", self.readonly_mounts)
+        self.timed("umount_old_root", self.umount_old_root)
+        sethostname(HOSTNAME)
+        return self.serve()
+
+    def prepare(self, sandbox_dir):
+        """
+        Do the image independent part of run() ahead of time: the
+        namespaces, default mounts, device nodes and masked paths are
+        set up on a tmpfs at |sandbox_dir| until attach() gets a root
+        """
+        self.enter_namespaces()
+        self.make_root_slave()
+        self.sandbox = Path(sandbox_dir)
+        mount("tmpfs", self.sandbox, "tmpfs", MS_NOSUID | MS_NODEV, "mode=755,size=64k")
         self.mount_defaults()
         self.create_default_dev_nodes()
         self.create_symlink_devices()
         self.inaccessible_mounts()
         self.readonly_mounts()
-        self.umount_old_root()
+
+    def attach(self, root_dir, control_read, control_write, bind_mounts, overlay=None):
+        """
+        Finish a prepare()d PID1 with its root and control pipe
+        """
+        self.root_dir = Path(root_dir).resolve()
+        self.control_read = control_read
+        self.control_write = control_write
+        self.bind_mounts = self.convert_bind_mounts_parameter(bind_mounts)
+        self.overlay = overlay
+        # only what is left for the start to pay is reported
+        self.timings = {}
+        self.timed("mount_overlay", self.mount_overlay)
+        self.timed("setup_root_mount", self.attach_root)
+        self.timed("umount_old_root", self.umount_old_root)
         sethostname(HOSTNAME)
+        return self.serve()
 
-        os.write(self.control_write, b"RDY")
+    def attach_root(self):
+        self.bind_root()
+        self.move_defaults()
+        self.pivot_root()
+
+    def serve(self):
+        timings = json.dumps(self.timings).encode("utf-8")
+        # one write below PIPE_BUF, the reader never sees a partial message
+        os.write(self.control_write, b"RDY" + struct.pack("=I", len(timings)) + timings)
         logger.debug("Container started")
         # this will return when the pipe is closed
         # E.g. the outside control process died before killing us
@@ -180,6 +315,24 @@ class PID1:
                 yield DeviceNode(name=loop_path.name, major=major, minor=minor)
 
 
+def build_template(template_dir):
+    """
+    Mount the /sys every container gets under |template_dir|, for PID1s
+    to clone with open_tree(). Clones share the superblock, which a
+    sysfs mount shares anyway within a network namespace. /dev stays a
+    tmpfs of each container's own, a shared one could be remounted
+    read-write or written to by any of them.
+    """
+    builder = PID1(None, None, None, False, [])
+    builder.sandbox = Path(template_dir)
+    mount("tmpfs", builder.sandbox, "tmpfs", MS_NOSUID | MS_NODEV, "mode=755,size=64k")
+    for m in CONTAINER_MOUNTS:
+        if m.destination in TEMPLATE_MOUNTS:
+            destination = builder.sandbox_path(m.destination)
+            destination.mkdir(parents=True, exist_ok=True)
+            mount(m.source, destination, m.type, m.flags, ",".join(m.options) if m.options else None)
+
+
 if __name__ == "__main__":
     args = json.loads(sys.argv[1])
     logger.setLevel(args.pop("loglevel"))
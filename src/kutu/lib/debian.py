@@ -0,0 +1,586 @@
+import bz2
+import gzip
+import hashlib
+import logging
+import lzma
+import os
+import shlex
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ..utils.getfile import file_get_cached, file_stream
+from ..utils.path import which
+from ..utils.tar import extract_pipelined
+
+logger = logging.getLogger(__name__)
+
+DEBIAN_MIRROR = "http://deb.debian.org/debian/"
+UBUNTU_MIRROR = "http://archive.ubuntu.com/ubuntu/"
+UBUNTU_PORTS_MIRROR = "http://ports.ubuntu.com/ubuntu-ports/"
+DEBIAN_KEYRING = "/usr/share/keyrings/debian-archive-keyring.gpg"
+UBUNTU_KEYRING = "/usr/share/keyrings/ubuntu-archive-keyring.gpg"
+# .debs downloaded at once
+FETCH_WORKERS = 8
+# what debootstrap installs by default
+BASE_PRIORITIES = ("required", "important")
+# releases that still keep /bin, /sbin and /lib apart from /usr
+SPLIT_USR = ("stretch", "buster", "bionic")
+
+_machines = {
+    "x86_64": "amd64",
+    "i386": "i386",
+    "i686": "i386",
+    "aarch64": "arm64",
+    "armv7l": "armhf",
+    "armv6l": "armel",
+    "ppc64le": "ppc64el",
+    "s390x": "s390x",
+    "riscv64": "riscv64",
+}
+# merged /usr links, lib64 only where the dynamic loader lives there
+_usr_links = {"amd64": ["bin", "sbin", "lib", "lib64"], "ppc64el": ["bin", "sbin", "lib", "lib64"]}
+_index_compressions = (("xz", lzma.decompress), ("gz", gzip.decompress), ("bz2", bz2.decompress), ("", bytes))
+# dpkg only keeps these control fields of the Packages index in its status
+_index_only = ("Filename", "Size", "MD5sum", "SHA1", "SHA256", "SHA512", "Description-md5", "Tag", "Task")
+
+
+def debian_arch(machine):
+    """
+    Return the Debian name of a machine architecture
+    """
+    try:
+        return _machines[machine]
+    except KeyError:
+        raise Exception("Unsupported architecture '{}'".format(machine))
+
+
+def parse_deb822(text):
+    """
+    Split control data into paragraphs, lists of (field, value) pairs
+    keeping the field order; continuation lines stay in the value
+    """
+    paragraphs = []
+    fields = []
+    for line in text.splitlines():
+        if not line.strip():
+            if fields:
+                paragraphs.append(fields)
+                fields = []
+        elif line[0] in " \t":
+            if fields:
+                fields[-1] = (fields[-1][0], fields[-1][1] + "\n" + line)
+        elif not line.startswith("#"):
+            name, _, value = line.partition(":")
+            fields.append((name.strip(), value.strip()))
+    if fields:
+        paragraphs.append(fields)
+    return paragraphs
+
+
+def parse_relations(value):
+    """
+    Return the package names of a Depends-like field as a list of
+    alternatives, versions, architectures and profiles dropped
+    """
+    groups = []
+    for group in value.split(","):
+        names = []
+        for alternative in group.split("|"):
+            name = alternative.strip().split(" ", 1)[0].split("(", 1)[0].split("[", 1)[0]
+            name = name.split(":", 1)[0]
+            if name:
+                names.append(name)
+        if names:
+            groups.append(names)
+    return groups
+
+
+class _Region:
+    """
+    Read-only view of |size| bytes of a file from its current offset
+    """
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._fileobj.read(size)
+        self._left = self._left - len(data)
+        return data
+
+
+def _ar_members(fileobj):
+    """
+    Yield (name, size) of the members of an ar archive, the file is
+    positioned at the data of each member while the caller handles it
+    """
+    if fileobj.read(8) != b"!<arch>\n":
+        raise Exception("Not a Debian package")
+    offset = 8
+    while True:
+        fileobj.seek(offset)
+        header = fileobj.read(60)
+        if len(header) < 60:
+            return
+        name = header[:16].decode("ascii").strip().rstrip("/")
+        size = int(header[48:58].decode("ascii").strip())
+        yield name, size
+        # members are 2-byte aligned
+        offset = offset + 60 + size + size % 2
+
+
+class _Zstd:
+    """
+    zstd decompressing reader, through the zstandard module
+    or the zstd command fed by a thread
+    """
+    def __init__(self, fileobj):
+        self._proc = None
+        try:
+            import zstandard
+            self._reader = zstandard.ZstdDecompressor().stream_reader(fileobj)
+            return
+        except ImportError:
+            pass
+        if not which("zstd"):
+            raise Exception("Decompressing zstd packages needs python zstandard or the zstd command")
+        self._proc = subprocess.Popen(["zstd", "-dcq"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._reader = self._proc.stdout
+        self._feeder = threading.Thread(target=self._feed, args=(fileobj,), daemon=True)
+        self._feeder.start()
+
+    def _feed(self, fileobj):
+        try:
+            data = fileobj.read(1024 * 1024)
+            while data:
+                self._proc.stdin.write(data)
+                data = fileobj.read(1024 * 1024)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                self._proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self, size=-1):
+        return self._reader.read(size)
+
+    def close(self):
+        if self._proc is not None:
+            # the tar stream may end before the decompressed data does
+            while self._proc.stdout.read(1024 * 1024):
+                pass
+            self._proc.stdout.close()
+            self._feeder.join()
+            if self._proc.wait() != 0:
+                raise Exception("zstd failed with exit code {}".format(self._proc.returncode))
+
+
+def _tar_reader(name, fileobj):
+    """
+    Return a reader of the tar stream of control.tar.* or data.tar.*.
+    gzip, bzip2 and xz are left to the extractor, which detects them.
+    """
+    if name.endswith(".zst"):
+        return _Zstd(fileobj)
+    if name.endswith(".lzma"):
+        return lzma.LZMAFile(fileobj, format=lzma.FORMAT_ALONE)
+    return fileobj
+
+
+def _read_control(name, fileobj):
+    """
+    Return the files of a control.tar.* member by name
+    """
+    reader = _tar_reader(name, fileobj)
+    files = {}
+    with tarfile.open(fileobj=reader, mode="r|*") as archive:
+        for member in archive:
+            if member.isreg():
+                files[os.path.basename(member.name)] = (member.mode, archive.extractfile(member).read())
+    if isinstance(reader, _Zstd):
+        reader.close()
+    return files
+
+
+def _md5(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        data = f.read(1024 * 1024)
+        while data:
+            digest.update(data)
+            data = f.read(1024 * 1024)
+    return digest.hexdigest()
+
+
+class DebianBootstrap:
+    """
+    Bootstrap a Debian or Ubuntu root without debootstrap.
+    The Release and Packages indexes are read and verified, the packages
+    of the base priorities and their dependencies resolved, the .debs
+    fetched in parallel over pooled connections into the download cache
+    and their data.tar unpacked with the streaming extractor. The dpkg
+    database is written from the control files and the maintainer
+    scripts are then run by dpkg in a chroot. Without |keyring| or gpgv
+    the Release file, and everything verified against it, can not be
+    trusted; that is refused unless |insecure| is set.
+    """
+    def __init__(self, suite, arch, mirror, cache, metadata=None, max_age=None,
+                 components=("main",), include=(), keyring=None, workers=FETCH_WORKERS, insecure=False):
+        self.suite = suite
+        self.arch = arch
+        self.mirror = mirror if mirror.endswith("/") else mirror + "/"
+        self.cache = cache
+        self.metadata = metadata
+        self.max_age = max_age
+        self.components = components
+        self.include = include
+        self.keyring = keyring
+        self.workers = workers
+        self.insecure = insecure
+        self.codename = suite
+        # package name: Packages index paragraph as a dict
+        self.packages = {}
+        # virtual package name: names of the packages providing it
+        self.providers = {}
+
+    def _release_url(self, name):
+        return "{}dists/{}/{}".format(self.mirror, self.suite, name)
+
+    def _fetch_release(self, temp_dir):
+        if self.metadata is not None:
+            if file_get_cached(self._release_url("Release"), temp_dir, self.metadata, self.max_age) != 0:
+                raise Exception("'{}': Release file is not available".format(self._release_url("Release")))
+        else:
+            with open(os.path.join(temp_dir, "Release"), "wb") as f:
+                if file_stream(self._release_url("Release"), lambda response: shutil.copyfileobj(response, f)) != 0:
+                    raise Exception("'{}': Release file is not available".format(self._release_url("Release")))
+        release = os.path.join(temp_dir, "Release")
+        self._verify_release(release, temp_dir)
+        with open(release, "r") as f:
+            return dict(parse_deb822(f.read())[0])
+
+    def _verify_release(self, release, temp_dir):
+        if not self.keyring or not os.path.exists(self.keyring) or not which("gpgv"):
+            if not self.insecure:
+                raise Exception(
+                    "Cannot check the Release signature of '{}': keyring '{}' or gpgv is missing".format(
+                        self.suite, self.keyring)
+                )
+            logger.warning("Insecure mode, using the Release of '%s' unverified", self.suite)
+            return
+        signature = os.path.join(temp_dir, "Release.gpg")
+        with open(signature, "wb") as f:
+            if file_stream(self._release_url("Release.gpg"), lambda response: shutil.copyfileobj(response, f)) != 0:
+                raise Exception("'{}': Release is not signed".format(self._release_url("Release")))
+        proc = subprocess.run(["gpgv", "--keyring", self.keyring, signature, release],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if proc.returncode != 0:
+            raise Exception("'{}': Invalid Release signature: {}".format(
+                self._release_url("Release"), proc.stdout.decode(errors="replace").strip()))
+
+    def fetch_verified(self, url, sha256, size=None):
+        """
+        Return the cached path of a file with a known digest,
+        downloading it into the download cache first when needed
+        """
+        cached = self.cache.lookup(url, sha256)
+        if cached is not None:
+            return cached
+        os.makedirs(self.cache.blob_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache.root, prefix=".fetch-")
+        digest = hashlib.sha256()
+
+        def _copy(response):
+            with os.fdopen(fd, "wb") as f:
+                data = response.read(1024 * 1024)
+                while data:
+                    digest.update(data)
+                    f.write(data)
+                    data = response.read(1024 * 1024)
+
+        try:
+            if file_stream(url, _copy) != 0:
+                raise Exception("'{}' is not available".format(url))
+            if digest.hexdigest() != sha256 or (size is not None and os.stat(temp_path).st_size != size):
+                raise Exception("'{}': Failed on SHA256 verification".format(url))
+            return self.cache.insert(temp_path, url, sha256)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def index(self):
+        """
+        Read the verified Packages indexes of the suite
+        """
+        with tempfile.TemporaryDirectory(prefix="kutu-") as temp_dir:
+            release = self._fetch_release(temp_dir)
+        self.codename = release.get("Codename", self.suite)
+        hashes = {}
+        for line in release.get("SHA256", "").splitlines():
+            parts = line.split()
+            if len(parts) == 3:
+                hashes[parts[2]] = (parts[0], int(parts[1]))
+
+        for component in self.components:
+            base = "{}/binary-{}/Packages".format(component, self.arch)
+            for extension, decompress in _index_compressions:
+                name = base + "." + extension if extension else base
+                if name in hashes:
+                    break
+            else:
+                raise Exception("'{}': {} is not listed in the Release file".format(self.suite, base))
+            sha256, size = hashes[name]
+            path = self.fetch_verified(self._release_url(name), sha256, size)
+            with open(path, "rb") as f:
+                text = decompress(f.read()).decode("utf-8", "replace")
+            for paragraph in parse_deb822(text):
+                package = dict(paragraph)
+                if "Package" not in package or package["Package"] in self.packages:
+                    continue
+                self.packages[package["Package"]] = package
+                for group in parse_relations(package.get("Provides", "")):
+                    self.providers.setdefault(group[0], []).append(package["Package"])
+        logger.info("Indexed %d packages of '%s'", len(self.packages), self.suite)
+
+    def _choose(self, names, selected):
+        """
+        Pick the package satisfying one of the alternatives |names|
+        """
+        for name in names:
+            if name in selected:
+                return name
+            for provider in self.providers.get(name, []):
+                if provider in selected:
+                    return provider
+        for name in names:
+            if name in self.packages:
+                return name
+        for name in names:
+            if self.providers.get(name):
+                return self.providers[name][0]
+        return None
+
+    def resolve(self):
+        """
+        Return the Packages paragraphs of the base system: the packages
+        of the base priorities, essential ones and |include|, with all
+        their dependencies
+        """
+        if not self.packages:
+            self.index()
+        wanted = [
+            name for name, package in sorted(self.packages.items())
+            if package.get("Priority") in BASE_PRIORITIES or package.get("Essential") == "yes"
+        ]
+        for name in self.include:
+            if self._choose([name], ()) is None:
+                raise Exception("Package '{}' not found in '{}'".format(name, self.suite))
+            wanted.append(name)
+
+        selected = {}
+        while wanted:
+            name = self._choose([wanted.pop()], selected)
+            if name is None or name in selected:
+                continue
+            package = self.packages[name]
+            selected[name] = package
+            for field in ("Pre-Depends", "Depends"):
+                for group in parse_relations(package.get(field, "")):
+                    choice = self._choose(group, selected)
+                    if choice is None:
+                        logger.warning("%s: Unable to satisfy '%s'", name, " | ".join(group))
+                    elif choice not in selected:
+                        wanted.append(choice)
+        logger.info("Resolved %d packages", len(selected))
+        return [selected[name] for name in sorted(selected)]
+
+    def _deb(self, package):
+        return self.fetch_verified(self.mirror + package["Filename"], package["SHA256"], int(package["Size"]))
+
+    def fetch(self, packages):
+        """
+        Download the .debs of |packages| in parallel, return their paths by name
+        """
+        paths = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._deb, package): package["Package"] for package in packages}
+            try:
+                for future in as_completed(futures):
+                    paths[futures[future]] = future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        logger.info("Fetched %d packages", len(paths))
+        return paths
+
+    def _info_name(self, control):
+        if control.get("Multi-Arch") == "same":
+            return "{}:{}".format(control["Package"], control["Architecture"])
+        return control["Package"]
+
+    def unpack(self, package, path, root):
+        """
+        Unpack a .deb into root and return its dpkg status paragraph
+        """
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # evicted from the download cache since it was fetched
+            f = open(self._deb(package), "rb")
+        names = []
+        control_files = None
+        with f:
+            for name, size in _ar_members(f):
+                if name.startswith("control.tar"):
+                    control_files = _read_control(name, _Region(f, size))
+                elif name.startswith("data.tar"):
+                    reader = _tar_reader(name, _Region(f, size))
+                    extract_pipelined(reader, root, names=names, keep_dir_links=True)
+                    if isinstance(reader, _Zstd):
+                        reader.close()
+        if control_files is None or "control" not in control_files:
+            raise Exception("'{}': No control file".format(path))
+
+        fields = parse_deb822(control_files["control"][1].decode("utf-8", "replace"))[0]
+        fields = [field for field in fields if field[0] not in _index_only]
+        control = dict(fields)
+        info_dir = os.path.join(root, "var/lib/dpkg/info")
+        info_name = self._info_name(control)
+        for name, (mode, data) in control_files.items():
+            if name == "control":
+                continue
+            with open(os.path.join(info_dir, "{}.{}".format(info_name, name)), "wb") as info:
+                info.write(data)
+            os.chmod(os.path.join(info_dir, "{}.{}".format(info_name, name)), mode & 0o777)
+
+        listed = []
+        seen = set()
+        for name in names:
+            name = os.path.normpath(name)
+            name = "/." if name == "." else "/" + name
+            if name not in seen:
+                seen.add(name)
+                listed.append(name)
+        with open(os.path.join(info_dir, info_name + ".list"), "w") as info:
+            info.write("".join(name + "\n" for name in listed))
+
+        status = [fields[0], ("Status", "install ok unpacked")] + fields[1:]
+        conffiles = []
+        if "conffiles" in control_files:
+            for line in control_files["conffiles"][1].decode().splitlines():
+                conffile = line.split()[-1] if line.split() else None
+                if conffile and os.path.isfile(os.path.join(root, conffile.lstrip("/"))):
+                    conffiles.append(" {} {}".format(conffile, _md5(os.path.join(root, conffile.lstrip("/")))))
+        if conffiles:
+            status.append(("Conffiles", "\n" + "\n".join(conffiles)))
+        return status
+
+    def _prepare_root(self, root):
+        if self.codename not in SPLIT_USR and self.suite not in SPLIT_USR:
+            for name in _usr_links.get(self.arch, ["bin", "sbin", "lib"]):
+                os.makedirs(os.path.join(root, "usr", name), exist_ok=True)
+                os.symlink(os.path.join("usr", name), os.path.join(root, name))
+        admin_dir = os.path.join(root, "var/lib/dpkg")
+        for name in ("info", "updates", "triggers", "alternatives"):
+            os.makedirs(os.path.join(admin_dir, name), exist_ok=True)
+        for name in ("available", "diversions", "statoverride"):
+            open(os.path.join(admin_dir, name), "a").close()
+        with open(os.path.join(admin_dir, "arch"), "w") as f:
+            f.write(self.arch + "\n")
+
+    def _configure(self, root, statuses):
+        """
+        Run preinst scripts and dpkg --configure in a chroot of root,
+        with its own /proc when util-linux unshare is available.
+        A failing preinst fails the bootstrap, like it does in dpkg.
+        """
+        dev = os.path.join(root, "dev")
+        os.makedirs(dev, exist_ok=True)
+        for name, minor in (("null", 3), ("zero", 5), ("full", 7), ("random", 8), ("urandom", 9)):
+            if not os.path.lexists(os.path.join(dev, name)):
+                os.mknod(os.path.join(dev, name), 0o20666, os.makedev(1, minor))
+                os.chmod(os.path.join(dev, name), 0o666)
+        policy = os.path.join(root, "usr/sbin/policy-rc.d")
+        os.makedirs(os.path.dirname(policy), exist_ok=True)
+        with open(policy, "w") as f:
+            # no services are started while packages are configured
+            f.write("#!/bin/sh\nexit 101\n")
+        os.chmod(policy, 0o755)
+
+        script = []
+        # base-passwd and base-files lay out what other scripts expect
+        ordered = sorted(statuses, key=lambda status: (dict(status)["Package"] not in ("base-passwd", "base-files"),
+                                                       dict(status)["Package"]))
+        for status in ordered:
+            control = dict(status)
+            preinst = "/var/lib/dpkg/info/{}.preinst".format(self._info_name(control))
+            if not os.path.exists(os.path.join(root, preinst.lstrip("/"))):
+                continue
+            script.append(
+                "DPKG_MAINTSCRIPT_NAME=preinst DPKG_MAINTSCRIPT_PACKAGE={} DPKG_MAINTSCRIPT_ARCH={} "
+                "{} install || {{ echo 'preinst of {} failed' >&2; exit 1; }}".format(
+                    shlex.quote(control["Package"]), shlex.quote(control["Architecture"]),
+                    shlex.quote(preinst), shlex.quote(control["Package"])
+                )
+            )
+        script.append("exec dpkg --configure --pending --force-configure-any")
+
+        cmd = ["chroot", root, "/bin/sh", "-c", "\n".join(script)]
+        if which("unshare"):
+            cmd = ["unshare", "--mount", "--propagation", "private", "--fork", "--pid",
+                   "--mount-proc=" + os.path.join(root, "proc")] + cmd
+            os.makedirs(os.path.join(root, "proc"), exist_ok=True)
+        env = {
+            "PATH": "/usr/sbin:/usr/bin:/sbin:/bin",
+            "LC_ALL": "C",
+            "DEBIAN_FRONTEND": "noninteractive",
+            "DEBCONF_NONINTERACTIVE_SEEN": "true",
+        }
+        try:
+            proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in proc.stdout:
+                logger.info("%s", line.decode("utf-8", "replace").rstrip())
+            if proc.wait() != 0:
+                raise Exception("Configuring packages failed with exit code {}".format(proc.returncode))
+        finally:
+            os.remove(policy)
+
+    def install(self, root, packages, paths=None):
+        """
+        Unpack |packages| into root and configure them, fetching
+        those missing from |paths|
+        """
+        paths = dict(paths or {})
+        missing = [package for package in packages if package["Package"] not in paths]
+        if missing:
+            paths.update(self.fetch(missing))
+        self._prepare_root(root)
+        statuses = []
+        for package in packages:
+            logger.debug("Unpacking '%s'", package["Package"])
+            statuses.append(self.unpack(package, paths[package["Package"]], root))
+
+        with open(os.path.join(root, "var/lib/dpkg/status"), "w") as f:
+            for status in statuses:
+                for name, value in status:
+                    # multiline values such as Conffiles start on the next line
+                    f.write("{}:{}{}\n".format(name, "" if value.startswith("\n") else " ", value))
+                f.write("\n")
+        self._configure(root, statuses)
+
+        sources = os.path.join(root, "etc/apt/sources.list")
+        os.makedirs(os.path.dirname(sources), exist_ok=True)
+        with open(sources, "w") as f:
+            f.write("deb {} {} {}\n".format(self.mirror, self.suite, " ".join(self.components)))
@@ -0,0 +1,204 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import stat
+
+logger = logging.getLogger(__name__)
+
+# the farm must share a filesystem with the layers to link into them
+FARM_ROOT = "/var/lib/kutu/farm"
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+_link_errors = (errno.EMLINK, errno.EXDEV, errno.EPERM)
+_clone_errors = (errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL, errno.ENOTTY)
+_xattr_errors = (errno.EPERM, errno.EACCES, errno.ENOSPC, errno.EDQUOT, errno.E2BIG, errno.ERANGE)
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        data = f.read(1024 * 1024)
+        while data:
+            digest.update(data)
+            data = f.read(1024 * 1024)
+    return digest.hexdigest()
+
+
+def _meta_key(content, path, st):
+    """
+    Hardlinks share their inode, so files are only linked together when
+    content, owner, mode, mtime and xattrs all match
+    """
+    key = hashlib.sha256("{}\0{:o}\0{}\0{}\0{}".format(
+        content, st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns).encode())
+    try:
+        for name in sorted(os.listxattr(path, follow_symlinks=False)):
+            key.update(b"\0" + name.encode("utf-8", "surrogateescape") + b"\0")
+            key.update(os.getxattr(path, name, follow_symlinks=False))
+    except OSError as exc:
+        if exc.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+    return key.hexdigest()
+
+
+def _replace(path, make_temp):
+    """
+    Atomically replace path with the file make_temp creates at a temporary name
+    """
+    temp_path = os.path.join(os.path.dirname(path), ".kutu-dedup-" + os.path.basename(path))
+    try:
+        os.unlink(temp_path)
+    except FileNotFoundError:
+        pass
+    try:
+        make_temp(temp_path)
+        os.rename(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _copy_xattrs(path, fd):
+    """
+    Copy every xattr of path, such as security.capability, to fd
+    """
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError as exc:
+        if exc.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+        return
+    for name in names:
+        os.setxattr(fd, name, os.getxattr(path, name, follow_symlinks=False))
+
+
+def _clone(source, temp_path, path, st):
+    """
+    Reflink source to temp_path and give it the metadata and xattrs of path
+    """
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+    try:
+        with open(source, "rb") as src:
+            fcntl.ioctl(fd, FICLONE, src.fileno())
+        os.chown(fd, st.st_uid, st.st_gid)
+        os.chmod(fd, stat.S_IMODE(st.st_mode))
+        # after chown, which drops security.capability
+        _copy_xattrs(path, fd)
+        os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+    finally:
+        os.close(fd)
+
+
+class ContentFarm:
+    """
+    Shared store of regular files used to deduplicate layers.
+    meta/<key> are hardlinks to layer files, keyed by content and metadata.
+    data/<sha256> point to one meta entry per content and serve as reflink
+    sources for files whose metadata differs.
+    """
+    def __init__(self, root=FARM_ROOT):
+        self.root = root
+        self.meta_dir = os.path.join(root, "meta")
+        self.data_dir = os.path.join(root, "data")
+        self._lock_file = None
+        self.files = 0
+        self.saved = 0
+
+    def __enter__(self):
+        os.makedirs(self.meta_dir, exist_ok=True)
+        os.makedirs(self.data_dir, exist_ok=True)
+        self._lock_file = open(os.path.join(self.root, ".lock"), "a")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._lock_file.close()
+        self._lock_file = None
+
+    def _add(self, path, content, key):
+        entry = os.path.join(self.meta_dir, key)
+        try:
+            os.link(path, entry)
+        except OSError as exc:
+            if exc.errno not in _link_errors + (errno.EEXIST,):
+                raise
+            return
+        data = os.path.join(self.data_dir, content)
+        if not os.path.lexists(data):
+            os.symlink(os.path.join("..", "meta", key), data)
+
+    def dedup_file(self, path, st):
+        content = _file_digest(path)
+        key = _meta_key(content, path, st)
+        entry = os.path.join(self.meta_dir, key)
+        try:
+            entry_st = os.stat(entry)
+        except FileNotFoundError:
+            entry_st = None
+        if entry_st is not None:
+            if entry_st.st_ino == st.st_ino and entry_st.st_dev == st.st_dev:
+                return
+            try:
+                _replace(path, lambda temp_path: os.link(entry, temp_path))
+            except OSError as exc:
+                if exc.errno not in _link_errors:
+                    raise
+                logger.debug("Unable to hardlink '%s': %s", path, exc)
+                return
+            self.files = self.files + 1
+            self.saved = self.saved + st.st_blocks * 512
+            return
+
+        source = os.path.join(self.data_dir, content)
+        if st.st_size and os.path.exists(source) and not os.path.samefile(source, path):
+            # same content, other metadata: share the extents only
+            try:
+                _replace(path, lambda temp_path: _clone(source, temp_path, path, st))
+                self.files = self.files + 1
+                self.saved = self.saved + st.st_blocks * 512
+            except OSError as exc:
+                if exc.errno not in _clone_errors + _xattr_errors:
+                    raise
+                logger.debug("Unable to reflink '%s': %s", path, exc)
+        self._add(path, content, key)
+
+    def dedup_tree(self, path):
+        """
+        Deduplicate the regular files under path against the farm
+        """
+        for root, dirs, files in os.walk(path):
+            dir_st = os.lstat(root)
+            changed = False
+            for name in files:
+                file_path = os.path.join(root, name)
+                st = os.lstat(file_path)
+                if not stat.S_ISREG(st.st_mode) or name.startswith(".kutu-dedup-"):
+                    continue
+                files_before = self.files
+                self.dedup_file(file_path, st)
+                changed = changed or self.files != files_before
+            if changed:
+                # linking and renaming touched the directory, keep its times
+                os.utime(root, ns=(dir_st.st_atime_ns, dir_st.st_mtime_ns))
+
+    def prune(self):
+        """
+        Drop farm entries no layer links to anymore
+        """
+        removed = 0
+        for name in os.listdir(self.meta_dir):
+            entry = os.path.join(self.meta_dir, name)
+            if os.lstat(entry).st_nlink == 1:
+                os.unlink(entry)
+                removed = removed + 1
+        for name in os.listdir(self.data_dir):
+            entry = os.path.join(self.data_dir, name)
+            if not os.path.exists(entry):
+                os.unlink(entry)
+        return removed
@@ -0,0 +1,159 @@
+import logging
+import os
+import re
+import stat
+import tempfile
+import time
+
+from .trash import move_to_trash, TRASH_NAME
+
+logger = logging.getLogger(__name__)
+
+# leave alone what a running bootstrap or create may still be filling
+GC_GRACE = 3600
+# interrupted downloads are kept this long to be resumed
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+
+
+def tree_size(path):
+    """
+    Disk usage of a tree, each hardlinked inode counted once
+    """
+    seen = set()
+    total = 0
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return 0
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_blocks * 512
+    total = st.st_blocks * 512
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total = total + st.st_blocks * 512
+    return total
+
+
+def _size_str(size):
+    return "{:.1f} MiB".format(size / 1024 ** 2)
+
+
+class Collector:
+    """
+    Mark-and-sweep over the state store.
+    Everything reachable from a registered image or container is marked;
+    layers, container and image directories nothing references, stale
+    staging and bootstrap temp directories and old partial downloads are
+    swept. With a target, cached downloads and then images no container
+    uses are evicted least recently used first until usage fits it.
+    """
+    def __init__(self, state, layers, cache, img_root, cont_root, download_root, dry_run=False):
+        self.state = state
+        self.layers = layers
+        self.cache = cache
+        self.img_root = img_root
+        self.cont_root = cont_root
+        self.download_root = download_root
+        self.dry_run = dry_run
+        self.now = time.time()
+        self.report = []
+        self.freed = 0
+        self.trashes = set()
+        # references to each layer, counted by sweep()
+        self.refs = {}
+
+    def _old(self, path, max_age=GC_GRACE):
+        try:
+            return self.now - os.lstat(path).st_mtime > max_age
+        except FileNotFoundError:
+            return False
+
+    def _drop(self, what, path, size=None):
+        if size is None:
+            size = tree_size(path)
+        self.report.append("{} {} ({})".format(what, path, _size_str(size)))
+        self.freed = self.freed + size
+        if self.dry_run:
+            return
+        if os.path.isdir(path) and not os.path.islink(path):
+            move_to_trash(path, reap=False)
+            self.trashes.add(os.path.join(os.path.dirname(path), TRASH_NAME))
+        else:
+            os.remove(path)
+
+    @staticmethod
+    def _entries(root):
+        try:
+            return [name for name in os.listdir(root) if name != TRASH_NAME]
+        except FileNotFoundError:
+            return []
+
+    def sweep(self):
+        """
+        Remove what nothing references
+        """
+        images = set(self.state.image_names())
+        containers = set(self.state.container_names())
+        for image in self.state.list_images():
+            for digest in image["layers"]:
+                self.refs[digest] = self.refs.get(digest, 0) + 1
+
+        for digest in self.layers.list():
+            path = self.layers.layer_dir(digest)
+            # a layer just committed is registered by its image right after
+            if digest not in self.refs and self._old(path):
+                self._drop("unused layer", path)
+        for name in self._entries(self.layers.root):
+            path = os.path.join(self.layers.root, name)
+            if name.startswith(".staging-") and self._old(path):
+                self._drop("stale layer staging", path)
+        for name in self._entries(self.cont_root):
+            path = os.path.join(self.cont_root, name)
+            if name not in containers and os.path.isdir(path) and self._old(path):
+                self._drop("orphaned container", path)
+        for name in self._entries(self.img_root):
+            path = os.path.join(self.img_root, name)
+            if name not in images and os.path.isdir(path) and self._old(path):
+                self._drop("orphaned image", path)
+        temp_root = tempfile.gettempdir()
+        for name in self._entries(temp_root):
+            path = os.path.join(temp_root, name)
+            if re.match(r"^kutu-[a-z0-9_]{8}$", name) and os.path.isdir(path) and self._old(path):
+                self._drop("bootstrap leftover", path)
+        for name in self._entries(self.download_root):
+            path = os.path.join(self.download_root, name)
+            if self._old(path, PARTIAL_MAX_AGE):
+                self._drop("stale download", path)
+
+    def evict(self, needed):
+        """
+        Free at least |needed| more bytes from caches and unused images
+        """
+        goal = self.freed + needed
+        for digest, size, _ in self.cache.entries():
+            if self.freed >= goal:
+                return
+            self.report.append("cached download {} ({})".format(digest, _size_str(size)))
+            self.freed = self.freed + size
+            if not self.dry_run:
+                self.cache.remove(digest)
+
+        for image in self.state.unused_images():
+            if self.freed >= goal:
+                return
+            if not self.dry_run and self.state.remove_image(image["name"]) is None:
+                # got a container meanwhile
+                continue
+            self._drop("unused image", os.path.join(self.img_root, image["name"]), size=0)
+            for digest in image["layers"]:
+                self.refs[digest] = self.refs[digest] - 1
+                if self.refs[digest] == 0:
+                    self._drop("layer of {}".format(image["name"]), self.layers.layer_dir(digest))
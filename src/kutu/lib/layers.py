@@ -0,0 +1,230 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+from time import strftime, localtime
+
+from .manifest import Manifest
+from .trash import move_to_trash, TRASH_NAME
+
+logger = logging.getLogger(__name__)
+
+LAYER_ROOT = "/var/lib/kutu/layers"
+
+
+def _hash_file(path, hasher):
+    with open(path, "rb") as f:
+        data = f.read(1024 * 1024)
+        while data:
+            hasher.update(data)
+            data = f.read(1024 * 1024)
+
+
+def directory_digest(path):
+    """
+    Digest of a directory tree: names, types, owners, modes, link
+    targets, device numbers, xattrs and file contents, but not times
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            full_path = os.path.join(root, name)
+            st = os.lstat(full_path)
+            entry = "{}\0{:o}\0{}\0{}".format(
+                os.path.relpath(full_path, path), st.st_mode, st.st_uid, st.st_gid
+            )
+            digest.update(entry.encode("utf-8", "surrogateescape"))
+            if stat.S_ISLNK(st.st_mode):
+                digest.update(os.fsencode(os.readlink(full_path)))
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                digest.update("{}".format(st.st_rdev).encode())
+            elif stat.S_ISREG(st.st_mode):
+                _hash_file(full_path, digest)
+            try:
+                for key in sorted(os.listxattr(full_path, follow_symlinks=False)):
+                    digest.update(key.encode("utf-8", "surrogateescape"))
+                    digest.update(os.getxattr(full_path, key, follow_symlinks=False))
+            except OSError as exc:
+                if exc.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                    raise
+            digest.update(b"\n")
+    return "sha256:" + digest.hexdigest()
+
+
+def _copy_attrs(src, dst, st):
+    """
+    Copy owner, mode, xattrs and times of |src| to |dst|, links included
+    """
+    os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        # overlayfs keeps opaque dirs and redirects in trusted.overlay.*
+        try:
+            for key in os.listxattr(src):
+                os.setxattr(dst, key, os.getxattr(src, key))
+        except OSError as exc:
+            if exc.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                raise
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def copy_upperdir(src, dst):
+    """
+    Copy an overlayfs upperdir into an empty |dst|, keeping whiteouts
+    (0/0 character devices), opaque and redirect xattrs and hardlinks
+    """
+    inodes = {}
+    directories = []
+    for root, dirs, files in os.walk(src):
+        for name in dirs + files:
+            src_path = os.path.join(root, name)
+            dst_path = os.path.join(dst, os.path.relpath(src_path, src))
+            st = os.lstat(src_path)
+            if stat.S_ISDIR(st.st_mode):
+                os.mkdir(dst_path)
+                directories.append((src_path, dst_path, st))
+                continue
+            if st.st_nlink > 1 and (st.st_dev, st.st_ino) in inodes:
+                os.link(inodes[(st.st_dev, st.st_ino)], dst_path, follow_symlinks=False)
+                continue
+            if stat.S_ISREG(st.st_mode):
+                shutil.copyfile(src_path, dst_path, follow_symlinks=False)
+            elif stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(src_path), dst_path)
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode) or stat.S_ISFIFO(st.st_mode):
+                os.mknod(dst_path, st.st_mode, st.st_rdev)
+            else:
+                logger.debug("Skipping '%s', sockets are not copied", src_path)
+                continue
+            _copy_attrs(src_path, dst_path, st)
+            if st.st_nlink > 1:
+                inodes[(st.st_dev, st.st_ino)] = dst_path
+    # directory times change while they are filled, copy them last
+    directories.append((src, dst, os.lstat(src)))
+    for src_path, dst_path, st in reversed(directories):
+        _copy_attrs(src_path, dst_path, st)
+
+
+class LayerWriter:
+    """
+    Context for a layer being built in a staging directory.
+    The layer only enters the store once commit() is called,
+    otherwise the staging directory is removed on exit.
+    """
+    def __init__(self, store):
+        self.store = store
+        self._staging = None
+        self.path = None
+        self.digest = None
+
+    def __enter__(self):
+        os.makedirs(self.store.root, exist_ok=True)
+        self._staging = tempfile.mkdtemp(dir=self.store.root, prefix=".staging-")
+        self.path = os.path.join(self._staging, "diff")
+        os.mkdir(self.path)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.digest is None:
+            shutil.rmtree(self._staging, ignore_errors=True)
+
+    def commit(self, digest=None, digests=None):
+        """
+        Move the layer into the store under |digest|, computed from its
+        content when not given, with the manifest of its files.
+        |digests| holds file hashes already computed during extraction.
+        Returns the layer digest.
+        """
+        if digest is None:
+            digest = directory_digest(self.path)
+        Manifest.from_tree(self.path, digests).save(os.path.join(self._staging, "manifest"))
+        meta = {
+            "Digest": digest,
+            "CreatedTime": strftime("%Y-%m-%d %H:%M:%S", localtime()),
+        }
+        with open(os.path.join(self._staging, "layer.json"), "w") as f:
+            json.dump(meta, f, indent=4, sort_keys=True)
+        try:
+            os.rename(self._staging, self.store.layer_dir(digest))
+        except OSError as exc:
+            if exc.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # an identical layer is already stored, use that one
+            logger.debug("Layer '%s' already exists", digest)
+            shutil.rmtree(self._staging)
+            # restart its gc grace period until the image refers to it
+            os.utime(self.store.layer_dir(digest))
+        self.digest = digest
+        self.path = self.store.path(digest)
+        return digest
+
+
+class LayerStore:
+    """
+    Read-only image layers keyed by digest.
+    <root>/<hex>/diff holds the files of a layer and <root>/<hex>/layer.json
+    its metadata. Images are ordered lists of layers stacked with overlayfs,
+    so images built on the same base share it on disk and in the page cache.
+    """
+    def __init__(self, root=LAYER_ROOT):
+        self.root = root
+
+    def layer_dir(self, digest):
+        # overlayfs separates lowerdirs with ':', keep it out of paths
+        algo, _, hexdigest = digest.partition(":")
+        if not hexdigest or algo != "sha256":
+            raise Exception("Invalid layer digest '{}'".format(digest))
+        return os.path.join(self.root, hexdigest)
+
+    def path(self, digest):
+        """
+        Return the directory holding the files of a layer
+        """
+        return os.path.join(self.layer_dir(digest), "diff")
+
+    def manifest_path(self, digest):
+        return os.path.join(self.layer_dir(digest), "manifest")
+
+    def exists(self, digest):
+        return os.path.isdir(self.path(digest))
+
+    def writer(self):
+        return LayerWriter(self)
+
+    def list(self):
+        """
+        Return the digests of all stored layers
+        """
+        ret = []
+        try:
+            for dirname in os.listdir(self.root):
+                if not dirname.startswith(".") and os.path.isdir(os.path.join(self.root, dirname)):
+                    ret.append("sha256:" + dirname)
+        except OSError:
+            pass
+        return ret
+
+    @property
+    def trash(self):
+        return os.path.join(self.root, TRASH_NAME)
+
+    def remove(self, digest, reap=True):
+        """
+        Move a layer to the trash, it is deleted in the background
+        """
+        logger.debug("Removing layer '%s'", digest)
+        move_to_trash(self.layer_dir(digest), reap)
+
+    def lowerdirs(self, layers):
+        """
+        Return overlayfs lowerdirs for layers listed base first
+        """
+        for digest in layers:
+            if not self.exists(digest):
+                raise Exception("Layer '{}' is missing".format(digest))
+        return [self.path(digest) for digest in reversed(layers)]
@@ -1,13 +1,37 @@
 import logging
 import ctypes
+import errno
 import ctypes.util
+import os
+import struct
 from pathlib import Path
 
+from .variables import (OPEN_TREE_CLOEXEC, AT_FDCWD, AT_SYMLINK_NOFOLLOW, AT_NO_AUTOMOUNT,
+                        MOVE_MOUNT_F_EMPTY_PATH)
+
 
 logger = logging.getLogger(__name__)
 
 libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
 
+# syscalls without a glibc wrapper, by machine
+_SYS_ioprio_set = {
+    "x86_64": 251,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+    "riscv64": 30,
+}
+# struct statx, stx_attributes is at offset 8 and stx_attributes_mask at 56
+_STATX_SIZE = 256
+_statx_attributes = struct.Struct("=Q")
+
+# the new mount API has the same numbers on every architecture
+_SYS_open_tree = 428
+_SYS_move_mount = 429
+
 
 def mount(source: Path, target: Path, fstype, flags, data):
     if fstype is not None:
@@ -27,20 +51,24 @@ def umount2(target: Path, flags: int):
         raise OSError(ctypes.get_errno(), "Failed to unmount directory: {}; flags={}".format(target, flags))
 
 
-def get_all_mounts():
-    with Path("/proc/self/mounts").open('rb') as f:
-        mounts = []
-        for line in f:
-            mp = line.split(b' ')[1]
-            # unicode_escape is necessary because moutns with special characters are
-            # represented with octal escape codes in 'mounts'
-            mounts.append(Path(mp.decode('unicode_escape')))
-    return mounts
-
-
-def is_mount_point(path: Path):
-    # os.path.ismount does not properly detect bind mounts
-    return path.absolute() in get_all_mounts()
+def statx_attributes(path: Path, flags=AT_SYMLINK_NOFOLLOW | AT_NO_AUTOMOUNT):
+    """
+    Return the attributes statx() reports for |path| and the mask
+    of those the filesystem supports, None without statx (glibc 2.28)
+    """
+    statx = getattr(libc, "statx", None)
+    if statx is None:
+        return None
+    buf = ctypes.create_string_buffer(_STATX_SIZE)
+    if statx(ctypes.c_int(AT_FDCWD), str(path).encode('utf-8'), ctypes.c_int(flags),
+             ctypes.c_uint(0), buf) != 0:
+        err = ctypes.get_errno()
+        if err == errno.ENOSYS:
+            return None
+        raise OSError(err, "statx failed: {}".format(path))
+    attributes, = _statx_attributes.unpack_from(buf, 8)
+    mask, = _statx_attributes.unpack_from(buf, 56)
+    return attributes, mask
 
 
 def unshare(flags):
@@ -72,3 +100,44 @@ def non_caching_getpid():
     if result < 0:
         raise OSError(abs(result), "getpid failed")
     return result
+
+
+def ioprio_set(which, who, ioprio):
+    nr = _SYS_ioprio_set.get(os.uname().machine)
+    if nr is None:
+        raise OSError(38, "ioprio_set is not known on {}".format(os.uname().machine))
+    if libc.syscall(nr, which, who, ioprio) != 0:
+        raise OSError(ctypes.get_errno(), "ioprio_set failed")
+
+
+def open_tree(path: Path, flags):
+    """
+    Return an fd of the mount at |path|, with OPEN_TREE_CLONE of
+    a detached copy of it for move_mount() (Linux 5.2)
+    """
+    fd = libc.syscall(_SYS_open_tree, ctypes.c_long(AT_FDCWD), str(path).encode('utf-8'), ctypes.c_long(flags))
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "open_tree failed: {}".format(path))
+    return fd
+
+
+def move_mount(fd, target: Path):
+    """
+    Attach the mount tree of an open_tree() fd at |target|
+    """
+    if libc.syscall(_SYS_move_mount, ctypes.c_long(fd), b"", ctypes.c_long(AT_FDCWD),
+                    str(target).encode('utf-8'), ctypes.c_long(MOVE_MOUNT_F_EMPTY_PATH)) != 0:
+        raise OSError(ctypes.get_errno(), "move_mount failed: {}".format(target))
+
+
+def has_mount_api():
+    """
+    Whether the kernel has open_tree() and move_mount()
+    """
+    try:
+        os.close(open_tree(Path("/"), OPEN_TREE_CLOEXEC))
+    except OSError as exc:
+        if exc.errno == errno.ENOSYS:
+            return False
+        raise
+    return True
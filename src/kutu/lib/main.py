@@ -64,15 +64,45 @@ def parser_opts():
     sp.add_argument("name")
     sp.set_defaults(func="start")
 
+    # inspect arguments
+    sp = subparsers.add_parser("inspect", help="Show details of a container")
+    sp.add_argument("name")
+    sp.add_argument("--timings", action="store_true",
+                    help="Show how long each phase of its starts took")
+    sp.set_defaults(func="inspect")
+
+    # commit arguments
+    sp = subparsers.add_parser("commit", help="Create a new image from a container's changes")
+    sp.add_argument("name")
+    sp.add_argument("image")
+    sp.set_defaults(func="commit")
+
+    # gc arguments
+    sp = subparsers.add_parser("gc", help="Remove unreferenced layers, directories and caches")
+    sp.add_argument("--target",
+                    help="Also evict unused images until usage fits, e.g. 20G or 80%%")
+    sp.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+    sp.set_defaults(func="gc")
+
     # bootstrap arguments
     sp = subparsers.add_parser("bootstrap",
                                help="Bootstrap a container from package servers",
                                )
-    sp.add_argument("name")
-    sp.add_argument("dist")
+    sp.add_argument("name", nargs="?")
+    sp.add_argument("dist", nargs="?")
     sp.add_argument("version", nargs="?")
+    sp.add_argument("--dedup", action="store_true",
+                    help="Share files identical to those of other images")
+    sp.add_argument("--from", dest="from_file", metavar="MANIFEST",
+                    help="Bootstrap every image listed in a JSON or YAML manifest concurrently, "
+                         "YAML needs PyYAML (pip install kutu[yaml])")
     sp.set_defaults(func="bootstrap")
 
+    # zygote arguments
+    sp = subparsers.add_parser("zygote", help="Manages the server forking container PID1s")
+    sp.add_argument("action", choices=["start", "stop", "status"])
+    sp.set_defaults(func="zygote")
+
     # image positional arguments
     sp = subparsers.add_parser("image", help="Manages Images")
     img_sub = sp.add_subparsers()
@@ -83,6 +113,19 @@ def parser_opts():
     img_rm = img_sub.add_parser("remove", aliases=["rm"], help="Remove Image")
     img_rm.add_argument("name", nargs="+")
     img_rm.set_defaults(func="img_remove")
+    # dedup positional args
+    img_dd = img_sub.add_parser("dedup", help="Share identical files between images")
+    img_dd.add_argument("name", nargs="*")
+    img_dd.set_defaults(func="img_dedup")
+    # pool positional args
+    img_pl = img_sub.add_parser("pool", help="Keep warm container sandboxes for an image in the zygote")
+    img_pl.add_argument("name")
+    img_pl.add_argument("size", type=int)
+    img_pl.set_defaults(func="img_pool")
+    # verify positional args
+    img_vf = img_sub.add_parser("verify", help="Check image files against their manifests")
+    img_vf.add_argument("name", nargs="*")
+    img_vf.set_defaults(func="img_verify")
 
     # container positional arguments
     sp = subparsers.add_parser("container", help="Manages Container")
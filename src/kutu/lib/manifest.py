@@ -0,0 +1,205 @@
+import bisect
+import hashlib
+import logging
+import os
+import stat
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_MAGIC = b"KTMF"
+MANIFEST_VERSION = 1
+VERIFY_WORKERS = os.cpu_count() or 1
+
+# magic, version, entry count
+_header = struct.Struct("<4sII")
+# path offset, path length, mode, size, mtime_ns, ino, ctime_ns, sha256
+_record = struct.Struct("<IHIQqQq32s")
+_no_digest = bytes(32)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        data = f.read(1024 * 1024)
+        while data:
+            digest.update(data)
+            data = f.read(1024 * 1024)
+    return digest.digest()
+
+
+def _entry_digest(path, st):
+    if stat.S_ISREG(st.st_mode):
+        return hash_file(path)
+    if stat.S_ISLNK(st.st_mode):
+        return hashlib.sha256(os.fsencode(os.readlink(path))).digest()
+    return _no_digest
+
+
+class ManifestEntry:
+    """
+    Expected state of one path of a layer
+    """
+    __slots__ = ("path", "mode", "size", "mtime_ns", "ino", "ctime_ns", "digest")
+
+    def __init__(self, path, mode, size, mtime_ns, ino, ctime_ns, digest):
+        self.path = path
+        self.mode = mode
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ino = ino
+        self.ctime_ns = ctime_ns
+        self.digest = digest
+
+    @classmethod
+    def from_stat(cls, path, st, digest):
+        # directory sizes depend on the filesystem, they are not recorded
+        size = st.st_size if not stat.S_ISDIR(st.st_mode) else 0
+        return cls(path, st.st_mode, size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns, digest)
+
+    def matches(self, st):
+        """
+        True when st shows the file was not touched since it was hashed.
+        ctime can not be set from userspace, so a restored mtime is caught too.
+        """
+        return (self.mode == st.st_mode and self.ino == st.st_ino
+                and self.ctime_ns == st.st_ctime_ns and self.mtime_ns == st.st_mtime_ns
+                and (stat.S_ISDIR(self.mode) or self.size == st.st_size))
+
+
+class Manifest:
+    """
+    Compact binary record of the files of a layer.
+    Fixed-size records sorted by path are followed by the path bytes,
+    so a path is found by bisecting the records.
+    """
+    def __init__(self, entries):
+        self.entries = sorted(entries, key=lambda entry: entry.path)
+        self._paths = [entry.path for entry in self.entries]
+        # set by verify() when recorded stats were refreshed
+        self.changed = False
+
+    def find(self, path):
+        """
+        Return the entry of a relative path, or None
+        """
+        path = os.fsencode(path)
+        index = bisect.bisect_left(self._paths, path)
+        if index < len(self._paths) and self._paths[index] == path:
+            return self.entries[index]
+        return None
+
+    @classmethod
+    def from_tree(cls, root, digests=None):
+        """
+        Build the manifest of the tree under root, |digests| maps relative
+        paths to the sha256 of files hashed while they were written
+        """
+        digests = digests or {}
+        entries = []
+        for dirpath, dirs, files in os.walk(root):
+            for name in dirs + files:
+                full_path = os.path.join(dirpath, name)
+                rel_path = os.path.relpath(full_path, root)
+                st = os.lstat(full_path)
+                digest = digests.get(rel_path) if stat.S_ISREG(st.st_mode) else None
+                if digest is None:
+                    digest = _entry_digest(full_path, st)
+                entries.append(ManifestEntry.from_stat(os.fsencode(rel_path), st, digest))
+        return cls(entries)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+        magic, version, count = _header.unpack_from(data)
+        if magic != MANIFEST_MAGIC or version != MANIFEST_VERSION:
+            raise Exception("'{}' is not a kutu manifest".format(filename))
+        entries = []
+        for offset in range(_header.size, _header.size + count * _record.size, _record.size):
+            (path_off, path_len, mode, size, mtime_ns,
+             ino, ctime_ns, digest) = _record.unpack_from(data, offset)
+            path = data[path_off:path_off + path_len]
+            entries.append(ManifestEntry(path, mode, size, mtime_ns, ino, ctime_ns, digest))
+        return cls(entries)
+
+    def save(self, filename):
+        records = []
+        paths = []
+        path_off = _header.size + len(self.entries) * _record.size
+        for entry in self.entries:
+            records.append(_record.pack(
+                path_off, len(entry.path), entry.mode, entry.size, entry.mtime_ns,
+                entry.ino, entry.ctime_ns, entry.digest
+            ))
+            paths.append(entry.path)
+            path_off = path_off + len(entry.path)
+        temp_path = filename + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(_header.pack(MANIFEST_MAGIC, MANIFEST_VERSION, len(self.entries)))
+            f.write(b"".join(records))
+            f.write(b"".join(paths))
+        os.replace(temp_path, filename)
+
+    def verify(self, root, executor=None):
+        """
+        Compare the tree under root with the manifest, hashing only the
+        files whose stat changed on |executor|, a process pool shared by
+        several calls, or a pool of its own. Returns a list of problems,
+        and refreshes the recorded stat of files found intact, see |changed|.
+        """
+        problems = []
+        rehash = []
+        self.changed = False
+        for entry in self.entries:
+            full_path = os.path.join(root, os.fsdecode(entry.path))
+            try:
+                st = os.lstat(full_path)
+            except FileNotFoundError:
+                problems.append("{}: missing".format(full_path))
+                continue
+            if entry.matches(st):
+                continue
+            if st.st_mode != entry.mode:
+                problems.append("{}: mode changed".format(full_path))
+            elif stat.S_ISREG(st.st_mode) and st.st_size != entry.size:
+                problems.append("{}: size changed".format(full_path))
+            elif st.st_mtime_ns != entry.mtime_ns:
+                problems.append("{}: mtime changed".format(full_path))
+            elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                rehash.append((entry, full_path, st))
+            else:
+                entry.ino, entry.ctime_ns = st.st_ino, st.st_ctime_ns
+                self.changed = True
+
+        if rehash:
+            logger.debug("Re-hashing %d files under '%s'", len(rehash), root)
+            files = [(full_path, st) for _, full_path, st in rehash]
+            if executor is None:
+                with ProcessPoolExecutor(max_workers=VERIFY_WORKERS) as own_executor:
+                    digests = list(own_executor.map(_hash_entry, files, chunksize=16))
+            else:
+                digests = executor.map(_hash_entry, files, chunksize=16)
+            for (entry, full_path, st), digest in zip(rehash, digests):
+                if digest != entry.digest:
+                    problems.append("{}: content changed".format(full_path))
+                else:
+                    # same content, e.g. relinked by dedup: trust the new stat
+                    entry.ino, entry.ctime_ns = st.st_ino, st.st_ctime_ns
+                    self.changed = True
+
+        for dirpath, dirs, files in os.walk(root):
+            for name in dirs + files:
+                rel_path = os.fsencode(os.path.relpath(os.path.join(dirpath, name), root))
+                if self.find(rel_path) is None:
+                    problems.append("{}: not in manifest".format(os.path.join(dirpath, name)))
+        return problems
+
+
+def _hash_entry(item):
+    full_path, st = item
+    try:
+        return _entry_digest(full_path, st)
+    except OSError:
+        return None
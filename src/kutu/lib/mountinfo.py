@@ -0,0 +1,197 @@
+import os
+import re
+import select
+import threading
+from collections import namedtuple
+from pathlib import Path
+
+from .libc import statx_attributes
+from .variables import STATX_ATTR_MOUNT_ROOT
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+# a line of mountinfo, see proc(5); propagation maps shared, master and
+# propagate_from to their peer group ids, unbindable to None
+MountEntry = namedtuple("MountEntry", [
+    "mount_id", "parent_id", "device", "root", "mount_point",
+    "options", "propagation", "fstype", "source", "super_options",
+])
+
+_escape = re.compile(rb"\\([0-7]{3})")
+
+
+def _unescape(field):
+    # space, tab, newline and backslash are written as octal escapes
+    return os.fsdecode(_escape.sub(lambda match: bytes([int(match.group(1), 8)]), field))
+
+
+def parse_mountinfo(data):
+    """
+    Parse the contents of a mountinfo file into entries, in table order
+    """
+    entries = []
+    for line in data.splitlines():
+        fields = line.split(b" ")
+        separator = fields.index(b"-", 6)
+        propagation = {}
+        for tag in fields[6:separator]:
+            name, _, group = tag.decode("ascii").partition(":")
+            propagation[name] = int(group) if group else None
+        major, minor = fields[2].split(b":")
+        entries.append(MountEntry(
+            mount_id=int(fields[0]),
+            parent_id=int(fields[1]),
+            device=os.makedev(int(major), int(minor)),
+            root=_unescape(fields[3]),
+            mount_point=_unescape(fields[4]),
+            options=frozenset(fields[5].decode("ascii").split(",")),
+            propagation=propagation,
+            fstype=fields[separator + 1].decode("ascii"),
+            source=_unescape(fields[separator + 2]),
+            super_options=frozenset(fields[separator + 3].decode("ascii").split(",")),
+        ))
+    return entries
+
+
+class MountInfo:
+    """
+    Index of the mount table of this process, by mount id and by
+    mount point. The table is read once and again only after the
+    kernel flagged a change on the open mountinfo file with POLLPRI.
+    """
+    def __init__(self, path=MOUNTINFO):
+        self.path = path
+        self.mounts = {}
+        # mount point -> ids mounted there, the visible one last
+        self.mount_points = {}
+        self.children = {}
+        self._fd = None
+        self._poll = None
+        # the namespace an open mountinfo keeps showing, even after unshare()
+        self._namespace = None
+        # poll() reports each change once, remembered until the table is reread
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self._fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def changed(self):
+        """
+        Whether the mount table changed since it was last read
+        """
+        if self._fd is None or self._stale:
+            return True
+        if any(events & (select.POLLPRI | select.POLLERR) for _, events in self._poll.poll(0)):
+            self._stale = True
+        return self._stale
+
+    def refresh(self, force=False):
+        """
+        Reread the table if it changed, return whether it did
+        """
+        with self._lock:
+            namespace = os.stat("/proc/self/ns/mnt").st_ino
+            if namespace != self._namespace:
+                self.close()
+                self._namespace = namespace
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+                self._poll = select.poll()
+                self._poll.register(self._fd, select.POLLPRI | select.POLLERR)
+            elif not force and not self.changed():
+                return False
+            self._stale = False
+            entries = parse_mountinfo(self._read())
+            mounts = {}
+            mount_points = {}
+            children = {}
+            for entry in entries:
+                mounts[entry.mount_id] = entry
+                mount_points.setdefault(entry.mount_point, []).append(entry.mount_id)
+                children.setdefault(entry.parent_id, []).append(entry.mount_id)
+            self.mounts = mounts
+            self.mount_points = mount_points
+            self.children = children
+        return True
+
+    def at(self, path):
+        """
+        Return the mount visible at |path|, None when it is not a mount point
+        """
+        ids = self.mount_points.get(os.fspath(Path(path).absolute()))
+        return self.mounts[ids[-1]] if ids else None
+
+    def is_mount_point(self, path):
+        return self.at(path) is not None
+
+    def parent(self, mount_id):
+        entry = self.mounts.get(mount_id)
+        if entry is None:
+            return None
+        return self.mounts.get(entry.parent_id)
+
+    def submounts(self, mount_id):
+        """
+        Return the mounts below |mount_id|, parents before their children
+        """
+        result = []
+        pending = list(self.children.get(mount_id, []))
+        while pending:
+            child = pending.pop(0)
+            if child == mount_id or child not in self.mounts:
+                continue
+            result.append(self.mounts[child])
+            pending.extend(self.children.get(child, []))
+        return result
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def mount_table():
+    """
+    Return this process's mount table index, reread only after a change
+    """
+    global _table
+    with _table_lock:
+        if _table is None:
+            _table = MountInfo()
+    _table.refresh()
+    return _table
+
+
+def is_mount_point(path: Path):
+    """
+    Whether |path| is the root of a mount, bind mounts included
+    (os.path.ismount misses them). statx() answers without reading
+    the mount table on Linux 5.8 and newer.
+    """
+    try:
+        attributes = statx_attributes(path)
+    except FileNotFoundError:
+        return False
+    if attributes is not None and attributes[1] & STATX_ATTR_MOUNT_ROOT:
+        return bool(attributes[0] & STATX_ATTR_MOUNT_ROOT)
+    return mount_table().is_mount_point(path)
+
+
+def get_all_mounts():
+    """
+    Return the mount point of every mount, in table order
+    """
+    table = mount_table()
+    return [Path(entry.mount_point) for entry in table.mounts.values()]
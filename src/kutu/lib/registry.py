@@ -0,0 +1,55 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# a directory changed this recently may change again within the same
+# mtime tick, its listing is not cached
+RACY_WINDOW = 1
+
+
+class Registry:
+    """
+    Name lookups without directory scans. Image and container names
+    are single-row queries on the state store's primary keys; the set
+    of running containers is kept and only reloaded once the mtime of
+    the pid directory changed. Like its state store, an instance
+    belongs to one thread.
+    """
+    def __init__(self, state, piddir):
+        self.state = state
+        self.piddir = piddir
+        self._running = None
+        self._pid_key = None
+
+    def images(self):
+        return self.state.image_names()
+
+    def containers(self):
+        return self.state.container_names()
+
+    def running(self):
+        try:
+            st = os.stat(self.piddir)
+        except FileNotFoundError:
+            self._pid_key = None
+            return set()
+        key = (st.st_ino, st.st_mtime_ns)
+        if key != self._pid_key or self._running is None:
+            self._running = {
+                pidname[:-len(".pid")] for pidname in os.listdir(self.piddir)
+                if pidname.endswith(".pid")
+            }
+            racy = time.time() - st.st_mtime_ns / 1e9 < RACY_WINDOW
+            self._pid_key = None if racy else key
+        return self._running
+
+    def image_exists(self, name):
+        return self.state.has_image(name)
+
+    def container_exists(self, name):
+        return self.state.has_container(name)
+
+    def is_running(self, name):
+        return name in self.running()
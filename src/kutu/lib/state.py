@@ -0,0 +1,344 @@
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from time import strftime, localtime
+
+logger = logging.getLogger(__name__)
+
+STATE_DB = "/var/lib/kutu/state.db"
+SCHEMA_VERSION = 4
+# how long a writer waits for a concurrent ktctl to commit, in ms
+BUSY_TIMEOUT = 30000
+
+_schema = """
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    base TEXT,
+    version TEXT,
+    created TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS layer_refs (
+    image TEXT NOT NULL REFERENCES images(name) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (image, position)
+);
+CREATE INDEX IF NOT EXISTS layer_refs_digest ON layer_refs(digest);
+CREATE TABLE IF NOT EXISTS containers (
+    name TEXT PRIMARY KEY,
+    image TEXT NOT NULL REFERENCES images(name),
+    entrypoint TEXT,
+    created TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS containers_image ON containers(image);
+"""
+
+# statements bringing a store of the previous version up to date
+_upgrades = {
+    2: [
+        # when an image last got a container or started one, for LRU eviction
+        "ALTER TABLE images ADD COLUMN used REAL",
+    ],
+    3: [
+        # warm PID1s the zygote keeps for the image
+        "ALTER TABLE images ADD COLUMN pool INTEGER NOT NULL DEFAULT 0",
+    ],
+    4: [
+        # phase durations of the last start, as json
+        "ALTER TABLE containers ADD COLUMN timings TEXT",
+        # how PID1 was started, its phases differ between exec, zygote and warm
+        "ALTER TABLE containers ADD COLUMN start_path TEXT",
+        # starts per start path, phase and power of two bucket of microseconds
+        "CREATE TABLE timings (path TEXT NOT NULL, phase TEXT NOT NULL, bucket INTEGER NOT NULL, "
+        "count INTEGER NOT NULL, PRIMARY KEY (path, phase, bucket))",
+    ],
+}
+
+
+def _now():
+    return strftime("%Y-%m-%d %H:%M:%S", localtime())
+
+
+class StateStore:
+    """
+    Images, their layers and containers kept in sqlite (WAL mode).
+    Every change is a short indexed transaction, so concurrent ktctl
+    runs neither block readers nor lose each other's updates.
+    On first use images.json and the container json files are imported.
+    """
+    def __init__(self, path=STATE_DB, legacy_images=None, legacy_containers=None):
+        self.path = path
+        self.legacy_images = legacy_images
+        self.legacy_containers = legacy_containers
+        self._db = None
+        # commits made through this connection, see changes()
+        self.generation = 0
+
+    @property
+    def db(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT / 1000, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA busy_timeout = {}".format(BUSY_TIMEOUT))
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.execute("PRAGMA foreign_keys = ON")
+            self._db = db
+            self._upgrade()
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Write transaction, the write lock is taken up front
+        """
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        self.generation = self.generation + 1
+
+    def changes(self):
+        """
+        A value that differs once the store was changed, by this
+        connection or by any other process
+        """
+        # data_version only moves on commits of other connections
+        return self.db.execute("PRAGMA data_version").fetchone()[0], self.generation
+
+    def _upgrade(self):
+        # the write lock is only taken when there is something to upgrade
+        if self._db.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        migrated = False
+        with self.transaction() as db:
+            # another process may have upgraded it meanwhile
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                return
+            if version < 1:
+                # executescript() would commit the open transaction
+                for statement in _schema.split(";"):
+                    if statement.strip():
+                        db.execute(statement)
+                migrated = self._migrate(db)
+                version = 1
+            for upgrade in range(version + 1, SCHEMA_VERSION + 1):
+                for statement in _upgrades[upgrade]:
+                    db.execute(statement)
+            db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        # only once committed, a failed import is tried again
+        if migrated:
+            os.rename(self.legacy_images, self.legacy_images + ".migrated")
+
+    def _migrate(self, db):
+        """
+        Import the images.json and <container>.json files of older
+        releases, return whether there were any
+        """
+        if not self.legacy_images or not os.path.exists(self.legacy_images):
+            return False
+        logger.info("Importing '%s' into '%s'", self.legacy_images, self.path)
+        with open(self.legacy_images, "r") as f:
+            images = json.load(f).get("images", [])
+        for img in images:
+            if db.execute("SELECT 1 FROM images WHERE name = ?", (img["ImageName"],)).fetchone():
+                logger.warning("Skipping duplicate image '%s'", img["ImageName"])
+            else:
+                self._insert_image(
+                    db, img["ImageName"], img.get("ImageBase"), img.get("Version"),
+                    img.get("Layers") or [], img.get("CreatedTime") or _now()
+                )
+            for cont in img.get("Containers", []):
+                cont_json = os.path.join(self.legacy_containers or "", cont, cont + ".json")
+                try:
+                    with open(cont_json, "r") as f:
+                        cont_data = json.load(f)
+                except (OSError, ValueError) as exc:
+                    logger.warning("Skipping container '%s': %s", cont, exc)
+                    continue
+                db.execute(
+                    "INSERT OR IGNORE INTO containers (name, image, entrypoint, created) VALUES (?, ?, ?, ?)",
+                    (cont, img["ImageName"], cont_data.get("Entrypoint"), cont_data.get("CreatedTime") or _now())
+                )
+        return True
+
+    @staticmethod
+    def _insert_image(db, name, base, version, layers, created):
+        db.execute(
+            "INSERT INTO images (name, base, version, created) VALUES (?, ?, ?, ?)",
+            (name, base, version, created)
+        )
+        db.executemany(
+            "INSERT INTO layer_refs (image, position, digest) VALUES (?, ?, ?)",
+            [(name, position, digest) for position, digest in enumerate(layers)]
+        )
+
+    def _image(self, row):
+        layers = self.db.execute(
+            "SELECT digest FROM layer_refs WHERE image = ? ORDER BY position", (row["name"],)
+        ).fetchall()
+        image = dict(row)
+        image["layers"] = [layer["digest"] for layer in layers]
+        return image
+
+    def add_image(self, name, base, version, layers):
+        """
+        Register an image made of |layers|, listed base first
+        """
+        try:
+            with self.transaction() as db:
+                self._insert_image(db, name, base, version, layers, _now())
+        except sqlite3.IntegrityError:
+            raise Exception("Image {} already exists".format(name))
+
+    def get_image(self, name):
+        row = self.db.execute("SELECT * FROM images WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return self._image(row)
+
+    def list_images(self):
+        rows = self.db.execute("SELECT * FROM images ORDER BY name").fetchall()
+        return [self._image(row) for row in rows]
+
+    def image_names(self):
+        return [row["name"] for row in self.db.execute("SELECT name FROM images")]
+
+    def has_image(self, name):
+        return self.db.execute("SELECT 1 FROM images WHERE name = ?", (name,)).fetchone() is not None
+
+    def remove_image(self, name):
+        """
+        Remove an image no container uses and return its layers,
+        None when it is missing or still in use
+        """
+        with self.transaction() as db:
+            image = self.get_image(name)
+            if image is None:
+                return None
+            if db.execute("SELECT 1 FROM containers WHERE image = ? LIMIT 1", (name,)).fetchone():
+                return None
+            db.execute("DELETE FROM images WHERE name = ?", (name,))
+        return image["layers"]
+
+    def layers_in_use(self):
+        rows = self.db.execute("SELECT DISTINCT digest FROM layer_refs").fetchall()
+        return {row["digest"] for row in rows}
+
+    def image_containers(self, name):
+        rows = self.db.execute("SELECT name FROM containers WHERE image = ? ORDER BY name", (name,)).fetchall()
+        return [row["name"] for row in rows]
+
+    def add_container(self, name, image, entrypoint):
+        try:
+            with self.transaction() as db:
+                db.execute(
+                    "INSERT INTO containers (name, image, entrypoint, created) VALUES (?, ?, ?, ?)",
+                    (name, image, entrypoint, _now())
+                )
+                db.execute("UPDATE images SET used = ? WHERE name = ?", (time.time(), image))
+        except sqlite3.IntegrityError:
+            raise Exception("Container {} already exists or image {} does not exist".format(name, image))
+
+    def touch_image(self, name):
+        """
+        Record that the image was just used
+        """
+        with self.transaction() as db:
+            db.execute("UPDATE images SET used = ? WHERE name = ?", (time.time(), name))
+
+    def set_pool(self, name, size):
+        """
+        Set how many warm PID1s the zygote keeps for an image,
+        False when it does not exist
+        """
+        with self.transaction() as db:
+            cursor = db.execute("UPDATE images SET pool = ? WHERE name = ?", (size, name))
+        return cursor.rowcount > 0
+
+    def pools(self):
+        """
+        Return the pool size of every image having one
+        """
+        rows = self.db.execute("SELECT name, pool FROM images WHERE pool > 0").fetchall()
+        return {row["name"]: row["pool"] for row in rows}
+
+    def unused_images(self):
+        """
+        Return images no container uses, least recently used first
+        """
+        rows = self.db.execute(
+            "SELECT * FROM images WHERE NOT EXISTS "
+            "(SELECT 1 FROM containers WHERE containers.image = images.name) "
+            "ORDER BY COALESCE(used, 0), created"
+        ).fetchall()
+        return [self._image(row) for row in rows]
+
+    def container_names(self):
+        return [row["name"] for row in self.db.execute("SELECT name FROM containers")]
+
+    def has_container(self, name):
+        return self.db.execute("SELECT 1 FROM containers WHERE name = ?", (name,)).fetchone() is not None
+
+    def get_container(self, name):
+        row = self.db.execute("SELECT * FROM containers WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def record_timings(self, name, path, timings):
+        """
+        Keep the phase durations of a start, in nanoseconds, as the
+        container's last ones and count them into the histograms of
+        its start path
+        """
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE containers SET timings = ?, start_path = ? WHERE name = ?",
+                (json.dumps(timings), path, name)
+            )
+            for phase, duration in timings.items():
+                # bucket n holds durations below 2**n microseconds
+                bucket = (duration // 1000).bit_length()
+                db.execute(
+                    "INSERT OR IGNORE INTO timings (path, phase, bucket, count) VALUES (?, ?, ?, 0)",
+                    (path, phase, bucket)
+                )
+                db.execute(
+                    "UPDATE timings SET count = count + 1 WHERE path = ? AND phase = ? AND bucket = ?",
+                    (path, phase, bucket)
+                )
+
+    def last_timings(self, name):
+        """
+        Return the start path and phase durations of the last start
+        """
+        row = self.db.execute("SELECT start_path, timings FROM containers WHERE name = ?", (name,)).fetchone()
+        if row is None or row["timings"] is None:
+            return None, {}
+        return row["start_path"], json.loads(row["timings"])
+
+    def timing_histograms(self):
+        """
+        Return the count of starts in each bucket, by start path and phase
+        """
+        histograms = {}
+        for row in self.db.execute("SELECT path, phase, bucket, count FROM timings ORDER BY path, phase, bucket"):
+            histograms.setdefault(row["path"], {}).setdefault(row["phase"], {})[row["bucket"]] = row["count"]
+        return histograms
+
+    def remove_container(self, name):
+        with self.transaction() as db:
+            db.execute("DELETE FROM containers WHERE name = ?", (name,))
@@ -0,0 +1,127 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .libc import ioprio_set
+from .variables import IOPRIO_WHO_PROCESS, IOPRIO_CLASS_IDLE, IOPRIO_CLASS_SHIFT
+
+logger = logging.getLogger(__name__)
+
+TRASH_NAME = ".trash"
+# the reaper runs from the same kutu package as its parent
+_package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# trees removed at the same time by the reaper
+REAP_WORKERS = 2
+
+
+def trash_dir(path):
+    """
+    Return the trash directory for path, next to it so that moving
+    into it is a rename on the same filesystem
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(path)), TRASH_NAME)
+
+
+def move_to_trash(path, reap=True):
+    """
+    Atomically move path out of the way and have it deleted in the background.
+    Falls back to deleting it in place when it can not be renamed.
+    """
+    trash = trash_dir(path)
+    os.makedirs(trash, exist_ok=True)
+    target = os.path.join(trash, "{}.{}".format(os.path.basename(path), uuid.uuid4().hex))
+    try:
+        os.rename(path, target)
+    except FileNotFoundError:
+        return
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EBUSY):
+            raise
+        logger.debug("Unable to move '%s' to the trash: %s", path, exc)
+        shutil.rmtree(path)
+        return
+    logger.debug("Moved '%s' to '%s'", path, target)
+    if reap:
+        spawn_reaper([trash])
+
+
+def has_trash(trash):
+    try:
+        return any(not name.startswith(".") for name in os.listdir(trash))
+    except FileNotFoundError:
+        return False
+
+
+def spawn_reaper(trashes):
+    """
+    Start a detached reaper for the trash directories that hold anything
+    """
+    trashes = [trash for trash in trashes if has_trash(trash)]
+    if not trashes:
+        return
+    subprocess.Popen(
+        [sys.executable, "-m", "kutu.lib.trash"] + trashes,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True, close_fds=True, cwd="/",
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join([_package_root] + sys.path)),
+    )
+
+
+def _remove(path):
+    def _onerror(func, failed_path, exc_info):
+        logger.warning("Unable to remove '%s': %s", failed_path, exc_info[1])
+    logger.debug("Reaping '%s'", path)
+    shutil.rmtree(path, onerror=_onerror)
+    return not os.path.lexists(path)
+
+
+def reap(trash, workers=REAP_WORKERS):
+    """
+    Empty a trash directory. Only one reaper works on a trash at a time;
+    entries that arrive while it finishes are picked up before it exits.
+    Returns the number of entries removed.
+    """
+    removed = 0
+    failed = set()
+    while True:
+        with open(os.path.join(trash, ".lock"), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # the running reaper rechecks the trash after unlocking
+                return removed
+            while True:
+                entries = [
+                    os.path.join(trash, name) for name in os.listdir(trash)
+                    if not name.startswith(".") and name not in failed
+                ]
+                if not entries:
+                    break
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for path, done in zip(entries, executor.map(_remove, entries)):
+                        if done:
+                            removed = removed + 1
+                        else:
+                            failed.add(os.path.basename(path))
+        if not any(name not in failed for name in os.listdir(trash) if not name.startswith(".")):
+            return removed
+
+
+def _lower_priority():
+    os.nice(19)
+    try:
+        ioprio_set(IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+    except OSError as exc:
+        logger.debug("Unable to set the idle I/O class: %s", exc)
+
+
+if __name__ == "__main__":
+    _lower_priority()
+    for trash_path in sys.argv[1:]:
+        reap(trash_path)
@@ -29,6 +29,19 @@ CLONE_NEWCGROUP = 0x02000000
 
 MNT_DETACH = 2
 
+OPEN_TREE_CLONE = 1
+OPEN_TREE_CLOEXEC = 0o2000000
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+AT_NO_AUTOMOUNT = 0x800
+AT_RECURSIVE = 0x8000
+STATX_ATTR_MOUNT_ROOT = 0x00002000
+MOVE_MOUNT_F_EMPTY_PATH = 0x00000004
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
 Mount = namedtuple('Mount', ['destination', 'type', 'source', 'flags', 'options'])
 DeviceNode = namedtuple('DeviceNode', ['name', 'major', 'minor'])
 BindMount = namedtuple('BindMount', ['source', 'destination', 'readonly'])
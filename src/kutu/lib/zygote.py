@@ -0,0 +1,530 @@
+import array
+import functools
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import sqlite3
+import struct
+import sys
+import time
+import traceback
+from pathlib import Path
+
+# what every container PID1 needs, imported once by the zygote
+from . import create
+from .libc import unshare, setns, mount, has_mount_api
+from .mount import PathEncoder
+from .variables import CLONE_NEWPID, CLONE_NEWNS, MS_REC, MS_SLAVE
+from ..utils.genhostname import gen_hostname
+
+logger = logging.getLogger(__name__)
+
+ZYGOTE_DIR = "/var/run/kutu/zygote"
+ZYGOTE_SOCKET = os.path.join(ZYGOTE_DIR, "zygote.sock")
+ZYGOTE_PIDFILE = os.path.join(ZYGOTE_DIR, "zygote.pid")
+# warm PID1s set up their default mounts here, in their own mount namespace
+SANDBOX_DIR = os.path.join(ZYGOTE_DIR, "sandbox")
+# the /sys PID1s clone, only mounted in the zygote's mount namespace
+TEMPLATE_DIR = os.path.join(ZYGOTE_DIR, "template")
+# control pipe read and write ends, stdin, stdout and stderr
+REQUEST_FDS = 5
+MAX_MESSAGE = 64 * 1024
+# memory all warm PID1s together may use
+POOL_MAX_MEMORY = 256 * 1024 ** 2
+# pool sizes are reread from the state store this often, in seconds
+POOL_REFRESH = 5
+# a pool whose PID1s keep failing to prepare is refilled at most this often
+POOL_RETRY_MAX = 300
+
+_ucred = struct.Struct("3i")
+
+
+def _send(sock, data, fds=()):
+    message = [json.dumps(data, cls=PathEncoder).encode("utf-8")]
+    if fds:
+        sock.sendmsg(message, [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    else:
+        sock.sendmsg(message)
+
+
+def _recv(sock, maxfds=0):
+    """
+    Return the next message and the fds passed with it, None at EOF
+    """
+    fds = array.array("i")
+    data, ancdata, _, _ = sock.recvmsg(MAX_MESSAGE, socket.CMSG_SPACE(maxfds * fds.itemsize) if maxfds else 0)
+    for level, kind, cmsg in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg[:len(cmsg) - len(cmsg) % fds.itemsize])
+    if not data:
+        for fd in fds:
+            os.close(fd)
+        return None, []
+    return json.loads(data.decode("utf-8")), list(fds)
+
+
+def _stdio(fds):
+    """
+    Take over the stdio passed with a request, return the control pipe ends
+    """
+    control_read, control_write, stdin, stdout, stderr = fds
+    os.dup2(stdin, 0)
+    os.dup2(stdout, 1)
+    os.dup2(stderr, 2)
+    for fd in (stdin, stdout, stderr):
+        if fd > 2:
+            os.close(fd)
+    return control_read, control_write
+
+
+def _memory(pid):
+    """
+    Proportional set size of a process, its resident size
+    on kernels without smaps_rollup
+    """
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid), "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        with open("/proc/{}/statm".format(pid), "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class _Warm:
+    """
+    A prepared PID1 waiting in a pool to be claimed
+    """
+    def __init__(self, image, pid, sock):
+        self.image = image
+        self.pid = pid
+        self.sock = sock
+        self.ready = False
+
+
+def available(path=ZYGOTE_SOCKET):
+    """
+    Whether a zygote accepts connections on |path|; the socket
+    a killed zygote left behind refuses them
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET | socket.SOCK_CLOEXEC)
+    try:
+        sock.connect(path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def spawn(params, control_read, control_write, path=ZYGOTE_SOCKET):
+    """
+    Ask the zygote for a container PID1 with |params| and the control
+    pipe ends. Returns the pid, whether it was claimed from a pool and
+    the connection its exit status arrives on, see wait().
+    Raises OSError when the zygote is not running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET | socket.SOCK_CLOEXEC)
+    try:
+        sock.connect(path)
+        _send(sock, params, [control_read, control_write,
+                             sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()])
+        reply, _ = _recv(sock)
+    except BaseException:
+        sock.close()
+        raise
+    if reply is None or "pid" not in reply:
+        sock.close()
+        raise RuntimeError("Zygote failed to start PID1: {}".format((reply or {}).get("error", "no reply")))
+    return reply["pid"], reply.get("warm", False), sock
+
+
+def kill(sock, signum=signal.SIGKILL):
+    """
+    Have the zygote signal a PID1 started with spawn(). Unlike kill(2)
+    from here this cannot hit another process reusing the pid, the
+    zygote only signals PID1 while it has not reaped it.
+    """
+    _send(sock, {"kill": signum})
+
+
+def wait(sock):
+    """
+    Return the wait status of a PID1 started with spawn(),
+    None when the zygote went away first
+    """
+    try:
+        reply, _ = _recv(sock)
+    finally:
+        sock.close()
+    return reply.get("status") if reply else None
+
+
+class ZygoteServer:
+    """
+    Long-lived process forking container PID1s.
+    The PID1 code is imported and the codecs it needs are loaded once,
+    so a start costs a fork instead of an interpreter boot. Requests
+    arrive on a root-only unix socket with the control pipe and the
+    stdio of the caller as SCM_RIGHTS; the caller gets the pid back
+    and, on the same connection, the wait status once PID1 exits.
+    Until then the caller may ask for PID1 to be signalled there.
+    For images with a pool size in |state| PID1s are forked ahead and
+    prepared up to attaching a root; a start of such an image claims
+    one. Pools are refilled after each claim while their memory stays
+    below |max_memory|.
+    A pool whose PID1s exit before they are ready is refilled less and
+    less often, until its size is changed.
+    """
+    def __init__(self, path=ZYGOTE_SOCKET, state=None, max_memory=POOL_MAX_MEMORY):
+        self.path = path
+        self.state = state
+        self.max_memory = max_memory
+        self.selector = selectors.DefaultSelector()
+        self.children = {}
+        self.running = True
+        # image -> warm PID1s, and the configured size of each pool
+        self.pools = {}
+        self.pool_sizes = {}
+        # image -> consecutive warm PID1s that failed, and when to try again
+        self.failures = {}
+        self.retry_at = {}
+        self._pool_version = None
+        self._capped = False
+        self.template = None
+        self._listener = None
+        self._wakeup = None
+        self._pidns = None
+
+    def _listen(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET | socket.SOCK_CLOEXEC)
+        old_umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(64)
+        return listener
+
+    def _build_template(self):
+        """
+        Build the mount template in a mount namespace of our own,
+        PID1s fall back to mounting everything on kernels before 5.2
+        """
+        if not has_mount_api():
+            logger.info("Kernel lacks open_tree(), PID1s mount /sys themselves")
+            return
+        unshare(CLONE_NEWNS)
+        mount(Path("none"), Path("/"), None, MS_REC | MS_SLAVE, None)
+        os.makedirs(TEMPLATE_DIR, mode=0o700, exist_ok=True)
+        create.build_template(TEMPLATE_DIR)
+        self.template = TEMPLATE_DIR
+
+    def _stop(self, signum, frame):
+        self.running = False
+
+    def serve(self):
+        # codecs are loaded dynamically and won't work once PID1 remounts root
+        b"a".decode("unicode_escape")
+        self._pidns = os.open("/proc/self/ns/pid", os.O_RDONLY | os.O_CLOEXEC)
+        self._listener = self._listen()
+        wakeup_read, self._wakeup = socket.socketpair()
+        wakeup_read.setblocking(False)
+        self._wakeup.setblocking(False)
+        signal.set_wakeup_fd(self._wakeup.fileno())
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self.selector.register(self._listener, selectors.EVENT_READ, self._accept)
+        self.selector.register(wakeup_read, selectors.EVENT_READ, self._reap)
+        os.makedirs(SANDBOX_DIR, mode=0o700, exist_ok=True)
+        self._build_template()
+        logger.info("Zygote listening on '%s'", self.path)
+        try:
+            while self.running:
+                self._refill()
+                for key, _ in self.selector.select(POOL_REFRESH):
+                    key.data(key.fileobj)
+        finally:
+            signal.set_wakeup_fd(-1)
+            for pool in self.pools.values():
+                for warm in pool:
+                    # the warm PID1 exits at EOF
+                    warm.sock.close()
+            self.selector.close()
+            self._listener.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        return 0
+
+    def _accept(self, listener):
+        conn, _ = listener.accept()
+        pid, uid, gid = _ucred.unpack(conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _ucred.size))
+        if uid != 0:
+            logger.warning("Refusing zygote request of uid %d", uid)
+            conn.close()
+            return
+        self.selector.register(conn, selectors.EVENT_READ, self._request)
+
+    def _request(self, conn):
+        self.selector.unregister(conn)
+        try:
+            params, fds = _recv(conn, REQUEST_FDS)
+        except (OSError, ValueError) as exc:
+            logger.warning("Bad zygote request: %s", exc)
+            conn.close()
+            return
+        if params is None:
+            conn.close()
+            return
+        try:
+            if len(fds) != REQUEST_FDS:
+                raise ValueError("expected {} fds, got {}".format(REQUEST_FDS, len(fds)))
+            pid = self._claim(params, fds)
+            warm = pid is not None
+            if not warm:
+                pid = self._fork(self._cold, params, fds)
+        except Exception as exc:
+            logger.error("Unable to start PID1: %s", exc)
+            _send(conn, {"error": str(exc)})
+            conn.close()
+            return
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self.children[pid] = conn
+        _send(conn, {"pid": pid, "warm": warm})
+        # kill requests, or EOF when the caller goes away
+        self.selector.register(conn, selectors.EVENT_READ, self._control)
+
+    def _control(self, conn):
+        try:
+            message, _ = _recv(conn)
+        except (OSError, ValueError):
+            message = None
+        pids = [pid for pid, child_conn in self.children.items() if child_conn is conn]
+        if message is not None:
+            # not reaped yet, so the pid cannot belong to anything else
+            for pid in pids:
+                try:
+                    os.kill(pid, message.get("kill", signal.SIGKILL))
+                except ProcessLookupError:
+                    pass
+            return
+        for pid in pids:
+            self.children[pid] = None
+        self.selector.unregister(conn)
+        conn.close()
+
+    def _claim(self, params, fds):
+        """
+        Hand the request to a ready PID1 of the image's pool,
+        None when there is none
+        """
+        pool = self.pools.get(params.get("image"))
+        # warm PID1s share the host network namespace
+        if not pool or params.get("isolate_networking"):
+            return None
+        claim = {key: params.get(key) for key in ("loglevel", "root_dir", "bind_mounts", "overlay")}
+        for warm in [warm for warm in pool if warm.ready]:
+            self._discard(warm)
+            try:
+                _send(warm.sock, claim, fds)
+            except OSError:
+                # died meanwhile, _reap() collects it
+                continue
+            finally:
+                warm.sock.close()
+            logger.debug("PID1 %d claimed from the %s pool", warm.pid, params.get("image"))
+            return warm.pid
+        return None
+
+    def _discard(self, warm):
+        for pool in self.pools.values():
+            if warm in pool:
+                pool.remove(warm)
+        self.selector.unregister(warm.sock)
+
+    def _warm_message(self, warm, sock):
+        try:
+            message, _ = _recv(sock)
+        except OSError:
+            message = None
+        if message is None:
+            # exited before it was claimed
+            self._discard(warm)
+            sock.close()
+            if not warm.ready:
+                self._failed(warm.image)
+            return
+        warm.ready = True
+        self.failures.pop(warm.image, None)
+        self.retry_at.pop(warm.image, None)
+
+    def _failed(self, image):
+        """
+        Back off refilling |image|'s pool, its PID1s fail to prepare
+        """
+        failures = self.failures.get(image, 0) + 1
+        self.failures[image] = failures
+        delay = min(POOL_REFRESH * 2 ** (failures - 1), POOL_RETRY_MAX)
+        self.retry_at[image] = time.monotonic() + delay
+        if failures == 1:
+            logger.error("Warm PID1 of %s failed, retrying its pool with backoff", image)
+        else:
+            logger.debug("Warm PID1 of %s failed %d times, next try in %d s", image, failures, delay)
+
+    def _load_pools(self):
+        if self.state is None:
+            return
+        try:
+            version = self.state.changes()
+            if version != self._pool_version:
+                pool_sizes = self.state.pools()
+                # a resized pool gets a fresh start
+                for image in list(self.failures):
+                    if pool_sizes.get(image) != self.pool_sizes.get(image):
+                        self.failures.pop(image)
+                        self.retry_at.pop(image, None)
+                self.pool_sizes = pool_sizes
+                self._pool_version = version
+        except sqlite3.Error as exc:
+            logger.warning("Unable to read pool sizes: %s", exc)
+
+    def _memory_left(self):
+        warm = [warm.pid for pool in self.pools.values() for warm in pool]
+        used = sum(_memory(pid) for pid in warm)
+        # the next one will likely take what the others take on average
+        needed = used // len(warm) if warm else _memory(os.getpid())
+        if used + needed <= self.max_memory:
+            self._capped = False
+            return True
+        if not self._capped:
+            logger.warning("Warm PID1s use %d bytes, not refilling pools beyond it", used)
+            self._capped = True
+        return False
+
+    def _refill(self):
+        """
+        Fork warm PID1s until every pool is full or the memory cap is reached
+        """
+        self._load_pools()
+        for image, pool in self.pools.items():
+            for warm in pool[self.pool_sizes.get(image, 0):]:
+                self._discard(warm)
+                warm.sock.close()
+        for image, size in self.pool_sizes.items():
+            pool = self.pools.setdefault(image, [])
+            if time.monotonic() < self.retry_at.get(image, 0):
+                continue
+            if image in self.failures and not all(warm.ready for warm in pool):
+                # the last try is still preparing
+                continue
+            while len(pool) < size:
+                if not self._memory_left():
+                    return
+                parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                try:
+                    pid = self._fork(self._warm, child, parent)
+                except OSError as exc:
+                    logger.error("Unable to fork a warm PID1: %s", exc)
+                    parent.close()
+                    return
+                finally:
+                    child.close()
+                warm = _Warm(image, pid, parent)
+                pool.append(warm)
+                self.selector.register(parent, selectors.EVENT_READ, functools.partial(self._warm_message, warm))
+                if image in self.failures:
+                    # one at a time until one gets ready again
+                    break
+
+    def _fork(self, target, *args):
+        # like ContainerPID1Manager.start(): only the children enter the new pid namespace
+        unshare(CLONE_NEWPID)
+        try:
+            pid = os.fork()
+            if not pid:
+                self._child(target, *args)
+        finally:
+            setns(self._pidns, CLONE_NEWPID)
+        return pid
+
+    def _child(self, target, *args):
+        """
+        Become PID1 of a container running |target|, never returns
+        """
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self._wakeup.close()
+            os.close(self._pidns)
+            # the exec'd PID1 drew a fresh hostname on import
+            create.HOSTNAME = gen_hostname(8)
+            code = target(*args)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(code or 0)
+
+    def _cold(self, params, fds):
+        control_read, control_write = _stdio(fds)
+        create.logger.setLevel(params.pop("loglevel"))
+        params.pop("image", None)
+        return create.PID1(control_read=control_read, control_write=control_write, template=self.template,
+                           **params).run()
+
+    def _warm(self, sock, parent):
+        parent.close()
+        pid1 = create.PID1(None, None, None, False, [], template=self.template)
+        pid1.prepare(SANDBOX_DIR)
+        _send(sock, {"ready": True})
+        claim, fds = _recv(sock, REQUEST_FDS)
+        sock.close()
+        if claim is None:
+            # dropped from its pool
+            return 0
+        control_read, control_write = _stdio(fds)
+        create.logger.setLevel(claim["loglevel"])
+        return pid1.attach(claim["root_dir"], control_read, control_write, claim["bind_mounts"], claim["overlay"])
+
+    def _reap(self, wakeup_read):
+        try:
+            while wakeup_read.recv(512):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            conn = self.children.pop(pid, None)
+            if conn is not None:
+                try:
+                    _send(conn, {"status": status})
+                except OSError:
+                    pass
+                self.selector.unregister(conn)
+                conn.close()
@@ -1,23 +1,43 @@
+import logging
+import sqlite3
+
 from ..lib.daemon import Daemon
-from ..lib.mount import OverlayfsMountContext
 from ..lib.contrun import ContainerContext
+from ..lib.state import StateStore
+
+logger = logging.getLogger(__name__)
 
 
 conenv = {"PATH": "/bin:/usr/bin:/sbin:/usr/sbin:/opt/bin:/usr/local/bin:/usr/local/sbin"}
 
 
 class ContainerStart(Daemon):
-    def __init__(self, rootdir, imgdir, pidfile, cmd=''):
+    def __init__(self, rootdir, imgdirs, pidfile, cmd='', image=None, name=None):
         self.rootdir = rootdir
-        self.imgdir = imgdir
+        # overlayfs lowerdirs, top layer first
+        self.imgdirs = imgdirs
         self.cmd = cmd
+        self.image = image
+        self.name = name
         super().__init__(pidfile)
 
+    def record_timings(self, path, timings):
+        # the daemon may not use the connection its parent opened before forking
+        state = StateStore()
+        try:
+            state.record_timings(self.name, path, timings)
+        except sqlite3.Error as exc:
+            logger.warning("Unable to record start timings of %s: %s", self.name, exc)
+        finally:
+            state.close()
+
     def run(self):
-        with OverlayfsMountContext([self.imgdir], self.rootdir + "/upperdir",
-                                   self.rootdir + "/workdir", self.rootdir + "/merged"):
-            with ContainerContext(self.rootdir + "/merged") as container:
-                container.run(self.cmd, env=conenv)
+        # PID1 mounts the overlay, a warm one from the zygote pool has everything else ready
+        overlay = (self.imgdirs, self.rootdir + "/upperdir", self.rootdir + "/workdir")
+        with ContainerContext(self.rootdir + "/merged", image=self.image, overlay=overlay) as container:
+            if self.name is not None:
+                self.record_timings(container.pid1.start_path, container.pid1.timings)
+            container.run(self.cmd, env=conenv)
 
 
 class ContainerStop(Daemon):
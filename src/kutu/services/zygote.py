@@ -0,0 +1,39 @@
+import os
+
+from ..lib.daemon import Daemon
+from ..lib.state import StateStore
+from ..lib.zygote import ZygoteServer, available, ZYGOTE_DIR, ZYGOTE_PIDFILE, ZYGOTE_SOCKET, POOL_MAX_MEMORY
+
+
+class Zygote(Daemon):
+    def __init__(self, pidfile=ZYGOTE_PIDFILE, path=ZYGOTE_SOCKET, max_memory=POOL_MAX_MEMORY):
+        self.path = path
+        self.max_memory = max_memory
+        os.makedirs(ZYGOTE_DIR, mode=0o700, exist_ok=True)
+        super().__init__(pidfile)
+
+    def _clear_stale(self):
+        """
+        Remove the socket and pidfile a killed zygote left behind,
+        return whether it was not running
+        """
+        if available(self.path):
+            return False
+        for path in (self.pidfile, self.path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def start(self):
+        self._clear_stale()
+        super().start()
+
+    def stop(self):
+        # the pid of a stale pidfile may belong to another process by now
+        if not self._clear_stale():
+            super().stop()
+
+    def run(self):
+        ZygoteServer(self.path, StateStore(), self.max_memory).serve()
@@ -0,0 +1,243 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_ROOT = "/var/lib/kutu/cache"
+# default size budget of the download cache
+CACHE_MAX_SIZE = 2 * 1024 ** 3
+
+_size_units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    """
+    Convert sizes like 512M or 2G to bytes
+    """
+    match = re.match(r"^\s*(\d+)\s*([KMGT]?)i?B?\s*$", str(value), re.IGNORECASE)
+    if not match:
+        raise Exception("Invalid size '{}'".format(value))
+    return int(match.group(1)) * _size_units[match.group(2).upper()]
+
+
+class DownloadCache:
+    """
+    Content-addressed cache of verified downloads.
+    blobs/<sha256> hold the data and index.json maps each url to its
+    digest and records when every blob was last used, for LRU eviction.
+    One instance may be shared by threads.
+    """
+    def __init__(self, root=CACHE_ROOT, max_size=CACHE_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.blob_dir = os.path.join(root, "blobs")
+        self.index_path = os.path.join(root, "index.json")
+        self._lock_path = os.path.join(root, ".lock")
+        self._lock_file = None
+        # flock() only excludes other open files, not threads sharing this one
+        self._mutex = threading.Lock()
+
+    def __enter__(self):
+        self._mutex.acquire()
+        try:
+            os.makedirs(self.blob_dir, exist_ok=True)
+            self._lock_file = open(self._lock_path, "a")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        except BaseException:
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            self._mutex.release()
+            raise
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._lock_file.close()
+        self._lock_file = None
+        self._mutex.release()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"urls": {}, "blobs": {}}
+        except ValueError:
+            logger.warning("Download cache index is corrupt, starting over")
+            return {"urls": {}, "blobs": {}}
+
+    def _write_index(self, index):
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temp_path, self.index_path)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def lookup(self, url, digest=None):
+        """
+        Return the cached file of url, or None.
+        With a digest only a blob with that digest is returned.
+        """
+        with self:
+            index = self._read_index()
+            if digest is None:
+                digest = index["urls"].get(url)
+            entry = index["blobs"].get(digest)
+            if entry is None:
+                return None
+            path = self.blob_path(digest)
+            try:
+                if os.stat(path).st_size != entry["size"]:
+                    raise FileNotFoundError(errno.ENOENT, "size mismatch", path)
+            except FileNotFoundError:
+                del index["blobs"][digest]
+                self._write_index(index)
+                return None
+            entry["used"] = time.time()
+            index["urls"][url] = digest
+            self._write_index(index)
+            return path
+
+    def insert(self, path, url, digest, move=True):
+        """
+        Add a verified file to the cache and return its cached path.
+        The file is renamed into place, or copied and then renamed when
+        it lives on another filesystem or |move| is false.
+        """
+        with self:
+            blob = self.blob_path(digest)
+            if move:
+                try:
+                    os.rename(path, blob)
+                    move = False
+                except OSError as exc:
+                    if exc.errno != errno.EXDEV:
+                        raise
+            if move or not os.path.exists(blob):
+                fd, temp_path = tempfile.mkstemp(dir=self.blob_dir, prefix=".insert-")
+                try:
+                    with os.fdopen(fd, "wb") as dst, open(path, "rb") as src:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                    os.rename(temp_path, blob)
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+                if move:
+                    os.remove(path)
+
+            index = self._read_index()
+            index["urls"][url] = digest
+            index["blobs"][digest] = {"size": os.stat(blob).st_size, "used": time.time()}
+            self._evict(index, keep=digest)
+            self._write_index(index)
+            return blob
+
+    def _evict(self, index, keep=None):
+        total = sum(entry["size"] for entry in index["blobs"].values())
+        for digest, entry in sorted(index["blobs"].items(), key=lambda item: item[1]["used"]):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            logger.debug("Evicting '%s' from the download cache", digest)
+            try:
+                os.remove(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+            del index["blobs"][digest]
+            total = total - entry["size"]
+        index["urls"] = {
+            url: digest for url, digest in index["urls"].items() if digest in index["blobs"]
+        }
+
+    def entries(self):
+        """
+        Return (digest, size, last use) of every blob, least recently used first
+        """
+        with self:
+            index = self._read_index()
+        return sorted(
+            ((digest, entry["size"], entry["used"]) for digest, entry in index["blobs"].items()),
+            key=lambda item: item[2]
+        )
+
+    def remove(self, digest):
+        with self:
+            index = self._read_index()
+            index["blobs"].pop(digest, None)
+            index["urls"] = {url: d for url, d in index["urls"].items() if d != digest}
+            try:
+                os.remove(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+            self._write_index(index)
+
+    def evict(self):
+        """
+        Remove least recently used blobs until the cache fits its budget
+        """
+        with self:
+            index = self._read_index()
+            self._evict(index)
+            self._write_index(index)
+
+
+class MetadataCache:
+    """
+    Small remote files, such as release indexes, stored with the
+    ETag and Last-Modified validators needed to revalidate them
+    """
+    def __init__(self, root=os.path.join(CACHE_ROOT, "meta")):
+        self.root = root
+
+    def _path(self, url):
+        return os.path.join(self.root, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def _write(self, path, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=".store-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def lookup(self, url):
+        """
+        Return the cached body path and its metadata, or None
+        """
+        path = self._path(url)
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url or not os.path.isfile(path):
+            return None
+        return path, meta
+
+    def store(self, url, body, etag=None, last_modified=None):
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(url)
+        self._write(path, body)
+        meta = {"url": url, "etag": etag, "last_modified": last_modified, "fetched": time.time()}
+        self._write(path + ".json", json.dumps(meta).encode("utf-8"))
+        return path
+
+    def touch(self, url):
+        """
+        Record that the cached copy was just revalidated
+        """
+        entry = self.lookup(url)
+        if entry is not None:
+            path, meta = entry
+            meta["fetched"] = time.time()
+            self._write(path + ".json", json.dumps(meta).encode("utf-8"))
@@ -1,12 +1,33 @@
+import dbm
 import errno
+import fcntl
 import hashlib
+import logging
 import os
+import queue
 import re
 import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 hashfunc_map = {}
 hashorigin_map = {}
 
+# read size used when several digests share one pass over a file
+MULTI_BLOCKSIZE = 1024 * 1024
+# from this size on, every digest is updated in its own thread
+THREADED_MIN_SIZE = 64 * 1024 * 1024
+# digests of files without user xattr support are kept here instead
+DIGEST_INDEX = "/var/lib/kutu/cache/digests"
+# chunk size of the SHA256-TREE leaves
+TREE_CHUNK_SIZE = 4 * 1024 * 1024
+# dbm.error is a tuple of the errors of every dbm backend
+_index_errors = (OSError,) + tuple(dbm.error)
+
 
 def _open_file(filename):
     """
@@ -40,6 +61,9 @@ class _GenerateHash:
         hashfunc_map[hashtype] = self
         hashorigin_map[hashtype] = origin
 
+    def new(self):
+        return self._hashobject()
+
     def checksum_str(self, data):
         checksum = self._hashobject()
         checksum.update(data)
@@ -76,18 +100,256 @@ class SizeHash:
 
 
 hashfunc_map["size"] = SizeHash()
+
+
+def _tree_leaf(data):
+    leaf = hashlib.sha256(b"\x00")
+    leaf.update(data)
+    return leaf.digest()
+
+
+def _tree_root(leaves):
+    """
+    Combine leaf digests pairwise up to the root, an odd node is carried up
+    """
+    level = list(leaves)
+    while len(level) > 1:
+        parents = [
+            hashlib.sha256(b"\x01" + level[i] + level[i + 1]).digest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+class _TreeHashObject:
+    """
+    Incremental SHA256-TREE, hashing leaves as chunks fill up
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._leaves = []
+
+    def update(self, data):
+        self._buffer += data
+        while len(self._buffer) >= TREE_CHUNK_SIZE:
+            self._leaves.append(_tree_leaf(memoryview(self._buffer)[:TREE_CHUNK_SIZE]))
+            del self._buffer[:TREE_CHUNK_SIZE]
+
+    def hexdigest(self):
+        leaves = list(self._leaves)
+        if self._buffer or not leaves:
+            leaves.append(_tree_leaf(self._buffer))
+        return _tree_root(leaves).hex()
+
+
+class TreeHash:
+    """
+    Merkle tree over fixed size SHA256 chunks, for our own layer identity.
+    Chunks are hashed in parallel and can be re-verified one by one.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+
+    def new(self):
+        return _TreeHashObject()
+
+    def checksum_str(self, data):
+        checksum = self.new()
+        checksum.update(data)
+        return checksum.hexdigest()
+
+    def _chunk_leaves(self, fd, indexes):
+        def _leaf(index):
+            return _tree_leaf(os.pread(fd, TREE_CHUNK_SIZE, index * TREE_CHUNK_SIZE))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(_leaf, indexes))
+
+    def leaves(self, filename):
+        """
+        Return the leaf digests of a file and its size
+        """
+        with _open_file(filename) as f:
+            size = os.fstat(f.fileno()).st_size
+            count = max(1, -(-size // TREE_CHUNK_SIZE))
+            return self._chunk_leaves(f.fileno(), range(count)), size
+
+    def checksum_file(self, filename):
+        leaves, size = self.leaves(filename)
+        return _tree_root(leaves).hex(), size
+
+    def damaged_chunks(self, filename, leaves, indexes=None):
+        """
+        Return the chunks whose digest no longer matches the recorded
+        leaves, only re-hashing |indexes| when given
+        """
+        if indexes is None:
+            indexes = range(len(leaves))
+        indexes = list(indexes)
+        with _open_file(filename) as f:
+            current = self._chunk_leaves(f.fileno(), indexes)
+        return [i for i, leaf in zip(indexes, current) if leaf != leaves[i]]
+
+
+hashfunc_map["SHA256-TREE"] = TreeHash()
+hashorigin_map["SHA256-TREE"] = "kutu"
 # cache all supported hash methods in a frozenset
 hashfunc_keys = frozenset(hashfunc_map)
+# digests of our own, not part of what perform_all() computes
+kutu_hashfunc_keys = frozenset(["SHA256-TREE"])
 
 
-def perform_checksum(filename, hashname="MD5"):
+class HashReader:
+    """
+    File-like wrapper that hashes everything read through it,
+    optionally copying it to |copy_to| as well
+    """
+    def __init__(self, fileobj, hashname="SHA256", copy_to=None):
+        if hashname not in hashfunc_keys or hashname == "size":
+            raise Exception("{} , hash function not available".format(hashname))
+        self._fileobj = fileobj
+        self._checksum = hashfunc_map[hashname].new()
+        self._copy_to = copy_to
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._checksum.update(data)
+        if self._copy_to is not None:
+            self._copy_to.write(data)
+        self.size = self.size + len(data)
+        return data
+
+    def drain(self, blocksize=1048576):
+        """
+        Read and hash the rest of the stream
+        """
+        while self.read(blocksize):
+            pass
+
+    def hexdigest(self):
+        return self._checksum.hexdigest()
+
+
+class DigestCache:
+    """
+    Remember digests of files in user.kutu.<hash> extended attributes,
+    valid as long as the size, mtime and inode of the file are unchanged.
+    Files on filesystems without user xattrs go to a dbm index instead.
+    """
+    # an mtime this recent may still change without a visible difference
+    racy_window = 2
+
+    def __init__(self, index_path=DIGEST_INDEX):
+        self.index_path = index_path
+
+    @staticmethod
+    def _attr(hashname):
+        return "user.kutu." + hashname.lower()
+
+    @staticmethod
+    def _key(st):
+        return "{} {} {}".format(st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def _index(self, mode):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        lock = open(self.index_path + ".lock", "a")
+        fcntl.flock(lock, fcntl.LOCK_SH if mode == "r" else fcntl.LOCK_EX)
+        try:
+            return lock, dbm.open(self.index_path, mode)
+        except Exception:
+            lock.close()
+            raise
+
+    def _index_get(self, filename, hashname):
+        try:
+            lock, index = self._index("r")
+        except _index_errors:
+            return None
+        try:
+            value = index.get("{}\0{}".format(os.path.abspath(filename), hashname))
+        finally:
+            index.close()
+            lock.close()
+        return value.decode("utf-8") if value is not None else None
+
+    def _index_set(self, filename, hashname, value):
+        try:
+            lock, index = self._index("c")
+        except _index_errors as exc:
+            logger.debug("Digest index unavailable: %s", exc)
+            return
+        try:
+            index["{}\0{}".format(os.path.abspath(filename), hashname)] = value
+        except _index_errors as exc:
+            # the digest is only not remembered
+            logger.debug("Unable to record the digest of '%s': %s", filename, exc)
+        finally:
+            index.close()
+            lock.close()
+
+    def get(self, filename, hashname, st):
+        """
+        Return the recorded digest if the file did not change since
+        """
+        try:
+            value = os.getxattr(filename, self._attr(hashname)).decode("utf-8")
+        except OSError:
+            value = self._index_get(filename, hashname)
+        if value is None:
+            return None
+        key, _, digest = value.rpartition(" ")
+        if key != self._key(st):
+            return None
+        return digest
+
+    def set(self, filename, hashname, st, digest):
+        if time.time_ns() - st.st_mtime_ns < self.racy_window * 1000000000:
+            return
+        value = "{} {}".format(self._key(st), digest)
+        try:
+            os.setxattr(filename, self._attr(hashname), value.encode("utf-8"))
+        except OSError as exc:
+            # ENOTSUP, EROFS, but also ENOSPC or EDQUOT: the checksum succeeded regardless
+            logger.debug("Unable to cache the digest of '%s' in an xattr: %s", filename, exc)
+            self._index_set(filename, hashname, value)
+
+
+digest_cache = DigestCache()
+
+
+def _cached_checksum(filename, hashname, compute):
+    """
+    Look the digest up in the cache, or compute and record it
+    """
+    st = os.stat(filename)
+    if not stat.S_ISREG(st.st_mode):
+        return compute()
+    digest = digest_cache.get(filename, hashname, st)
+    if digest is not None:
+        return digest, st.st_size
+    myhash, mysize = compute()
+    if DigestCache._key(os.stat(filename)) == DigestCache._key(st):
+        digest_cache.set(filename, hashname, st, myhash)
+    return myhash, mysize
+
+
+def perform_checksum(filename, hashname="MD5", use_cache=True):
     """
     Run a specific checksum against a file
     """
     try:
         if hashname not in hashfunc_keys:
             raise Exception("{} , hash function not available".format(hashname))
-        myhash, mysize = hashfunc_map[hashname].checksum_file(filename)
+        if use_cache and hashname != "size":
+            myhash, mysize = _cached_checksum(
+                filename, hashname, lambda: hashfunc_map[hashname].checksum_file(filename)
+            )
+        else:
+            myhash, mysize = hashfunc_map[hashname].checksum_file(filename)
     except (OSError, IOError) as exc:
         if exc.errno in (errno.ENOENT, errno.ESTALE):
             raise Exception("{} : File not found".format(filename))
@@ -97,6 +359,95 @@ def perform_checksum(filename, hashname="MD5"):
     return myhash, mysize
 
 
+def _update_serial(f, checksums):
+    size = 0
+    data = f.read(MULTI_BLOCKSIZE)
+    while data:
+        for checksum in checksums:
+            checksum.update(data)
+        size = size + len(data)
+        data = f.read(MULTI_BLOCKSIZE)
+    return size
+
+
+def _hash_worker(checksum, buffers):
+    while True:
+        data = buffers.get()
+        if data is None:
+            return
+        checksum.update(data)
+
+
+def _update_threaded(f, checksums):
+    # hashlib releases the GIL on large buffers, so each digest gets a
+    # thread fed from the single read pass through a bounded queue
+    queues = []
+    workers = []
+    for checksum in checksums:
+        buffers = queue.Queue(maxsize=8)
+        worker = threading.Thread(target=_hash_worker, args=(checksum, buffers), daemon=True)
+        worker.start()
+        queues.append(buffers)
+        workers.append(worker)
+    size = 0
+    try:
+        data = f.read(MULTI_BLOCKSIZE)
+        while data:
+            for buffers in queues:
+                buffers.put(data)
+            size = size + len(data)
+            data = f.read(MULTI_BLOCKSIZE)
+    finally:
+        for buffers in queues:
+            buffers.put(None)
+        for worker in workers:
+            worker.join()
+    return size
+
+
+def perform_multi(filename, hashnames, use_cache=True):
+    """
+    Run several checksums against a file, reading it only once
+    """
+    hashnames = set(hashnames)
+    for hashname in hashnames:
+        if hashname not in hashfunc_keys:
+            raise Exception("{} , hash function not available".format(hashname))
+    checksums = {x: hashfunc_map[x].new() for x in hashnames if x != "size"}
+    mydict = {}
+    try:
+        st = os.stat(filename)
+        use_cache = use_cache and stat.S_ISREG(st.st_mode)
+        if use_cache:
+            for x in list(checksums):
+                digest = digest_cache.get(filename, x, st)
+                if digest is not None:
+                    mydict[x] = digest
+                    del checksums[x]
+        mysize = st.st_size
+        if checksums:
+            with _open_file(filename) as f:
+                if len(checksums) > 1 and st.st_size >= THREADED_MIN_SIZE:
+                    mysize = _update_threaded(f, list(checksums.values()))
+                else:
+                    mysize = _update_serial(f, list(checksums.values()))
+            unchanged = use_cache and DigestCache._key(os.stat(filename)) == DigestCache._key(st)
+            for x, checksum in checksums.items():
+                mydict[x] = checksum.hexdigest()
+                if unchanged:
+                    digest_cache.set(filename, x, st, mydict[x])
+    except (OSError, IOError) as exc:
+        if exc.errno in (errno.ENOENT, errno.ESTALE):
+            raise Exception("{} : File not found".format(filename))
+        elif exc.errno == errno.EACCES:
+            raise Exception("{} : Permission denied".format(filename))
+        raise
+
+    if "size" in hashnames:
+        mydict["size"] = mysize
+    return mydict
+
+
 def verify_all(filename, mydict, strict=0):
     """
     Verify all checksums against a file
@@ -131,11 +482,12 @@ def verify_all(filename, mydict, strict=0):
         got = " ".join(got)
         return False, ("Insufficient data for checksum verification", got, expected)
 
+    myhashes = perform_multi(filename, verifiable_hash_types)
     for x in sorted(mydict):
         if x == "size":
             continue
         elif x in hashfunc_keys:
-            myhash = perform_checksum(filename, x)[0]
+            myhash = myhashes[x]
             if mydict[x] != myhash:
                 if strict:
                     raise Exception(
@@ -168,10 +520,7 @@ def perform_all(filename):
     """
     Performing for all verifiable_hash_types
     """
-    mydict = {}
-    for k in hashfunc_keys:
-        mydict[k] = perform_checksum(filename, k)[0]
-    return mydict
+    return perform_multi(filename, hashfunc_keys - kutu_hashfunc_keys)
 
 
 def get_valid_checksum_keys():
@@ -239,3 +588,25 @@ def parse_checksum(filename, sumsfile):
         os.remove(sumsfile)
 
     return checksum
+
+
+def benchmark(filename, hashnames=("SHA256", "SHA256-TREE")):
+    """
+    Return the throughput, in MB/s, of each hash function on a file
+    """
+    size = os.stat(filename).st_size
+    result = {}
+    for hashname in hashnames:
+        start = time.monotonic()
+        perform_checksum(filename, hashname, use_cache=False)
+        elapsed = time.monotonic() - start
+        result[hashname] = size / (1024 * 1024) / elapsed if elapsed else float("inf")
+    return result
+
+
+if __name__ == "__main__":
+    # python -m kutu.utils.checksum <file> [hash ...]
+    if len(sys.argv) < 2:
+        sys.exit("usage: {} <file> [hash ...]".format(sys.argv[0]))
+    for name, speed in benchmark(sys.argv[1], sys.argv[2:] or ("SHA256", "SHA256-TREE")).items():
+        print("{:<12} {:>10.1f} MB/s".format(name, speed))
@@ -2,7 +2,15 @@ import logging
 import sys
 import socket
 import base64
+import json
 import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+from .checksum import perform_checksum
 
 _all_errors = [NotImplementedError, ValueError, socket.error]
 
@@ -20,6 +28,141 @@ _all_errors = tuple(_all_errors)
 
 logger = logging.getLogger(__name__)
 
+# size of the chunks read from the response body
+CHUNK_SIZE = 1024 * 1024
+# parallel range requests used for large files
+DOWNLOAD_SEGMENTS = 4
+# files smaller than two segments of this size are fetched in one stream
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+
+
+class _PooledHTTPSConnection(http_client_HTTPConnection):
+    """
+    HTTPS connection resuming the TLS session of its pool
+    """
+    default_port = 443
+
+    def __init__(self, host, pool, **kwargs):
+        super().__init__(host, **kwargs)
+        self.pool = pool
+
+    def connect(self):
+        super().connect()
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self.pool.ssl_context().wrap_socket(
+            self.sock,
+            server_hostname=server_hostname,
+            session=self.pool.get_session(self.host),
+        )
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections, reused per host.
+    At most |max_per_host| idle connections are kept for each host and
+    connections unused for |idle_timeout| seconds are closed.
+    """
+    def __init__(self, max_per_host=4, idle_timeout=30):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._sessions = {}
+        self._context = None
+        self._lock = threading.Lock()
+
+    def ssl_context(self):
+        with self._lock:
+            if self._context is None:
+                import ssl
+                self._context = ssl.create_default_context()
+            return self._context
+
+    def get_session(self, host):
+        with self._lock:
+            return self._sessions.get(host)
+
+    def _evict(self, now):
+        for key, conns in list(self._idle.items()):
+            alive = []
+            for conn, last_used in conns:
+                if now - last_used > self.idle_timeout:
+                    conn.close()
+                else:
+                    alive.append((conn, last_used))
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+
+    def acquire(self, protocol, host):
+        """
+        Return an idle connection to host or a new one
+        """
+        key = (protocol, host)
+        with self._lock:
+            self._evict(time.monotonic())
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop()[0]
+
+        if protocol == "https":
+            conn = _PooledHTTPSConnection(host, self)
+        elif protocol == "http":
+            conn = http_client_HTTPConnection(host)
+            conn.pool = self
+        else:
+            raise NotImplementedError("%s is not a supported protocol." % protocol)
+        conn.pool_key = key
+        return conn
+
+    def release(self, conn):
+        """
+        Give a connection back to the pool, its response must be fully read
+        """
+        session = getattr(conn.sock, "session", None)
+        with self._lock:
+            if session is not None:
+                self._sessions[conn.host] = session
+            now = time.monotonic()
+            self._evict(now)
+            conns = self._idle.setdefault(conn.pool_key, [])
+            if len(conns) < self.max_per_host:
+                conns.append((conn, now))
+                return
+        conn.close()
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+        with self._lock:
+            for conns in self._idle.values():
+                for conn, _ in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+connection_pool = ConnectionPool()
+
+
+def release_conn(conn):
+    """
+    Return a pooled connection, caller owned connections are left alone
+    """
+    if getattr(conn, "pool", None) is not None:
+        conn.pool.release(conn)
+
+
+def _conn_url(conn, address):
+    """
+    Rebuild the absolute url of a request made on |conn|
+    """
+    if isinstance(conn, _PooledHTTPSConnection):
+        protocol = "https"
+    else:
+        protocol = getattr(conn, "pool_key", ("http",))[0]
+    return "{}://{}:{}{}".format(protocol, conn.host, conn.port, address)
+
 
 def create_conn(baseurl, conn=None):
     """
@@ -76,61 +219,93 @@ def create_conn(baseurl, conn=None):
         if protocol == "https":
             # check python ssl support
             try:
-                from http.client import HTTPSConnection as http_client_HTTPSConnection
+                import ssl  # NOQA: F401 imported but unused
             except ImportError:
                 raise NotImplementedError(
                     "python must have ssl enabled for https support"
                 )
-            conn = http_client_HTTPSConnection(host)
-        elif protocol == "http":
-            conn = http_client_HTTPConnection(host)
-        else:
-            raise NotImplementedError("%s is not a supported protocol." % protocol)
+        conn = connection_pool.acquire(protocol, host)
 
     return conn, protocol, address, http_params, http_headers
 
 
-def make_http_request(conn, address, _params={}, headers={}, dest=None):
+def _copy_response(response, dest):
+    """
+    Copy the response body to |dest| in chunks
+    """
+    while True:
+        data = response.read(CHUNK_SIZE)
+        if not data:
+            break
+        dest.write(data)
+
+
+def make_http_request(conn, address, _params={}, headers={}, dest=None, consumer=None, method="GET"):
     """
     Uses the |conn| object to request the data
     """
     rc = 0
     response = None
-    while (rc == 0) or (rc == 301) or (rc == 302):
-        try:
-            if rc != 0:
-                conn = create_conn(address)[0]
-            conn.request("GET", address, body=None, headers=headers)
-        except SystemExit as exc:
-            raise Exception("{}".format(exc))
-        except Exception as exc:
-            return None, None, "Server request failed: {}".format(exc)
-        response = conn.getresponse()
-        rc = response.status
-
-        # 301 means that the page address is wrong.
-        if (rc == 301) or (rc == 302):
-            ignored_data = response.read()
-            del ignored_data
-            for x in str(response.msg).split("\n"):
-                parts = x.split(": ", 1)
-                if parts[0] == "Location":
-                    if rc == 301:
-                        sys.stderr.write(
-                            "Location has moved: "
-                            + str(parts[1])
-                            + "\n"
-                        )
-                    if rc == 302:
-                        sys.stderr.write(
-                            "Location has temporarily moved: "
-                            + str(parts[1])
-                            + "\n"
-                        )
-                    address = parts[1]
+    redirected = None
+    try:
+        while (rc == 0) or (rc == 301) or (rc == 302):
+            try:
+                response = _request(conn, address, headers, method)
+            except SystemExit as exc:
+                raise Exception("{}".format(exc))
+            except Exception as exc:
+                return None, None, "Server request failed: {}".format(exc)
+            rc = response.status
+
+            # 301 means that the page address is wrong.
+            if (rc == 301) or (rc == 302):
+                ignored_data = response.read()
+                del ignored_data
+                location = response.getheader("Location")
+                if location is None:
                     break
+                if rc == 301:
+                    sys.stderr.write("Location has moved: " + location + "\n")
+                if rc == 302:
+                    sys.stderr.write("Location has temporarily moved: " + location + "\n")
+                # follow the redirect on a pooled connection
+                location = urljoin(_conn_url(conn, address), location)
+                if redirected is not None:
+                    release_conn(redirected)
+                redirected = None
+                conn, _, address, _, _ = create_conn(location)
+                redirected = conn
+
+        # the final location, after redirects
+        response.url = _conn_url(conn, address)
+        return _read_response(response, rc, conn, dest, consumer)
+    finally:
+        if redirected is not None:
+            release_conn(redirected)
+
 
+def _request(conn, address, headers, method="GET"):
+    """
+    Send a request, retrying once if a kept-alive connection was dropped
+    """
+    reused = conn.sock is not None
+    try:
+        conn.request(method, address, body=None, headers=headers)
+        return conn.getresponse()
+    except (http_client_error, ConnectionError):
+        if not reused:
+            raise
+        conn.close()
+        conn.request(method, address, body=None, headers=headers)
+        return conn.getresponse()
+
+
+def _read_response(response, rc, conn, dest, consumer):
+    """
+    Hand the body of a final response to |dest| or |consumer|
+    """
     if (rc != 200) and (rc != 206):
+        response.read()
         return (
             None,
             rc,
@@ -138,26 +313,55 @@ def make_http_request(conn, address, _params={}, headers={}, dest=None):
             % (str(response.status), str(response.reason)),
         )
 
-    if dest:
-        dest.write(response.read())
-        return "", 0, ""
+    try:
+        if consumer:
+            consumer(response)
+            return "", 0, ""
+
+        if dest:
+            _copy_response(response, dest)
+            return "", 0, ""
 
-    return response.read(), 0, ""
+        return response.read(), 0, ""
+    finally:
+        # a partially read response leaves the connection unusable
+        if not response.isclosed():
+            conn.close()
 
 
-def file_get(baseurl=None, dest=None, conn=None, filename=None):
+def file_get(baseurl=None, dest=None, conn=None, filename=None, segments=1, resume=False,
+             cache=None, digest=None):
     """
     Takes a base url to connect to and read from.
     URL should be in the form <proto>://<site>[:port]<path>
+    With |segments| > 1 large files are fetched as parallel byte ranges,
+    with |resume| an interrupted download continues where it stopped.
+    A DownloadCache is checked first when given, and filled with the
+    download once it matches the SHA256 |digest|.
     """
     if not os.path.isdir(dest):
         os.mkdir(dest)
 
     filename = str(os.path.basename(baseurl))
     file_path = os.path.join(dest, filename)
-    dest = open(file_path, 'wb')
+    if cache is not None and digest is not None:
+        cached = cache.lookup(baseurl, digest)
+        if cached is not None:
+            logger.info("Using cached '%s'", filename)
+            shutil.copyfile(cached, file_path)
+            return 0
 
-    fetch = file_get_lib(baseurl, dest, conn)
+    if (segments > 1 or resume) and not conn:
+        fetch = file_get_segmented(baseurl, file_path, segments)
+    else:
+        with open(file_path, 'wb') as f:
+            fetch = file_get_lib(baseurl, f, conn)
+
+    if fetch == os.EX_OK and cache is not None and digest is not None:
+        if perform_checksum(file_path, "SHA256")[0] != digest:
+            logger.error("'%s': Failed on SHA256 verification", filename)
+            return 1
+        cache.insert(file_path, baseurl, digest, move=False)
 
     if fetch != os.EX_OK:
         logger.error("Fetcher exited with a failure condition.\n")
@@ -169,7 +373,277 @@ def file_get(baseurl=None, dest=None, conn=None, filename=None):
     return 1
 
 
-def file_get_lib(baseurl, dest, conn=None):
+def file_get_cached(baseurl, dest, cache, max_age=None):
+    """
+    Fetch a small file into dest through a MetadataCache.
+    A cached copy younger than |max_age| seconds is used as is, an older
+    one is revalidated with If-None-Match/If-Modified-Since and served on 304.
+    """
+    if not os.path.isdir(dest):
+        os.mkdir(dest)
+
+    filename = str(os.path.basename(baseurl))
+    file_path = os.path.join(dest, filename)
+    entry = cache.lookup(baseurl)
+    if entry is not None:
+        cached, meta = entry
+        if max_age is not None and time.time() - meta["fetched"] < max_age:
+            logger.debug("Using cached '%s'", filename)
+            shutil.copyfile(cached, file_path)
+            return 0
+
+    headers = {}
+    if entry is not None:
+        if meta["etag"]:
+            headers["If-None-Match"] = meta["etag"]
+        if meta["last_modified"]:
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    fetched = {}
+
+    def _store(response):
+        fetched["path"] = cache.store(
+            baseurl,
+            response.read(),
+            etag=response.getheader("ETag"),
+            last_modified=response.getheader("Last-Modified"),
+        )
+
+    fetch = file_get_lib(baseurl, None, consumer=_store, extra_headers=headers)
+    if fetch == 304 and entry is not None:
+        logger.debug("'%s' not modified", filename)
+        cache.touch(baseurl)
+        shutil.copyfile(cached, file_path)
+        return 0
+    if fetch != os.EX_OK:
+        logger.error("Fetcher exited with a failure condition.\n")
+        return 1
+
+    shutil.copyfile(fetched["path"], file_path)
+    return 0
+
+
+def file_stream(baseurl, consumer, conn=None):
+    """
+    Takes a base url to connect to and passes the response,
+    a file-like object, to |consumer| without storing it.
+    Exceptions raised by the consumer are propagated.
+    """
+    fetch = file_get_lib(baseurl, None, conn, consumer=consumer)
+
+    if fetch != os.EX_OK:
+        logger.error("Fetcher exited with a failure condition.\n")
+        return 1
+
+    return 0
+
+
+class RemoteFileChanged(Exception):
+    pass
+
+
+def probe_url(baseurl):
+    """
+    Return the size, range support, final url and validator of a remote file.
+    The size is None when the server does not report it, the validator is
+    a strong ETag or a Last-Modified date, or None.
+    """
+    info = {}
+
+    def _probe(response):
+        length = response.getheader("Content-Length")
+        info["size"] = int(length) if length and length.isdigit() else None
+        info["ranges"] = response.getheader("Accept-Ranges", "none").strip() == "bytes"
+        info["url"] = response.url
+        etag = response.getheader("ETag")
+        if etag and not etag.startswith("W/"):
+            info["validator"] = etag
+        else:
+            info["validator"] = response.getheader("Last-Modified")
+        # reading the empty body marks the response done, so the
+        # connection goes back to the pool instead of being closed
+        response.read()
+
+    if file_get_lib(baseurl, None, consumer=_probe, method="HEAD") != os.EX_OK:
+        return None, False, baseurl, None
+
+    return info["size"], info["ranges"], info["url"], info["validator"]
+
+
+class PartialDownload:
+    """
+    On-disk state of a download: <file>.part holds the data and
+    <file>.part.json the validator and the verified end of each range
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.part_path = file_path + ".part"
+        self.state_path = self.part_path + ".json"
+        self.state = None
+        self.discarded = False
+        self._lock = threading.Lock()
+
+    def load(self, url, size, validator):
+        """
+        Return the ranges left by an earlier attempt on the same remote file
+        """
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (state.get("url") != url or state.get("size") != size
+                or state.get("validator") != validator
+                or not os.path.isfile(self.part_path)):
+            return None
+        self.state = state
+        return state["ranges"]
+
+    def start(self, url, size, validator, bounds):
+        self.state = {
+            "url": url,
+            "size": size,
+            "validator": validator,
+            "ranges": [[first, first, last] for first, last in bounds],
+        }
+        return self.state["ranges"]
+
+    def advance(self, index, offset):
+        with self._lock:
+            self.state["ranges"][index][1] = offset
+
+    def save(self, fd):
+        """
+        Flush the data, then record how far each range got
+        """
+        if self.state["validator"] is None:
+            # nothing to check a later attempt against
+            return
+        # snapshot first, so that only offsets already written get synced and recorded
+        with self._lock:
+            snapshot = json.dumps(self.state)
+        os.fdatasync(fd)
+        with self._lock:
+            if self.discarded:
+                # ranges still running must not bring the state back
+                return
+            temp_path = self.state_path + ".tmp"
+            with open(temp_path, "w") as f:
+                f.write(snapshot)
+            os.replace(temp_path, self.state_path)
+
+    def discard(self):
+        with self._lock:
+            self.discarded = True
+            for path in (self.part_path, self.state_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def complete(self):
+        os.replace(self.part_path, self.file_path)
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+
+def _fetch_range(baseurl, fd, partial, index, if_range=None):
+    """
+    Fetch the remaining bytes of range |index| and pwrite them in place
+    """
+    _, offset, end = partial.state["ranges"][index]
+
+    def _write(response):
+        content_range = response.getheader("Content-Range", "")
+        if response.status == 200 and if_range:
+            raise RemoteFileChanged("Remote file changed since the download started")
+        if response.status != 206 or not content_range.startswith("bytes {}-{}/".format(offset, end)):
+            raise Exception("Server ignored range request for bytes {}-{}".format(offset, end))
+        position = offset
+        unsaved = 0
+        try:
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                os.pwrite(fd, data, position)
+                position = position + len(data)
+                partial.advance(index, position)
+                unsaved = unsaved + len(data)
+                if unsaved >= SEGMENT_MIN_SIZE:
+                    partial.save(fd)
+                    unsaved = 0
+        finally:
+            partial.save(fd)
+        if position != end + 1:
+            raise Exception("Short read on bytes {}-{}: got {}".format(offset, end, position - offset))
+
+    headers = {"Range": "bytes={}-{}".format(offset, end)}
+    if if_range:
+        headers["If-Range"] = if_range
+    if file_get_lib(baseurl, None, consumer=_write, extra_headers=headers) != os.EX_OK:
+        raise Exception("Failed to fetch bytes {}-{}".format(offset, end))
+
+
+def file_get_segmented(baseurl, file_path, segments=DOWNLOAD_SEGMENTS):
+    """
+    Download baseurl to file_path as parallel byte ranges over pooled
+    connections, falling back to a single stream when the server does
+    not accept ranges or the size is unknown.
+    Data goes to file_path.part; when the server provides a validator
+    an interrupted download is resumed from where it stopped.
+    """
+    size, ranges, url, validator = probe_url(baseurl)
+    partial = PartialDownload(file_path)
+    if not ranges or size is None:
+        partial.discard()
+        with open(partial.part_path, 'wb') as f:
+            fetch = file_get_lib(baseurl, f)
+        if fetch == os.EX_OK:
+            partial.complete()
+        return fetch
+
+    pending = partial.load(baseurl, size, validator)
+    if pending is None:
+        segments = max(1, min(segments, size // SEGMENT_MIN_SIZE))
+        step = size // segments
+        bounds = [(i * step, size - 1 if i == segments - 1 else (i + 1) * step - 1)
+                  for i in range(segments)]
+        pending = partial.start(baseurl, size, validator, bounds)
+        fd = os.open(partial.part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            os.ftruncate(fd, size)
+    else:
+        logger.info("Resuming download of '%s'", os.path.basename(file_path))
+        fd = os.open(partial.part_path, os.O_WRONLY)
+
+    indexes = [i for i, (_, offset, last) in enumerate(pending) if offset <= last]
+    try:
+        logger.debug("Fetching '%s' in %d ranges", os.path.basename(file_path), len(indexes))
+        with ThreadPoolExecutor(max_workers=max(1, len(indexes))) as executor:
+            futures = [executor.submit(_fetch_range, url, fd, partial, i, validator) for i in indexes]
+            for future in futures:
+                try:
+                    future.result()
+                except RemoteFileChanged as exc:
+                    logger.error("Download of '%s' failed: %s", baseurl, exc)
+                    partial.discard()
+                    return 1
+                except Exception as exc:
+                    logger.error("Download of '%s' failed, it can be resumed: %s", baseurl, exc)
+                    return 1
+    finally:
+        os.close(fd)
+
+    partial.complete()
+    return os.EX_OK
+
+
+def file_get_lib(baseurl, dest, conn=None, consumer=None, method="GET", extra_headers=None):
     """
     Takes a base url to connect to and read from.
     URL should be in the form <proto>://<site>[:port]<path>
@@ -180,14 +654,18 @@ def file_get_lib(baseurl, dest, conn=None):
         keepconnection = 1
 
     conn, protocol, address, params, headers = create_conn(baseurl, conn)
+    if extra_headers:
+        headers = dict(headers, **extra_headers)
 
     logger.debug("Fetching '" + str(os.path.basename(address)) + "'\n")
-    if protocol in ["http", "https"]:
-        data, rc, _msg = make_http_request(conn, address, params, headers, dest=dest)
-    else:
-        raise TypeError("Unknown protocol. '%s'" % protocol)
-
-    if not keepconnection:
-        conn.close()
+    try:
+        if protocol in ["http", "https"]:
+            data, rc, _msg = make_http_request(conn, address, params, headers,
+                                               dest=dest, consumer=consumer, method=method)
+        else:
+            raise TypeError("Unknown protocol. '%s'" % protocol)
+    finally:
+        if not keepconnection:
+            release_conn(conn)
 
     return rc
@@ -1,15 +1,462 @@
+import bz2
+import copy
+import errno
+import hashlib
 import logging
+import lzma
+import os
+import queue
+import stat
 import tarfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# size of the blocks read from the source and handed to the parser
+BLOCK_SIZE = 1024 * 1024
+# decompressed blocks buffered between the decompressor and the parser
+QUEUE_DEPTH = 16
+# regular files up to this size are written by the worker pool,
+# bigger ones are streamed to disk by the parser itself
+POOLED_FILE_MAX = 4 * 1024 * 1024
+# file writes are I/O bound, a few more workers than cores keep the disk busy
+EXTRACT_WORKERS = min(16, (os.cpu_count() or 1) * 2)
 
-def tar_extract(filename, dest):
+
+class _Decompressor(threading.Thread):
+    """
+    Read a tar stream, decompress it if needed and queue the result
+    """
+    def __init__(self, fileobj):
+        super().__init__(daemon=True)
+        self._fileobj = fileobj
+        self.blocks = queue.Queue(maxsize=QUEUE_DEPTH)
+        self.stopped = threading.Event()
+        self.error = None
+
+    @staticmethod
+    def _new(data):
+        if data.startswith(b"\x1f\x8b"):
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if data.startswith(b"BZh"):
+            return bz2.BZ2Decompressor()
+        if data.startswith(b"\xfd7zXZ\x00"):
+            return lzma.LZMADecompressor()
+        return None
+
+    def _put(self, block):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decompress(self, decompressor, data):
+        """
+        Decompress data, following concatenated gzip/bz2/xz members.
+        Returns the output and the decompressor to use next, None once
+        the compressed stream is over.
+        """
+        out = []
+        while True:
+            out.append(decompressor.decompress(data))
+            if not decompressor.eof or not decompressor.unused_data:
+                return b"".join(out), decompressor
+            data = decompressor.unused_data
+            decompressor = self._new(data)
+            if decompressor is None:
+                # padding after the last member
+                return b"".join(out), None
+
+    def run(self):
+        try:
+            data = self._fileobj.read(BLOCK_SIZE)
+            decompressor = self._new(data)
+            compressed = decompressor is not None
+            while data:
+                if compressed:
+                    if decompressor.eof:
+                        # the previous member ended on a block boundary
+                        decompressor = self._new(data)
+                        if decompressor is None:
+                            break
+                    data, decompressor = self._decompress(decompressor, data)
+                if data and not self._put(data):
+                    return
+                if compressed and decompressor is None:
+                    break
+                data = self._fileobj.read(BLOCK_SIZE)
+            if compressed and decompressor is not None and not decompressor.eof:
+                raise EOFError("Compressed stream ended before the end-of-stream marker")
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self._put(None)
+
+
+class _BlockReader:
+    """
+    File-like view of the blocks queued by a _Decompressor
+    """
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+        self._block = b""
+        self._pos = 0
+        self._eof = False
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._pos >= len(self._block):
+                if self._eof:
+                    break
+                block = self._decompressor.blocks.get()
+                if block is None:
+                    self._eof = True
+                    if self._decompressor.error is not None:
+                        raise tarfile.ReadError(
+                            "Decompression failed: {}".format(self._decompressor.error)
+                        )
+                    break
+                self._block = memoryview(block)
+                self._pos = 0
+            count = len(self._block) - self._pos
+            if size > 0:
+                count = min(count, size)
+                size = size - count
+            chunks.append(self._block[self._pos:self._pos + count])
+            self._pos = self._pos + count
+        return b"".join(chunks)
+
+
+def _xattrs(member):
+    """
+    Yield the extended attributes stored in the pax headers of a member
+    """
+    for key, value in member.pax_headers.items():
+        if key.startswith("SCHILY.xattr."):
+            # tarfile decodes pax values with surrogateescape, undo it
+            yield key[len("SCHILY.xattr."):], value.encode("utf-8", "surrogateescape")
+
+
+def _mtime_ns(member):
+    """
+    Member mtime in nanoseconds, exact when a pax header carries it
+    """
+    value = member.pax_headers.get("mtime")
+    if value is not None:
+        seconds, _, fraction = value.partition(".")
+        try:
+            mtime = int(seconds) * 1000000000
+            fraction = (fraction + "000000000")[:9]
+            return mtime - int(fraction) if value.startswith("-") else mtime + int(fraction)
+        except ValueError:
+            pass
+    return int(member.mtime * 1000000000)
+
+
+class _Extractor:
+    """
+    Recreate the members of a tar stream under dest.
+    The parser creates directories, links and device nodes in archive
+    order and hands regular files to a bounded pool of writers; a path
+    is never touched again before its pending write has finished.
+    Directory metadata is applied last, deepest first.
+    The sha256 of regular files is recorded in |digests| when given,
+    the name of every member in |names|. With |keep_dir_links| a symlink
+    to a directory inside dest stands in for a directory member, as
+    dpkg does for merged /usr. Symlinks met on the way to a member are
+    resolved as if dest were the root, nothing is written outside it.
+    """
+    def __init__(self, archive, dest, workers, digests=None, names=None, keep_dir_links=False):
+        self.archive = archive
+        self.dest = dest
+        self.root = os.path.realpath(dest)
+        self.digests = digests
+        self.names = names
+        self.keep_dir_links = keep_dir_links
+        self.is_root = os.geteuid() == 0
+        self.pending = {}
+        # archive directory -> resolved, existing directory under root
+        self.parents = {}
+        self.directories = []
+        self.slots = threading.Semaphore(workers * 4)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _wait(self, path):
+        future = self.pending.pop(os.path.normpath(path), None)
+        if future is not None:
+            future.result()
+
+    def _reap(self):
+        for path, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[path]
+                future.result()
+
+    def _submit(self, path, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._write_file, path, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        self.pending[os.path.normpath(path)] = future
+        if len(self.pending) > 1024:
+            self._reap()
+
+    @staticmethod
+    def _set_xattrs(target, member):
+        for name, value in _xattrs(member):
+            try:
+                os.setxattr(target, name, value)
+            except OSError as exc:
+                if exc.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+                logger.debug("Unable to set xattr '%s' on '%s': %s", name, member.name, exc)
+
+    def _set_attrs(self, target, member, follow_symlinks=True):
+        """
+        Apply owner, mode, xattrs and mtime; target is a path or an open fd
+        """
+        if self.is_root:
+            os.chown(target, member.uid, member.gid, follow_symlinks=follow_symlinks)
+        if follow_symlinks:
+            os.chmod(target, member.mode)
+            self._set_xattrs(target, member)
+        mtime = _mtime_ns(member)
+        os.utime(target, ns=(mtime, mtime), follow_symlinks=follow_symlinks)
+
+    def _write_file(self, path, member, data):
+        if self.digests is not None:
+            self.digests[os.path.normpath(member.name)] = hashlib.sha256(data).digest()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            self._set_attrs(fd, member)
+        finally:
+            os.close(fd)
+
+    def _stream_file(self, path, member):
+        source = self.archive.extractfile(member)
+        digest = hashlib.sha256()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+        try:
+            data = source.read(BLOCK_SIZE)
+            while data:
+                digest.update(data)
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                data = source.read(BLOCK_SIZE)
+            self._set_attrs(fd, member)
+        finally:
+            os.close(fd)
+        if self.digests is not None:
+            self.digests[os.path.normpath(member.name)] = digest.digest()
+
+    @staticmethod
+    def _remove(path):
+        """
+        Make way for a new entry, existing directories are kept
+        """
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISDIR(st.st_mode):
+            os.unlink(path)
+
+    def _resolve(self, name):
+        """
+        Return the path of |name| under root with the symlinks among its
+        parents resolved inside root: absolute targets start over at
+        root and '..' stops there. The last component is not followed.
+        """
+        parts = [part for part in name.split("/") if part not in ("", ".")]
+        resolved = []
+        links = 0
+        while len(parts) > 1:
+            part = parts.pop(0)
+            if part == "..":
+                if resolved:
+                    resolved.pop()
+                continue
+            path = os.path.join(self.root, *resolved, part)
+            if not os.path.islink(path):
+                resolved.append(part)
+                continue
+            links = links + 1
+            if links > 40:
+                raise tarfile.TarError("Too many levels of symbolic links in '{}'".format(name))
+            target = os.readlink(path)
+            if target.startswith("/"):
+                resolved = []
+            parts = [part for part in target.split("/") if part not in ("", ".")] + parts
+        if parts and parts[0] == "..":
+            if resolved:
+                resolved.pop()
+            parts = []
+        return os.path.join(self.root, *(resolved + parts))
+
+    def _parent(self, name):
+        """
+        Resolve and create the directory |name| is extracted to
+        """
+        parent = os.path.dirname(os.path.normpath(name))
+        path = self.parents.get(parent)
+        if path is None:
+            # "x" stands in for the last component so that parent is followed
+            path = os.path.dirname(self._resolve(os.path.join(parent, "x")))
+            os.makedirs(path, exist_ok=True)
+            # directories are never replaced, the resolution stays valid
+            self.parents[parent] = path
+        return path
+
+    def _dir_link(self, name, path):
+        if not os.path.islink(path):
+            return False
+        return os.path.isdir(os.path.dirname(self._resolve(os.path.join(name, "x"))))
+
+    def extract(self, member):
+        name = os.path.normpath(member.name)
+        if self.names is not None:
+            self.names.append(member.name)
+        if name == ".":
+            path = self.root
+        else:
+            path = os.path.join(self._parent(name), os.path.basename(name))
+        self._wait(path)
+        if member.isdir():
+            if self.keep_dir_links and self._dir_link(name, path):
+                return
+            self._remove(path)
+            os.makedirs(path, exist_ok=True)
+            self.directories.append((path, member))
+            return
+
+        self._remove(path)
+        if member.isreg() and not member.issparse():
+            if member.size <= POOLED_FILE_MAX:
+                self._submit(path, member, self.archive.extractfile(member).read())
+            else:
+                self._stream_file(path, member)
+        elif member.isreg():
+            # sparse files are left to tarfile, which knows their map
+            kwargs = {"filter": "fully_trusted"} if hasattr(tarfile, "fully_trusted_filter") else {}
+            # extracted into its resolved parent, tarfile follows symlinks
+            member = copy.copy(member)
+            member.name = os.path.basename(path)
+            self.archive.extract(member, os.path.dirname(path), numeric_owner=True, **kwargs)
+            self._set_xattrs(path, member)
+            mtime = _mtime_ns(member)
+            os.utime(path, ns=(mtime, mtime))
+        elif member.issym():
+            os.symlink(member.linkname, path)
+            self._set_attrs(path, member, follow_symlinks=False)
+        elif member.islnk():
+            target = self._resolve(member.linkname)
+            self._wait(target)
+            os.link(target, path, follow_symlinks=False)
+            if self.digests is not None and os.path.normpath(member.linkname) in self.digests:
+                self.digests[os.path.normpath(member.name)] = self.digests[os.path.normpath(member.linkname)]
+        elif member.ischr() or member.isblk() or member.isfifo():
+            if member.ischr():
+                mode = stat.S_IFCHR
+            elif member.isblk():
+                mode = stat.S_IFBLK
+            else:
+                mode = stat.S_IFIFO
+            try:
+                os.mknod(path, mode | member.mode, os.makedev(member.devmajor, member.devminor))
+            except PermissionError as exc:
+                logger.debug("Unable to create device node '%s': %s", member.name, exc)
+                return
+            self._set_attrs(path, member)
+        else:
+            logger.debug("Skipping '%s' of unsupported type %r", member.name, member.type)
+
+    def run(self, members):
+        try:
+            for member in members:
+                self.extract(member)
+        finally:
+            self.executor.shutdown(wait=True)
+        for future in self.pending.values():
+            future.result()
+        # mtimes of directories change while they are filled, set them last
+        self.directories.sort(key=lambda item: item[0], reverse=True)
+        for path, member in self.directories:
+            self._set_attrs(path, member)
+
+
+def _checked_members(archive, dest):
+    """
+    Yield archive members, refusing those that would land outside |dest|.
+    Relative symlinks must stay inside it too; absolute ones are kept,
+    they point into the root of the container.
+    """
+    for member in archive:
+        names = [member.name]
+        if member.islnk():
+            names.append(member.linkname)
+        elif member.issym() and not os.path.isabs(member.linkname):
+            names.append(os.path.join(os.path.dirname(member.name), member.linkname))
+        for name in names:
+            name = os.path.normpath(name)
+            if os.path.isabs(name) or name == ".." or name.startswith("../"):
+                raise tarfile.TarError("Refusing to extract '{}' outside of '{}'".format(member.name, dest))
+        yield member
+
+
+def extract_pipelined(fileobj, dest, workers=EXTRACT_WORKERS, digests=None,
+                      names=None, keep_dir_links=False):
+    """
+    Extract a (possibly compressed) tar stream read sequentially from
+    |fileobj|: decompression, member parsing and file writes run in
+    separate threads. |digests|, when given, is filled with the sha256
+    of the regular files by relative path, |names| with member names.
+    Raises OSError or tarfile.TarError on failure.
+    """
+    decompressor = _Decompressor(fileobj)
+    decompressor.start()
+    try:
+        with tarfile.open(fileobj=_BlockReader(decompressor), mode="r|") as archive:
+            extractor = _Extractor(archive, dest, workers, digests, names, keep_dir_links)
+            extractor.run(_checked_members(archive, dest))
+    finally:
+        decompressor.stopped.set()
+        decompressor.join()
+
+
+def tar_extract(filename, dest, digests=None):
     try:
-        with tarfile.open(filename, "r:*") as extract_me:
+        with open(filename, "rb") as f:
             logger.debug("Extracting '%s' to '%s'", filename, dest)
-            extract_me.extractall(dest)
+            extract_pipelined(f, dest, digests=digests)
             logger.info("Extracted '%s' to '%s'", filename, dest)
             return True
-    except (OSError, tarfile.TarError):
+    except (OSError, tarfile.TarError) as exc:
+        logger.error("Extracting '%s' to '%s' failed: %s", filename, dest, exc)
+        return False
+
+
+def tar_extract_stream(fileobj, dest, digests=None):
+    """
+    Extract a (possibly compressed) tar stream read sequentially from |fileobj|
+    """
+    try:
+        logger.debug("Extracting stream to '%s'", dest)
+        extract_pipelined(fileobj, dest, digests=digests)
+        logger.info("Extracted stream to '%s'", dest)
+        return True
+    except (OSError, tarfile.TarError) as exc:
+        logger.error("Extracting stream to '%s' failed: %s", dest, exc)
         return False
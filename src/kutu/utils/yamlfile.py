@@ -0,0 +1,24 @@
+import json
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def yaml_load(filename):
+    """
+    Load a YAML file with PyYAML. Without it only JSON, which is
+    valid YAML too, can be read.
+    """
+    with open(filename, "r") as f:
+        text = f.read()
+    if yaml is not None:
+        try:
+            return yaml.safe_load(text)
+        except yaml.YAMLError as exc:
+            raise Exception("'{}': Invalid YAML: {}".format(filename, exc))
+    try:
+        return json.loads(text)
+    except ValueError:
+        raise Exception("'{}': PyYAML is needed to read YAML, install kutu[yaml] or use JSON".format(filename))